@@ -0,0 +1,365 @@
+"""In-memory stand-in for the parts of `BlitzGateway` that the collection helpers use.
+
+Every call that would be a server round-trip sleeps for `latency` seconds and is counted in
+`FakeGateway.calls`, so benchmarks can report the number of round-trips next to the wall time.
+Projection queries are answered for the queries defined in `biohack_utils.omero_annotation` and
+`biohack_utils.consistency`; other queries raise `NotImplementedError`.
+"""
+import itertools
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from omero.rtypes import rlong, rstring, unwrap
+
+from biohack_utils import consistency
+from biohack_utils import omero_annotation as oa
+
+
+def _value(rvalue):
+    return rvalue.getValue() if hasattr(rvalue, "getValue") else rvalue
+
+
+class _MapAnnotation:
+    def __init__(self, gateway, ann_id):
+        self._gateway = gateway
+        self._id = ann_id
+
+    def getId(self):
+        return self._id
+
+    def getNs(self):
+        return self._gateway.annotations[self._id]["ns"]
+
+    def getValue(self):
+        return list(self._gateway.annotations[self._id]["kv"])
+
+
+class _Image:
+    def __init__(self, gateway, image_id):
+        self._gateway = gateway
+        self._id = image_id
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._gateway.images[self._id]
+
+    def listAnnotations(self, ns=None):
+        self._gateway._round_trip("listAnnotations")
+        return [
+            _MapAnnotation(self._gateway, ann_id) for ann_id in self._gateway.annotations_of_image[self._id]
+            if ns is None or self._gateway.annotations[ann_id]["ns"] == ns
+        ]
+
+    def linkAnnotation(self, ann):
+        self._gateway._round_trip("linkAnnotation")
+        self._gateway.add_link(self._id, ann.getId())
+
+    def getParent(self):
+        datasets = self._gateway.datasets_of_image.get(self._id)
+        return _Dataset(self._gateway, min(datasets)) if datasets else None
+
+
+class _Dataset:
+    def __init__(self, gateway, dataset_id):
+        self._gateway = gateway
+        self._id = dataset_id
+
+    def getId(self):
+        return self._id
+
+    def listChildren(self):
+        self._gateway._round_trip("listChildren")
+        return [_Image(self._gateway, image_id) for image_id in self._gateway.datasets[self._id]]
+
+
+class _QueryService:
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._handlers = {
+            oa._COLLECTIONS_OF_IMAGE_QUERY: gateway._collections_of_image,
+            oa._MEMBERS_OF_COLLECTIONS_QUERY: gateway._members_of_collections,
+            oa._EXISTING_COLLECTION_LINKS_QUERY: gateway._existing_collection_links,
+            oa._NODES_OF_IMAGES_QUERY: gateway._nodes_of_images,
+            oa._IMAGES_WITH_ANNOTATION_QUERY: gateway._images_with_annotation,
+            oa._LINKS_OF_IMAGES_QUERY: gateway._links_of_images,
+            consistency._ANNOTATION_ID_RANGE_QUERY: gateway._annotation_id_range,
+            consistency._IMAGE_ID_RANGE_QUERY: gateway._image_id_range,
+            consistency._ANNOTATIONS_IN_RANGE_QUERY: gateway._annotations_in_range,
+            consistency._UNLINKED_IN_RANGE_QUERY: gateway._unlinked_in_range,
+            consistency._NODES_IN_RANGE_QUERY: gateway._nodes_in_range,
+            consistency._COLLECTION_LINKS_IN_RANGE_QUERY: gateway._collection_links_in_range,
+        }
+        for by_type, by_name, paged in itertools.product((False, True), repeat=3):
+            self._handlers[oa._filtered_members_query(by_type, by_name, paged)] = gateway._filtered_members
+
+    def projection(self, query, params, ctx=None):
+        self._gateway._round_trip("projection")
+        handler = self._handlers.get(query)
+        if handler is None:
+            raise NotImplementedError(f"The fake gateway can't answer: {query}")
+        args = {key: unwrap(value) for key, value in params.map.items()}
+        rows = handler(args)
+        page = getattr(params, "theFilter", None)
+        if page is not None and unwrap(page.limit) is not None:
+            offset = unwrap(page.offset) or 0
+            rows = rows[offset:offset + unwrap(page.limit)]
+        return [[rstring(v) if isinstance(v, str) else None if v is None else rlong(v) for v in row] for row in rows]
+
+
+class _UpdateService:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def _save(self, obj):
+        kind = type(obj).__name__
+        if kind == "MapAnnotationI":
+            if obj.getId() is None:
+                ann_id = self._gateway.add_annotation(
+                    _value(obj.getNs()), [(nv.name, nv.value) for nv in obj.getMapValue()]
+                )
+                obj.setId(rlong(ann_id))
+            return obj
+        if kind == "ImageAnnotationLinkI":
+            self._save(obj.getChild())
+            link_id = self._gateway.add_link(_value(obj.getParent().getId()), _value(obj.getChild().getId()))
+            obj.setId(rlong(link_id))
+            return obj
+        raise NotImplementedError(f"The fake gateway can't save {kind}")
+
+    def saveObject(self, obj, ctx=None):
+        self._gateway._round_trip("saveObject")
+        self._save(obj)
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._gateway._round_trip("saveAndReturnObject")
+        return self._save(obj)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._gateway._round_trip("saveAndReturnArray")
+        return [self._save(obj) for obj in objs]
+
+
+class FakePool:
+    """Stand-in for `biohack_utils.session.ConnectionPool` that hands out the gateway itself.
+    """
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    @contextmanager
+    def connection(self, timeout=None):
+        yield self._gateway
+
+    def close(self):
+        pass
+
+
+class FakeGateway:
+    """In-memory OMERO server with images, datasets, map annotations and image annotation links.
+
+    Args:
+        latency: Seconds every round-trip takes.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.SERVICE_OPTS = {}
+        self.host = "fake"
+        self.images = {}
+        self.datasets = defaultdict(list)
+        self.datasets_of_image = defaultdict(set)
+        self.annotations = {}
+        self.links = {}
+        self.annotations_of_image = defaultdict(list)
+        self.images_of_annotation = defaultdict(list)
+        self._ids = itertools.count(1)
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    def _round_trip(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    #
+    # Populating the server, these don't count as round-trips.
+    #
+
+    def add_image(self, name, dataset_id=None):
+        image_id = next(self._ids)
+        self.images[image_id] = name
+        if dataset_id is not None:
+            self.datasets[dataset_id].append(image_id)
+            self.datasets_of_image[image_id].add(dataset_id)
+        return image_id
+
+    def add_annotation(self, ns, kv):
+        ann_id = next(self._ids)
+        self.annotations[ann_id] = {"ns": ns, "kv": [(str(k), str(v)) for k, v in kv]}
+        return ann_id
+
+    def add_link(self, image_id, ann_id):
+        link_id = next(self._ids)
+        self.links[link_id] = (image_id, ann_id)
+        self.annotations_of_image[image_id].append(ann_id)
+        self.images_of_annotation[ann_id].append(image_id)
+        return link_id
+
+    #
+    # The BlitzGateway API.
+    #
+
+    def getQueryService(self):
+        return _QueryService(self)
+
+    def getUpdateService(self):
+        return _UpdateService(self)
+
+    def getObject(self, obj_type, obj_id):
+        self._round_trip("getObject")
+        if obj_type == "Image":
+            return _Image(self, obj_id) if obj_id in self.images else None
+        if obj_type in ("Annotation", "MapAnnotation"):
+            return _MapAnnotation(self, obj_id) if obj_id in self.annotations else None
+        if obj_type == "Dataset":
+            return _Dataset(self, obj_id) if obj_id in self.datasets else None
+        raise NotImplementedError(f"The fake gateway has no {obj_type} objects")
+
+    def getObjectsByAnnotations(self, obj_type, ann_ids):
+        self._round_trip("getObjectsByAnnotations")
+        image_ids = dict.fromkeys(image_id for ann_id in ann_ids for image_id in self.images_of_annotation[ann_id])
+        return [_Image(self, image_id) for image_id in image_ids]
+
+    #
+    # Projection queries, the rows have the same layout as the HQL in omero_annotation.
+    #
+
+    def _annotations_in_ns(self, image_ids, ns):
+        for image_id in image_ids:
+            for ann_id in sorted(set(self.annotations_of_image[image_id])):
+                if self.annotations[ann_id]["ns"] == ns:
+                    yield image_id, ann_id
+
+    def _collections_of_image(self, args):
+        return [
+            (ann_id, key, value)
+            for _, ann_id in self._annotations_in_ns([args["iid"]], args["ns"])
+            for key, value in self.annotations[ann_id]["kv"]
+        ]
+
+    def _members_of_collections(self, args):
+        return [(ann_id, image_id) for ann_id in args["cids"] for image_id in self.images_of_annotation[ann_id]]
+
+    def _existing_collection_links(self, args):
+        cids = set(args["cids"])
+        return [
+            (ann_id, image_id) for image_id in args["ids"] for ann_id in self.annotations_of_image[image_id]
+            if ann_id in cids
+        ]
+
+    def _nodes_of_images(self, args):
+        return [
+            (image_id, ann_id, key, value)
+            for image_id, ann_id in self._annotations_in_ns(args["ids"], args["ns"])
+            for key, value in self.annotations[ann_id]["kv"]
+        ]
+
+    def _images_with_annotation(self, args):
+        return sorted({(image_id,) for image_id, _ in self._annotations_in_ns(args["ids"], args["ns"])})
+
+    def _filtered_members(self, args):
+        rows = set()
+        for coll_id in args["cids"]:
+            for image_id in self.images_of_annotation[coll_id]:
+                if image_id <= args.get("after", 0):
+                    continue
+                if "types" in args or "names" in args:
+                    nodes = [
+                        dict(self.annotations[ann_id]["kv"])
+                        for _, ann_id in self._annotations_in_ns([image_id], args["ns"])
+                    ]
+                    if not any(
+                        kv.get("collection_id") == str(coll_id)
+                        and ("types" not in args or kv.get("type") in args["types"])
+                        and ("names" not in args or kv.get("name") in args["names"])
+                        for kv in nodes
+                    ):
+                        continue
+                rows.add((coll_id, image_id))
+        return sorted(rows, key=lambda row: (row[1], row[0]))
+
+    def _links_of_images(self, args):
+        return [
+            (image_id, value)
+            for image_id, ann_id in self._annotations_in_ns(args["ids"], args["ns"])
+            for key, value in self.annotations[ann_id]["kv"] if key == "link"
+        ]
+
+    def _in_ns(self, ns):
+        return [ann_id for ann_id, ann in self.annotations.items() if ann["ns"] == ns]
+
+    def _annotation_id_range(self, args):
+        ann_ids = self._in_ns(args["ns"])
+        return [(min(ann_ids), max(ann_ids))] if ann_ids else [(None, None)]
+
+    def _image_id_range(self, args):
+        image_ids = [
+            image_id for image_id, ann_id in self.links.values() if self.annotations[ann_id]["ns"] == args["ns"]
+        ]
+        return [(min(image_ids), max(image_ids))] if image_ids else [(None, None)]
+
+    def _annotations_in_range(self, args):
+        return [(ann_id,) for ann_id in sorted(self._in_ns(args["ns"])) if args["after"] < ann_id <= args["upto"]]
+
+    def _unlinked_in_range(self, args):
+        return [row for row in self._annotations_in_range(args) if not self.images_of_annotation[row[0]]]
+
+    def _nodes_in_range(self, args):
+        image_ids = sorted(
+            image_id for image_id in self.annotations_of_image if args["after"] < image_id <= args["upto"]
+        )
+        return [
+            (image_id, ann_id, key, value)
+            for image_id, ann_id in self._annotations_in_ns(image_ids, args["ns"])
+            for key, value in sorted(self.annotations[ann_id]["kv"]) if key in ("collection_id", "type")
+        ]
+
+    def _collection_links_in_range(self, args):
+        return [
+            (image_id, ann_id) for image_id, ann_id in self.links.values()
+            if args["after"] < image_id <= args["upto"] and self.annotations[ann_id]["ns"] == args["ns"]
+        ]
+
+
+def make_collection_server(n_images, latency=0.0, n_collections=1, dataset_id=1):
+    """A fake server with `n_images` images in one dataset, spread over `n_collections` collections.
+
+    The first member of each collection is the raw image ("Intensities"), the others are labels.
+
+    Returns:
+        The gateway and the ids of the collections.
+    """
+    gateway = FakeGateway(latency=0.0)
+    collection_ids = [
+        gateway.add_annotation(oa.NS_COLLECTION, [("version", "0.x"), ("type", "collection"), ("name", f"c{i}")])
+        for i in range(n_collections)
+    ]
+    gateway.datasets[dataset_id] = []
+    for i in range(n_images):
+        coll_id = collection_ids[i % n_collections]
+        image_id = gateway.add_image(f"image_{i}", dataset_id)
+        node_type = "Intensities" if i < n_collections else "Labels"
+        node_id = gateway.add_annotation(
+            oa.NS_NODE, [("type", node_type), ("collection_id", coll_id), ("name", f"node_{i}")]
+        )
+        gateway.add_link(image_id, coll_id)
+        gateway.add_link(image_id, node_id)
+    gateway.latency = latency
+    return gateway, collection_ids
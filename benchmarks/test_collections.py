@@ -0,0 +1,146 @@
+"""Benchmarks of the collection helpers against the in-memory `FakeGateway`.
+
+Run them with pytest-benchmark, e.g. to compare against the last saved run:
+
+    pytest benchmarks --benchmark-autosave --benchmark-compare
+
+The number of server round-trips of the last round is stored in `extra_info` of every benchmark,
+and the benchmarks fail if it exceeds the expected budget. `BIOHACK_BENCH_LATENCY` sets the
+latency of each round-trip in seconds (0 by default, which measures the client-side cost).
+"""
+import importlib.util
+import os
+
+import pytest
+
+# The collection helpers need omero-py with a working Ice, skip the benchmarks without it.
+pytest.importorskip("omero.rtypes", exc_type=ImportError)
+
+from biohack_utils import omero_annotation as oa  # noqa: E402
+
+from fake_gateway import FakePool, make_collection_server  # noqa: E402
+
+
+SIZES = [10, 1_000, 100_000]
+LATENCY = float(os.environ.get("BIOHACK_BENCH_LATENCY", "0"))
+
+
+def _load_development_script(name):
+    path = os.path.join(os.path.dirname(__file__), "..", "development", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda n: f"{n}_images")
+def server(request):
+    gateway, collection_ids = make_collection_server(request.param, latency=LATENCY)
+    return gateway, collection_ids[0], request.param
+
+
+def _run(benchmark, gateway, func, *args, **kwargs):
+    rounds = 3 if len(gateway.images) >= 100_000 else 10
+    result = benchmark.pedantic(
+        func, args=args, kwargs=kwargs, setup=gateway.reset_calls, rounds=rounds, iterations=1
+    )
+    benchmark.extra_info["server_calls"] = gateway.round_trips
+    benchmark.extra_info["calls"] = dict(gateway.calls)
+    return result
+
+
+def test_get_collections(benchmark, server):
+    gateway, collection_id, n_images = server
+    raw_id = next(iter(gateway.images))
+    collections = _run(benchmark, gateway, oa._get_collections, gateway, raw_id)
+    assert len(collections[0]["members"]) == n_images
+    assert gateway.round_trips <= 3
+
+
+def test_find_related_images(benchmark, server):
+    gateway, collection_id, n_images = server
+    raw_id = next(iter(gateway.images))
+    related = _run(benchmark, gateway, oa._find_related_images, gateway, raw_id, node_type="Labels")
+    assert len(related) == n_images - 1
+    assert gateway.round_trips <= 3
+
+
+def test_fetch_raw_node_of_large_collection(benchmark, server):
+    gateway, collection_id, n_images = server
+    raw_id = next(iter(gateway.images))
+    label_id = list(gateway.images)[-1]
+    # The single "Intensities" node is selected on the server, the labels are never transferred.
+    related = _run(benchmark, gateway, oa._find_related_images, gateway, label_id, node_type="Intensities")
+    assert [member["image_id"] for member in related] == [raw_id]
+    assert gateway.round_trips <= 3
+
+
+def test_iter_collection_members_first_page(benchmark, server):
+    gateway, collection_id, n_images = server
+
+    def _first_page():
+        members = oa.iter_collection_members(gateway, collection_id, node_type="Labels", page_size=100)
+        return [member for _, member in zip(range(100), members)]
+
+    members = _run(benchmark, gateway, _first_page)
+    assert len(members) == min(100, n_images - 1)
+    assert gateway.round_trips <= 2
+
+
+@pytest.mark.parametrize("node_type", [None, "Labels"])
+def test_find_images_with_collection_id_in_dataset(benchmark, server, node_type, capsys):
+    gateway, collection_id, n_images = server
+    images = _run(
+        benchmark, gateway, oa._find_images_with_collection_id_in_dataset,
+        gateway, collection_id, 1, node_type=node_type,
+    )
+    capsys.readouterr()
+    assert len(images) == (n_images if node_type is None else n_images - 1)
+
+
+@pytest.mark.parametrize("n_images", SIZES, ids=lambda n: f"{n}_images")
+def test_write_annotations_to_image_and_labels(benchmark, n_images):
+    connect_annotations = _load_development_script("connect_annotations")
+    gateway, _ = make_collection_server(n_images, latency=LATENCY)
+    image_ids = list(gateway.images)
+    node_ids = _run(
+        benchmark, gateway, connect_annotations.write_annotations_to_image_and_labels,
+        gateway, image_ids[:-1], image_ids[-1],
+    )
+    assert len(node_ids) == n_images
+    # One save for the collection, then the existing collection links and image links and a save per
+    # chunk of 500 nodes.
+    assert gateway.round_trips <= 1 + 3 * -(-n_images // 500)
+
+
+@pytest.mark.parametrize("n_images", SIZES, ids=lambda n: f"{n}_images")
+def test_scan_collections(benchmark, n_images):
+    from biohack_utils.consistency import repair_plan, scan_collections
+
+    gateway, (collection_id,) = make_collection_server(n_images, latency=LATENCY)
+    image_ids = list(gateway.images)
+    # The debris of interrupted writes.
+    unlinked_collection = gateway.add_annotation(oa.NS_COLLECTION, [("type", "collection"), ("name", "lost")])
+    unlinked_node = gateway.add_annotation(oa.NS_NODE, [("type", "Labels"), ("collection_id", collection_id)])
+    dangling_node = gateway.add_annotation(oa.NS_NODE, [("type", "Labels"), ("collection_id", 999_999_999)])
+    gateway.add_link(image_ids[0], dangling_node)
+    duplicate_node = gateway.add_annotation(oa.NS_NODE, [("type", "Labels"), ("collection_id", collection_id)])
+    gateway.add_link(image_ids[-1], duplicate_node)
+    unlinked_image = gateway.add_image("unlinked")
+    gateway.add_link(unlinked_image, gateway.add_annotation(
+        oa.NS_NODE, [("type", "Labels"), ("collection_id", collection_id)]
+    ))
+
+    report = _run(
+        benchmark, gateway, scan_collections, gateway, range_size=10_000, page_size=5_000, pool=FakePool(gateway)
+    )
+    assert report["unlinked_collections"] == [unlinked_collection]
+    assert report["unlinked_nodes"] == [unlinked_node]
+    assert [node["node_id"] for node in report["dangling_nodes"]] == [dangling_node]
+    assert [duplicate["image_id"] for duplicate in report["duplicate_nodes"]] == [image_ids[-1]]
+    assert report["missing_collection_links"] == [{"image_id": unlinked_image, "collection_id": collection_id}]
+    assert report["nodes"] == n_images + 4
+
+    plan = repair_plan(report)
+    assert plan["links"] == [[(unlinked_image, collection_id)]]
+    assert sorted(plan["delete"][0]) == sorted([unlinked_node, dangling_node, duplicate_node, unlinked_collection])
@@ -0,0 +1,189 @@
+"""asyncio facade for reading and writing collections, on top of a `session.ConnectionPool`.
+
+Every call borrows a connection of the pool for its duration. Projection queries use Ice's
+asynchronous invocations (`begin_projection`), so a lookup waits for the server without
+occupying a thread, and independent lookups overlap, e.g. with `asyncio.gather`.
+The write helpers run the blocking implementations of `omero_annotation` in worker threads.
+The number of concurrent calls per pool is limited, see `limit_concurrency`.
+
+Example:
+    pool = ConnectionPool.from_connection(conn, size=8)
+    collections = await asyncio.gather(*(get_collections_async(pool, iid) for iid in image_ids))
+"""
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from omero.rtypes import rlist, rlong, unwrap
+from omero.sys import ParametersI
+
+from . import omero_annotation
+from .omero_annotation import (
+    NS_COLLECTION, NS_NODE, _COLLECTIONS_OF_IMAGE_QUERY, _MEMBERS_OF_COLLECTIONS_QUERY, _NODES_OF_IMAGES_QUERY,
+)
+
+
+def limit_concurrency(pool, max_concurrent):
+    """Set the maximal number of concurrent calls on this pool, by default the pool size.
+    """
+    pool._biohack_async_limit = max_concurrent
+    pool._biohack_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore(pool):
+    """The semaphore of the pool for the running event loop.
+
+    A semaphore is bound to the loop it is first used in, so every loop gets its own one and
+    the pool can be used by several `asyncio.run` calls.
+    """
+    semaphores = getattr(pool, "_biohack_async_semaphores", None)
+    if semaphores is None:
+        semaphores = pool._biohack_async_semaphores = weakref.WeakKeyDictionary()
+    loop = asyncio.get_running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = semaphores[loop] = asyncio.Semaphore(getattr(pool, "_biohack_async_limit", None) or pool.size)
+    return semaphore
+
+
+@asynccontextmanager
+async def _pooled(pool):
+    async with _semaphore(pool):
+        conn = await asyncio.to_thread(pool.acquire)
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+
+def _resolve(future, value=None, exception=None):
+    if future.done():  # The awaiting task was cancelled.
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(value)
+
+
+async def projection_async(pool, query, params):
+    """Run a projection query and return the rows as lists of plain python values.
+    """
+    async with _pooled(pool) as conn:
+        qs = conn.getQueryService()
+        begin = getattr(qs, "begin_projection", None)
+        if begin is None:
+            return await asyncio.to_thread(omero_annotation._projection, conn, query, params)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        begin(
+            query, params,
+            _response=lambda rows: loop.call_soon_threadsafe(_resolve, future, rows),
+            _ex=lambda ex: loop.call_soon_threadsafe(_resolve, future, None, ex),
+            _ctx=conn.SERVICE_OPTS,
+        )
+        rows = await future
+    return [unwrap(row) for row in rows]
+
+
+async def _run(pool, func, *args, **kwargs):
+    async with _pooled(pool) as conn:
+        return await asyncio.to_thread(func, conn, *args, **kwargs)
+
+
+#
+# Read helpers.
+#
+
+
+async def get_collection_members_async(pool, collection_ids):
+    """Get the member image ids of one or several collections with one query.
+    Returns the list of ids for a single collection and a dict {collection_id: [ids]} otherwise.
+    """
+    single = isinstance(collection_ids, int)
+    coll_ids = [collection_ids] if single else list(collection_ids)
+    params = ParametersI()
+    params.add("cids", rlist([rlong(coll_id) for coll_id in coll_ids]))
+    rows = await projection_async(pool, _MEMBERS_OF_COLLECTIONS_QUERY, params)
+    members = omero_annotation._members_from_rows(coll_ids, rows)
+    return members[collection_ids] if single else members
+
+
+async def get_node_annotations_async(pool, image_ids):
+    """Get the node annotations of the images with one query.
+    Returns a dict {image_id: [(node ann id, kv dict)]}.
+    """
+    image_ids = list(image_ids)
+    if not image_ids:
+        return {}
+    params = ParametersI()
+    params.addIds(image_ids)
+    params.addString("ns", NS_NODE)
+    node_maps = omero_annotation._rows_to_maps(await projection_async(pool, _NODES_OF_IMAGES_QUERY, params))
+    return {image_id: list(node_maps.get(image_id, {}).items()) for image_id in image_ids}
+
+
+async def get_node_info_async(pool, image_id):
+    """Get the node annotation (first one) for an image, or None.
+    """
+    node_anns = (await get_node_annotations_async(pool, [image_id]))[image_id]
+    return node_anns[0][1] if node_anns else None
+
+
+async def get_collections_async(pool, image_id):
+    """Get all collections an image is part of, see `omero_annotation._get_collections`.
+    Needs three queries, whatever the number of collections and members.
+    """
+    params = ParametersI()
+    params.addLong("iid", image_id)
+    params.addString("ns", NS_COLLECTION)
+    coll_rows = await projection_async(pool, _COLLECTIONS_OF_IMAGE_QUERY, params)
+    coll_anns = list(omero_annotation._rows_to_maps([(image_id, *row) for row in coll_rows]).get(image_id, {}).items())
+    if not coll_anns:
+        return []
+
+    members_by_coll = await get_collection_members_async(pool, [coll_id for coll_id, _ in coll_anns])
+    member_ids = sorted({mid for mids in members_by_coll.values() for mid in mids})
+    nodes_by_image = await get_node_annotations_async(pool, member_ids)
+    return omero_annotation._assemble_collections(coll_anns, members_by_coll, nodes_by_image)
+
+
+async def find_related_images_async(pool, image_id, node_type=None):
+    """Find all images in the same collection(s), see `omero_annotation._find_related_images`.
+    """
+    return omero_annotation._related_members(await get_collections_async(pool, image_id), image_id, node_type)
+
+
+async def get_node_links_async(pool, image_id):
+    """Get the links of the node of an image, see `omero_annotation._get_node_links`.
+    """
+    return await _run(pool, omero_annotation._get_node_links, image_id)
+
+
+#
+# Write helpers.
+#
+
+
+async def create_collection_async(pool, name, version="0.x"):
+    return await _run(pool, omero_annotation._create_collection, name, version)
+
+
+async def link_collection_to_image_async(pool, collection_ann_id, image_id):
+    return await _run(pool, omero_annotation._link_collection_to_image, collection_ann_id, image_id)
+
+
+async def add_node_annotation_async(pool, image_id, node_type, collection_ann_id, node_name=None, attributes=None):
+    return await _run(
+        pool, omero_annotation._add_node_annotation, image_id, node_type, collection_ann_id, node_name, attributes
+    )
+
+
+async def bulk_add_node_annotations_async(pool, nodes, chunk_size=500, add_links=True):
+    return await _run(
+        pool, omero_annotation._bulk_add_node_annotations, list(nodes), chunk_size=chunk_size, add_links=add_links
+    )
+
+
+async def bulk_append_links_async(pool, links, chunk_size=500):
+    return await _run(pool, omero_annotation._bulk_append_links, list(links), chunk_size=chunk_size)
@@ -0,0 +1,230 @@
+"""Bulk deletion of images or their annotations, selected by dataset, collection or id list.
+
+The ids are deleted in chunks. Several delete requests are submitted without waiting and their
+callbacks are polled together, so the server works on the next chunks while earlier ones finish.
+Collection annotations that are no longer linked to any image can be deleted afterwards.
+"""
+import time
+
+from omero.rtypes import rlist, rlong
+from omero.sys import ParametersI
+
+from .cache import get_cache
+from .omero_annotation import NS_COLLECTION, _MEMBERS_OF_COLLECTIONS_QUERY, _projection
+
+
+_DATASET_IMAGES_QUERY = "select l.child.id from DatasetImageLink l where l.parent.id = :id order by l.child.id"
+_IMAGE_ANNOTATIONS_QUERY = (
+    "select distinct l.child.id from ImageAnnotationLink l "
+    "where l.parent.id in (:ids) and l.child.ns = :ns"
+)
+_LINKED_COLLECTIONS_QUERY = (
+    "select l.child.id from ImageAnnotationLink l where l.child.id in (:cids) group by l.child.id"
+)
+_EXISTING_ANNOTATIONS_QUERY = "select a.id from MapAnnotation a where a.id in (:cids)"
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _ids_params(name, ids):
+    params = ParametersI()
+    params.add(name, rlist([rlong(i) for i in ids]))
+    return params
+
+
+def _target_images(conn, image_ids=None, dataset_id=None, collection_id=None):
+    """Collect the image ids from an explicit list, a dataset and the members of a collection.
+    """
+    targets = dict.fromkeys(int(i) for i in image_ids or [])
+    if dataset_id is not None:
+        params = ParametersI()
+        params.addId(dataset_id)
+        targets.update(dict.fromkeys(row[0] for row in _projection(conn, _DATASET_IMAGES_QUERY, params)))
+    if collection_id is not None:
+        rows = _projection(conn, _MEMBERS_OF_COLLECTIONS_QUERY, _ids_params("cids", [collection_id]))
+        targets.update(dict.fromkeys(member_id for _, member_id in rows))
+    return list(targets)
+
+
+def _annotations_of_images(conn, image_ids, ns, chunk_size):
+    ann_ids = {}
+    for chunk in _chunks(image_ids, chunk_size):
+        params = _ids_params("ids", chunk)
+        params.addString("ns", ns)
+        ann_ids.update(dict.fromkeys(row[0] for row in _projection(conn, _IMAGE_ANNOTATIONS_QUERY, params)))
+    return list(ann_ids)
+
+
+def _orphaned_collections(conn, collection_ids):
+    """Return the collection annotations that still exist but are not linked to any image.
+    """
+    if not collection_ids:
+        return []
+    linked = {row[0] for row in _projection(conn, _LINKED_COLLECTIONS_QUERY, _ids_params("cids", collection_ids))}
+    existing = [row[0] for row in _projection(conn, _EXISTING_ANNOTATIONS_QUERY, _ids_params("cids", collection_ids))]
+    return [coll_id for coll_id in existing if coll_id not in linked]
+
+
+def _submit_and_poll(conn, obj_type, ids, chunk_size, max_pending, poll_interval, errors):
+    """Delete the ids in chunks with at most `max_pending` unfinished delete requests.
+    Returns the number of submitted chunks.
+    """
+    from omero.callbacks import CmdCallbackI
+    from omero.cmd import ERR
+
+    chunks = list(_chunks(ids, chunk_size))
+    pending = []
+    next_chunk = 0
+    while next_chunk < len(chunks) or pending:
+        while next_chunk < len(chunks) and len(pending) < max_pending:
+            chunk = chunks[next_chunk]
+            handle = conn.deleteObjects(obj_type, chunk, wait=False)
+            pending.append((CmdCallbackI(conn.c, handle), chunk))
+            next_chunk += 1
+
+        still_pending = []
+        for callback, chunk in pending:
+            response = callback.getResponse()
+            if response is None:
+                callback.poll()
+                response = callback.getResponse()
+            if response is None:
+                still_pending.append((callback, chunk))
+                continue
+            if isinstance(response, ERR):
+                errors.append({"type": obj_type, "ids": chunk, "error": f"{response.name}: {response.parameters}"})
+            callback.close(True)
+
+        if len(still_pending) == len(pending) and still_pending:
+            time.sleep(poll_interval)
+        pending = still_pending
+    return len(chunks)
+
+
+def bulk_delete(
+    conn,
+    image_ids=None,
+    dataset_id=None,
+    collection_id=None,
+    annotations_ns=None,
+    cascade_collections=False,
+    dry_run=False,
+    chunk_size=500,
+    max_pending=8,
+    poll_interval=0.2,
+):
+    """Delete images, or the annotations of images, in bulk.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image_ids: The ids of images to delete.
+        dataset_id: Delete all images of this dataset.
+        collection_id: Delete all members of this collection annotation.
+        annotations_ns: If given, only the annotations in this namespace are deleted from the
+            selected images and the images are kept.
+        cascade_collections: Delete the collection annotations of the selected images that are
+            no longer linked to any image afterwards. Off by default.
+        dry_run: Only report what would be deleted.
+        chunk_size: Number of objects per delete request.
+        max_pending: Maximal number of delete requests that run on the server at the same time.
+        poll_interval: Seconds between polling unfinished requests.
+
+    Returns:
+        Dict with the ids of the deleted images, annotations and collections, the number of
+        delete requests and the errors reported by the server.
+    """
+    t0 = time.perf_counter()
+    targets = _target_images(conn, image_ids, dataset_id, collection_id)
+    report = {"images": [], "annotations": [], "collections": [], "requests": 0, "errors": [], "dry_run": dry_run}
+
+    collections = _annotations_of_images(conn, targets, NS_COLLECTION, chunk_size) if cascade_collections else []
+    if collection_id is not None and cascade_collections and int(collection_id) not in collections:
+        collections.append(int(collection_id))
+
+    if annotations_ns is None:
+        report["images"] = targets
+    else:
+        report["annotations"] = _annotations_of_images(conn, targets, annotations_ns, chunk_size)
+
+    if dry_run:
+        # Collections would be orphaned if all their linked images are among the deleted ones.
+        if annotations_ns is None and collections:
+            rows = _projection(conn, _MEMBERS_OF_COLLECTIONS_QUERY, _ids_params("cids", collections))
+            deleted = set(targets)
+            remaining = {coll_id for coll_id, member_id in rows if member_id not in deleted}
+            report["collections"] = [coll_id for coll_id in collections if coll_id not in remaining]
+        report["seconds"] = time.perf_counter() - t0
+        return report
+
+    if report["images"]:
+        report["requests"] += _submit_and_poll(
+            conn, "Image", report["images"], chunk_size, max_pending, poll_interval, report["errors"]
+        )
+    if report["annotations"]:
+        report["requests"] += _submit_and_poll(
+            conn, "Annotation", report["annotations"], chunk_size, max_pending, poll_interval, report["errors"]
+        )
+
+    orphaned = [coll_id for coll_id in _orphaned_collections(conn, collections) if coll_id not in report["annotations"]]
+    if orphaned:
+        report["requests"] += _submit_and_poll(
+            conn, "Annotation", orphaned, chunk_size, max_pending, poll_interval, report["errors"]
+        )
+        report["collections"] = orphaned
+
+    cache = get_cache(conn)
+    if cache is not None:
+        cache.clear()
+    report["seconds"] = time.perf_counter() - t0
+    return report
+
+
+def main():
+    from .session import close_connection
+    from .util import connect_to_omero, omero_credential_parser
+
+    parser = omero_credential_parser()
+    parser.description = "Delete images or their annotations in bulk."
+    parser.add_argument("--image_ids", type=int, nargs="+", help="Ids of the images to delete.")
+    parser.add_argument("--dataset_id", type=int, help="Delete all images of this dataset.")
+    parser.add_argument("--collection_id", type=int, help="Delete all members of this collection.")
+    parser.add_argument(
+        "--annotations_only", action="store_true",
+        help="Only delete the annotations in --namespace of the selected images."
+    )
+    parser.add_argument(
+        "--cascade", action="store_true", help="Also delete the collections that have no linked images afterwards."
+    )
+    parser.add_argument("--dry_run", action="store_true")
+    parser.add_argument("--chunk_size", type=int, default=500)
+    args = parser.parse_args()
+
+    image_ids = (args.image_ids or []) + ([args.image_id] if args.image_id is not None else [])
+    if not image_ids and args.dataset_id is None and args.collection_id is None:
+        parser.error("Select the images with --image_id(s), --dataset_id or --collection_id.")
+
+    conn = connect_to_omero(args)
+    try:
+        report = bulk_delete(
+            conn, image_ids=image_ids, dataset_id=args.dataset_id, collection_id=args.collection_id,
+            annotations_ns=args.namespace if args.annotations_only else None,
+            cascade_collections=args.cascade, dry_run=args.dry_run, chunk_size=args.chunk_size,
+        )
+    finally:
+        close_connection(conn)
+
+    prefix = "Would delete" if args.dry_run else "Deleted"
+    print(
+        f"{prefix} {len(report['images'])} images, {len(report['annotations'])} annotations "
+        f"and {len(report['collections'])} collections with {report['requests']} requests "
+        f"in {report['seconds']:.1f} s."
+    )
+    for error in report["errors"]:
+        print(f"Failed to delete {error['type']} {error['ids'][0]}..{error['ids'][-1]}: {error['error']}")
+
+
+if __name__ == "__main__":
+    main()
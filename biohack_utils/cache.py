@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class MetadataCache:
+    """In-memory LRU cache with an optional time-to-live for OMERO metadata.
+
+    Any object providing `get`, `put`, `invalidate` and `clear` with the same signatures
+    can be attached to a connection instead (see `attach_cache`).
+
+    Args:
+        maxsize: Maximal number of entries. The least recently used entries are evicted first.
+        ttl: Time in seconds after which an entry expires. `None` means entries never expire.
+        clock: Monotonic clock used for the expiry, mostly useful for testing.
+    """
+    def __init__(self, maxsize=4096, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the hit / miss counters and the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+def attach_cache(conn, cache=None, **kwargs):
+    """Attach a metadata cache to the connection and return it.
+
+    All helpers in `biohack_utils.omero_annotation` read through this cache and keep it
+    up-to-date when they write. If no cache is given a `MetadataCache` is created from `kwargs`.
+    """
+    if cache is None:
+        cache = MetadataCache(**kwargs)
+    conn._biohack_cache = cache
+    return cache
+
+
+def detach_cache(conn):
+    """Remove the metadata cache from the connection and return it (or None).
+    """
+    return conn.__dict__.pop("_biohack_cache", None)
+
+
+def get_cache(conn):
+    """Return the metadata cache attached to the connection or None.
+    """
+    return getattr(conn, "_biohack_cache", None)
+
+
+def cached(conn, key, load):
+    """Return the cached value for key or load it with `load()` and cache it.
+    `None` is never cached, so that objects created later are found.
+    """
+    cache = get_cache(conn)
+    if cache is None:
+        return load()
+
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = load()
+        if value is not None:
+            cache.put(key, value)
+    return value
+
+
+def invalidate(conn, *keys):
+    """Drop the given keys from the cache attached to the connection, if any.
+    """
+    cache = get_cache(conn)
+    if cache is None:
+        return
+    for key in keys:
+        cache.invalidate(key)
@@ -0,0 +1,417 @@
+"""The `biohack` command line interface.
+
+    biohack annotate | delete | upload | import | export | query | features | instances | diff | pyramid | daemon ...
+
+Only the standard library is imported to parse the arguments; OMERO, Ice and numpy are imported
+by the subcommand that needs them. With `biohack daemon start` a resident process keeps the
+modules imported and the connections open. Commands started with `--via_daemon` (or with
+`BIOHACK_DAEMON=1` set) are sent to it over a user-only unix socket and return in milliseconds.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+
+
+_DAEMON_ENV = "BIOHACK_DAEMON"
+
+# Connections kept open by the daemon, by (username, password hash, host, port).
+_daemon_connections = None
+
+
+def _daemon_socket_path():
+    path = os.environ.get("BIOHACK_DAEMON_SOCKET")
+    if path:
+        return path
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "biohack_utils", "daemon.sock")
+
+
+#
+# Connections.
+#
+
+
+def _connect(args):
+    from .session import DEFAULT_HOST, DEFAULT_PORT
+    from .util import connect_to_omero
+
+    if not args.reuse_session and args.password is None:
+        raise SystemExit("A password (-p) is needed unless --reuse_session is given.")
+
+    if _daemon_connections is None:
+        # Keep stdout for the output of the command, e.g. the JSON of `query`.
+        with contextlib.redirect_stdout(sys.stderr):
+            return connect_to_omero(args)
+
+    # A request with another password must log in itself instead of getting the cached connection.
+    password = None if args.password is None else hashlib.sha256(args.password.encode()).hexdigest()
+    key = (args.username, password, DEFAULT_HOST, DEFAULT_PORT)
+    conn = _daemon_connections.get(key)
+    if conn is not None:
+        try:
+            conn.keepAlive()
+            return conn
+        except Exception:
+            _daemon_connections.pop(key, None)
+    with contextlib.redirect_stdout(sys.stderr):
+        conn = connect_to_omero(args)
+    _daemon_connections[key] = conn
+    return conn
+
+
+def _release(conn):
+    # The daemon keeps its connections open for the next command.
+    if _daemon_connections is None:
+        from .session import close_connection
+        close_connection(conn)
+
+
+@contextlib.contextmanager
+def _connection(args):
+    conn = _connect(args)
+    try:
+        yield conn
+    finally:
+        _release(conn)
+
+
+#
+# Subcommands.
+#
+
+
+def _annotate(args):
+    from . import omero_annotation
+
+    with _connection(args) as conn:
+        collection_id = args.collection_id or omero_annotation._create_collection(conn, args.name, args.version)
+        nodes = [
+            {"image_id": image_id, "collection_id": collection_id, "type": args.image_type, "name": args.image_name}
+            for image_id in args.image_ids
+        ] + [
+            {"image_id": label_id, "collection_id": collection_id, "type": "Labels", "name": args.label_name}
+            for label_id in args.label_ids or []
+        ]
+        node_ids = omero_annotation._bulk_add_node_annotations(conn, nodes)
+    print(f"Collection {collection_id}: added {len(node_ids)} nodes.")
+
+
+def _delete(args):
+    from .bulk_delete import bulk_delete
+
+    with _connection(args) as conn:
+        report = bulk_delete(
+            conn, image_ids=args.image_ids, dataset_id=args.dataset_id, collection_id=args.collection_id,
+            annotations_ns=args.namespace, cascade_collections=args.cascade, dry_run=args.dry_run,
+        )
+    prefix = "Would delete" if args.dry_run else "Deleted"
+    print(
+        f"{prefix} {len(report['images'])} images, {len(report['annotations'])} annotations "
+        f"and {len(report['collections'])} collections."
+    )
+    for error in report["errors"]:
+        print(f"Failed to delete {error['type']} {error['ids'][0]}..{error['ids'][-1]}: {error['error']}")
+    return 1 if report["errors"] else 0
+
+
+def _upload(args):
+    from .upload import upload_files
+
+    with _connection(args) as conn:
+        image_ids = upload_files(
+            conn, args.paths, names=args.names, dataset_id=args.dataset_id, max_workers=args.n_workers,
+            show_progress=not args.quiet,
+        )
+    for path, image_id in zip(args.paths, image_ids):
+        print(f"{path} -> Image {image_id}")
+
+
+def _import(args):
+    from .zarr_import import import_collection
+
+    with _connection(args) as conn:
+        collection_id, image_ids = import_collection(
+            conn, args.input, dataset_id=args.dataset_id, n_workers=args.n_workers, show_progress=not args.quiet
+        )
+    print(f"Collection {collection_id}: imported {len(image_ids)} nodes.")
+
+
+def _export(args):
+    from .zarr_export import export_collection
+
+    with _connection(args) as conn:
+        stats = export_collection(conn, args.collection_id, args.output, n_workers=args.n_workers)
+    print(json.dumps(stats, indent=2))
+
+
+def _query(args):
+    from . import omero_annotation
+
+    with _connection(args) as conn:
+        if args.collection_id is not None:
+            index = None
+            if args.index:
+                from .index import CollectionIndex
+                index = CollectionIndex.for_connection(conn)
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = [
+                    {"image_id": image_id, "name": name}
+                    for image_id, name, _ in omero_annotation._find_images_with_collection_id_in_dataset(
+                        conn, args.collection_id, args.dataset_id, node_type=args.node_type, index=index,
+                    )
+                ]
+        elif args.related:
+            result = omero_annotation._find_related_images(conn, args.image_id, node_type=args.node_type)
+        else:
+            result = omero_annotation._get_collections(conn, args.image_id)
+    print(json.dumps(result, indent=2))
+
+
+def _features(args):
+    from .features import compute_collection_features
+
+    with _connection(args) as conn:
+        results = compute_collection_features(
+            conn, args.collection_id, label_type=args.label_type, raw_type=args.raw_type, channel=args.channel,
+            n_workers=args.n_workers, save=not args.dry_run,
+        )
+    for image_id, result in results.items():
+        table = result.get("file_annotation_id")
+        print(f"Image {image_id}: {len(result['features']['label'])} instances" + (f", table {table}" if table else ""))
+
+
+def _instances(args):
+    from .matching import assign_stable_ids
+
+    with _connection(args) as conn:
+        table, file_ann_id = assign_stable_ids(
+            conn, args.image_id, parent_image_id=args.parent_id, collection_id=args.collection_id,
+            threshold=args.threshold,
+        )
+    n_matched = int((table["parent_label"] != 0).sum())
+    print(f"Image {args.image_id}: {len(table['label'])} instances, {n_matched} matched, table {file_ann_id}")
+
+
+def _diff(args):
+    from .label_diff import diff_images
+
+    with _connection(args) as conn:
+        diff = diff_images(conn, args.parent_id, args.image_id)
+    instances = diff.pop("instances")
+    diff["instances"] = [
+        {column: int(values[i]) for column, values in instances.items()}
+        for i in range(len(instances["label"]))
+        if instances["removed"][i] or instances["added"][i]
+    ] if args.per_instance else len(instances["label"])
+    print(json.dumps(diff, indent=2))
+
+
+def _pyramid(args):
+    from .label_pyramid import upload_label_pyramid
+
+    with _connection(args) as conn:
+        level_ids = upload_label_pyramid(
+            conn, args.image_id, args.collection_id, n_levels=args.n_levels, factor=args.factor, method=args.method,
+            dataset_id=args.dataset_id, n_workers=args.n_workers,
+        )
+    for level, image_id in level_ids.items():
+        print(f"Level {level}: Image {image_id}")
+
+
+def _scan(args):
+    from .consistency import apply_repair_plan, repair_plan, scan_collections
+
+    with _connection(args) as conn:
+        report = scan_collections(conn, max_workers=args.n_workers, range_size=args.range_size)
+        if args.repair:
+            report["repair"] = apply_repair_plan(conn, repair_plan(report))
+    print(json.dumps(report, indent=2))
+    return 1 if args.repair and report["repair"]["errors"] else 0
+
+
+def _daemon(args):
+    if args.action == "start":
+        from .daemon import serve
+        serve(_daemon_socket_path(), detach=not args.foreground)
+    elif args.action == "stop":
+        response = _send_to_daemon({"stop": True})
+        print("Daemon stopped." if response else "No daemon is running.")
+    else:
+        response = _send_to_daemon({"ping": True})
+        print(f"Daemon running (pid {response['pid']})." if response else "No daemon is running.")
+
+
+def _credential_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-u", "--username", type=str, required=True)
+    parser.add_argument("-p", "--password", type=str)
+    parser.add_argument(
+        "--reuse_session", action="store_true",
+        help="Join the cached OMERO session of this user instead of logging in again."
+    )
+    return parser
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="biohack", description="Manage OME-Zarr style collections in OMERO.")
+    parser.add_argument("--via_daemon", action="store_true", help="Run the command in the warm daemon.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    credentials = _credential_parser()
+
+    annotate = subparsers.add_parser("annotate", parents=[credentials], help="Group images into a collection.")
+    annotate.add_argument("--image_ids", type=int, nargs="+", required=True)
+    annotate.add_argument("--label_ids", type=int, nargs="+")
+    annotate.add_argument("--collection_id", type=int, help="Add to this collection instead of creating one.")
+    annotate.add_argument("--name", type=str, default="cells", help="Name of the new collection.")
+    annotate.add_argument("--version", type=str, default="0.0.1")
+    annotate.add_argument("--image_type", type=str, default="Intensities")
+    annotate.add_argument("--image_name", type=str, default="Raw")
+    annotate.add_argument("--label_name", type=str, default="Cell_Segmentation")
+    annotate.set_defaults(func=_annotate)
+
+    delete = subparsers.add_parser("delete", parents=[credentials], help="Delete images or annotations in bulk.")
+    delete.add_argument("--image_ids", type=int, nargs="+")
+    delete.add_argument("--dataset_id", type=int)
+    delete.add_argument("--collection_id", type=int)
+    delete.add_argument("--namespace", type=str, help="Only delete the annotations in this namespace.")
+    delete.add_argument(
+        "--cascade", action="store_true", help="Also delete the collections that have no linked images afterwards."
+    )
+    delete.add_argument("--dry_run", action="store_true")
+    delete.set_defaults(func=_delete)
+
+    upload = subparsers.add_parser("upload", parents=[credentials], help="Upload image files.")
+    upload.add_argument("paths", nargs="+")
+    upload.add_argument("--names", nargs="+")
+    upload.add_argument("--dataset_id", type=int)
+    upload.add_argument("--n_workers", type=int, default=4)
+    upload.add_argument("--quiet", action="store_true")
+    upload.set_defaults(func=_upload)
+
+    import_ = subparsers.add_parser("import", parents=[credentials], help="Import an OME-Zarr collection.")
+    import_.add_argument("-i", "--input", type=str, required=True)
+    import_.add_argument("--dataset_id", type=int)
+    import_.add_argument("--n_workers", type=int, default=4)
+    import_.add_argument("--quiet", action="store_true")
+    import_.set_defaults(func=_import)
+
+    export = subparsers.add_parser("export", parents=[credentials], help="Export a collection to OME-Zarr.")
+    export.add_argument("--collection_id", type=int, required=True)
+    export.add_argument("-o", "--output", type=str, required=True)
+    export.add_argument("--n_workers", type=int, default=8)
+    export.set_defaults(func=_export)
+
+    query = subparsers.add_parser("query", parents=[credentials], help="Print collections and members as JSON.")
+    query.add_argument("--image_id", type=int, help="Print the collections of this image.")
+    query.add_argument("--related", action="store_true", help="Print the related images of --image_id instead.")
+    query.add_argument("--collection_id", type=int, help="Print the members of this collection in --dataset_id.")
+    query.add_argument("--dataset_id", type=int)
+    query.add_argument("--node_type", type=str)
+    query.add_argument("--index", action="store_true", help="Answer from the local membership index.")
+    query.set_defaults(func=_query)
+
+    features = subparsers.add_parser(
+        "features", parents=[credentials], help="Compute per-instance feature tables of the label images."
+    )
+    features.add_argument("--collection_id", type=int, required=True)
+    features.add_argument("--label_type", type=str, default="Labels")
+    features.add_argument("--raw_type", type=str, default="Intensities")
+    features.add_argument("--channel", type=int, default=0)
+    features.add_argument("--n_workers", type=int, default=4)
+    features.add_argument("--dry_run", action="store_true", help="Only print the number of instances.")
+    features.set_defaults(func=_features)
+
+    instances = subparsers.add_parser(
+        "instances", parents=[credentials], help="Assign stable instance ids, matched against a parent version."
+    )
+    instances.add_argument("--image_id", type=int, required=True, help="The label image.")
+    instances.add_argument("--parent_id", type=int, help="The previous version of the label image.")
+    instances.add_argument("--collection_id", type=int)
+    instances.add_argument("--threshold", type=float, default=0.5, help="The minimal IoU of matched instances.")
+    instances.set_defaults(func=_instances)
+
+    diff = subparsers.add_parser("diff", parents=[credentials], help="Compare two versions of a label image.")
+    diff.add_argument("--parent_id", type=int, required=True, help="The previous version of the label image.")
+    diff.add_argument("--image_id", type=int, required=True, help="The new version of the label image.")
+    diff.add_argument("--per_instance", action="store_true", help="List the changes of every changed label.")
+    diff.set_defaults(func=_diff)
+
+    pyramid = subparsers.add_parser(
+        "pyramid", parents=[credentials], help="Add label-safe lower resolution levels of a label image."
+    )
+    pyramid.add_argument("--image_id", type=int, required=True, help="The full resolution label image.")
+    pyramid.add_argument("--collection_id", type=int, required=True)
+    pyramid.add_argument("--n_levels", type=int)
+    pyramid.add_argument("--factor", type=int, default=2)
+    pyramid.add_argument("--method", choices=["mode", "nearest"], default="mode")
+    pyramid.add_argument("--dataset_id", type=int)
+    pyramid.add_argument("--n_workers", type=int)
+    pyramid.set_defaults(func=_pyramid)
+
+    scan = subparsers.add_parser(
+        "scan", parents=[credentials], help="Find and repair inconsistent collection annotations on the server."
+    )
+    scan.add_argument("--repair", action="store_true", help="Add missing links and delete the debris.")
+    scan.add_argument("--n_workers", type=int, default=8)
+    scan.add_argument("--range_size", type=int, default=10_000, help="Number of ids checked per query range.")
+    scan.set_defaults(func=_scan)
+
+    daemon = subparsers.add_parser("daemon", help="Start, stop or check the warm daemon.")
+    daemon.add_argument("action", choices=["start", "stop", "status"])
+    daemon.add_argument("--foreground", action="store_true")
+    daemon.set_defaults(func=_daemon)
+    return parser
+
+
+def run(argv):
+    """Parse and run a command in this process. Returns the exit code.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "query" and args.image_id is None and args.collection_id is None:
+        parser.error("query needs --image_id or --collection_id.")
+    if args.command == "query" and args.collection_id is not None and args.dataset_id is None:
+        parser.error("query --collection_id needs --dataset_id.")
+    if args.command == "delete" and not args.image_ids and args.dataset_id is None and args.collection_id is None:
+        parser.error("Select the images with --image_ids, --dataset_id or --collection_id.")
+    return args.func(args) or 0
+
+
+def _send_to_daemon(request):
+    """Send a request to the daemon, returns its response or None if no daemon is running.
+    """
+    path = _daemon_socket_path()
+    if not os.path.exists(path):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    return json.loads(line) if line else None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    via_daemon = "--via_daemon" in argv or os.environ.get(_DAEMON_ENV) == "1"
+    if via_daemon and argv and argv[0] not in ("daemon", "-h", "--help"):
+        argv = [arg for arg in argv if arg != "--via_daemon"]
+        response = _send_to_daemon({"argv": argv, "cwd": os.getcwd()})
+        if response is not None:
+            sys.stdout.write(response["stdout"])
+            sys.stderr.write(response["stderr"])
+            sys.exit(response["exit_code"])
+        print("No daemon is running, running the command directly.", file=sys.stderr)
+    sys.exit(run(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Server-wide consistency scan of the collection annotations.
+
+An interrupted `write_annotations_to_image_and_labels` or bulk edit can leave debris behind:
+collection annotations that no image links to, node annotations that no image links to or whose
+`collection_id` points nowhere, images with several node annotations for the same collection and
+images that have a node of a collection but are not linked to the collection itself.
+
+`scan_collections` finds all of these with paged projection queries over id ranges, which a thread
+pool runs in parallel. Only the annotation ids of the collections and the debris are kept, so the
+memory does not grow with the number of node annotations. `repair_plan` turns the report into
+batches of links to add and annotations to delete, `apply_repair_plan` runs them.
+
+    report = scan_collections(conn)
+    apply_repair_plan(conn, repair_plan(report))
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from omero.model import ImageAnnotationLinkI, ImageI, MapAnnotationI
+from omero.sys import ParametersI
+
+from .bulk_delete import _chunks, _submit_and_poll
+from .cache import get_cache
+from .index import _paged
+from .omero_annotation import NS_COLLECTION, NS_NODE, _projection
+from .session import _worker_pool
+
+
+_ANNOTATION_ID_RANGE_QUERY = "select min(a.id), max(a.id) from MapAnnotation a where a.ns = :ns"
+_IMAGE_ID_RANGE_QUERY = "select min(l.parent.id), max(l.parent.id) from ImageAnnotationLink l where l.child.ns = :ns"
+_ANNOTATIONS_IN_RANGE_QUERY = (
+    "select a.id from MapAnnotation a where a.ns = :ns and a.id > :after and a.id <= :upto order by a.id"
+)
+_UNLINKED_IN_RANGE_QUERY = (
+    "select a.id from MapAnnotation a where a.ns = :ns and a.id > :after and a.id <= :upto "
+    "and not exists (select l.id from ImageAnnotationLink l where l.child.id = a.id) order by a.id"
+)
+# Every node has a type, so nodes without a collection_id still come back with their type row.
+_NODES_IN_RANGE_QUERY = (
+    "select l.parent.id, a.id, mv.name, mv.value "
+    "from MapAnnotation a join a.mapValue mv, ImageAnnotationLink l "
+    "where l.child.id = a.id and a.ns = :ns and mv.name in ('collection_id', 'type') "
+    "and l.parent.id > :after and l.parent.id <= :upto order by l.parent.id, a.id, mv.name"
+)
+_COLLECTION_LINKS_IN_RANGE_QUERY = (
+    "select l.parent.id, l.child.id from ImageAnnotationLink l "
+    "where l.child.ns = :ns and l.parent.id > :after and l.parent.id <= :upto order by l.id"
+)
+
+
+def _range_params(ns, after, upto):
+    params = ParametersI()
+    params.addString("ns", ns)
+    params.addLong("after", after)
+    params.addLong("upto", upto)
+    return params
+
+
+def _id_ranges(conn, query, ns, range_size):
+    """Split the ids between the smallest and largest id of the query into (after, upto] ranges.
+    """
+    params = ParametersI()
+    params.addString("ns", ns)
+    rows = _projection(conn, query, params)
+    if not rows or rows[0][0] is None:
+        return []
+    first, last = rows[0]
+    return [(after, min(after + range_size, last)) for after in range(first - 1, last, range_size)]
+
+
+def _unlinked_in_range(conn, id_range, ns, page_size):
+    return [ann_id for ann_id, in _paged(conn, _UNLINKED_IN_RANGE_QUERY, _range_params(ns, *id_range), page_size)]
+
+
+def _collections_in_range(conn, id_range, page_size):
+    """The ids of all collection annotations in an id range and of those without an image link.
+    """
+    rows = _paged(conn, _ANNOTATIONS_IN_RANGE_QUERY, _range_params(NS_COLLECTION, *id_range), page_size)
+    return np.array([ann_id for ann_id, in rows], dtype="int64"), _unlinked_in_range(
+        conn, id_range, NS_COLLECTION, page_size
+    )
+
+
+def _check_images_in_range(conn, id_range, collection_ids, page_size):
+    """Check the node annotations and collection links of the images in an id range.
+
+    `collection_ids` is the sorted array of all collection annotation ids.
+    """
+    nodes = {}
+    for image_id, node_id, key, value in _paged(
+        conn, _NODES_IN_RANGE_QUERY, _range_params(NS_NODE, *id_range), page_size
+    ):
+        nodes.setdefault((image_id, node_id), {})[key] = value
+    linked = {
+        tuple(row) for row in _paged(
+            conn, _COLLECTION_LINKS_IN_RANGE_QUERY, _range_params(NS_COLLECTION, *id_range), page_size
+        )
+    }
+
+    result = {"images": set(), "nodes": len(nodes), "dangling": [], "duplicates": [], "missing_links": []}
+    by_collection = {}
+    for (image_id, node_id), kv in nodes.items():
+        result["images"].add(image_id)
+        coll_id = kv.get("collection_id")
+        coll_id = int(coll_id) if coll_id is not None and coll_id.isdigit() else None
+        position = np.searchsorted(collection_ids, coll_id) if coll_id is not None else 0
+        if coll_id is None or position == len(collection_ids) or collection_ids[position] != coll_id:
+            result["dangling"].append(
+                {"node_id": node_id, "image_id": image_id, "collection_id": kv.get("collection_id")}
+            )
+            continue
+        by_collection.setdefault((image_id, coll_id), []).append(node_id)
+
+    for (image_id, coll_id), node_ids in by_collection.items():
+        if len(node_ids) > 1:
+            result["duplicates"].append(
+                {"image_id": image_id, "collection_id": coll_id, "node_ids": sorted(node_ids)}
+            )
+        if (image_id, coll_id) not in linked:
+            result["missing_links"].append({"image_id": image_id, "collection_id": coll_id})
+    result["images"] = len(result["images"])
+    return result
+
+
+def scan_collections(conn, max_workers=8, range_size=10_000, page_size=5_000, pool=None):
+    """Scan all collection and node annotations on the server for inconsistencies.
+
+    The annotation and image ids are split into ranges of `range_size` ids that are checked in
+    parallel, each with paged projection queries. First the ids of all collection annotations
+    and the annotations without any image link are collected, then the node annotations and
+    collection links are checked image range by image range.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        max_workers: Number of ranges that are queried at the same time.
+        range_size: Number of ids per range.
+        page_size: Maximal number of rows per projection query.
+        pool: A `biohack_utils.session.ConnectionPool` to give each range its own connection. By
+            default a pool joined to the session of `conn` is used and closed afterwards.
+
+    Returns:
+        Dict with the number of scanned 'collections', 'nodes' and 'images', and the debris:
+        'unlinked_collections' and 'unlinked_nodes' (annotation ids without any image link),
+        'dangling_nodes' (nodes whose collection_id is missing or no collection annotation),
+        'duplicate_nodes' (several nodes of an image for the same collection) and
+        'missing_collection_links' (images with a node of a collection they are not linked to).
+    """
+    t0 = time.perf_counter()
+
+    def _run(func, *args):
+        if pool is None:
+            return func(conn, *args)
+        with pool.connection() as pool_conn:
+            return func(pool_conn, *args)
+
+    def _map(func, ranges, *args):
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(lambda id_range: _run(func, id_range, *args), ranges))
+
+    collection_ranges = _id_ranges(conn, _ANNOTATION_ID_RANGE_QUERY, NS_COLLECTION, range_size)
+    node_ranges = _id_ranges(conn, _ANNOTATION_ID_RANGE_QUERY, NS_NODE, range_size)
+    image_ranges = _id_ranges(conn, _IMAGE_ID_RANGE_QUERY, NS_NODE, range_size)
+
+    n_ranges = max(len(collection_ranges), len(node_ranges), len(image_ranges))
+    with _worker_pool(conn, pool, min(max_workers, n_ranges)) as pool:
+        collections = _map(_collections_in_range, collection_ranges, page_size)
+        collection_ids = np.concatenate([ids for ids, _ in collections] or [np.zeros(0, dtype="int64")])
+        unlinked_collections = [unlinked for _, unlinked in collections]
+        unlinked_nodes = _map(_unlinked_in_range, node_ranges, NS_NODE, page_size)
+        checks = _map(_check_images_in_range, image_ranges, collection_ids, page_size)
+
+    report = {
+        "collections": len(collection_ids),
+        "nodes": sum(len(ids) for ids in unlinked_nodes) + sum(check["nodes"] for check in checks),
+        "images": sum(check["images"] for check in checks),
+        "unlinked_collections": [ann_id for ids in unlinked_collections for ann_id in ids],
+        "unlinked_nodes": [ann_id for ids in unlinked_nodes for ann_id in ids],
+        "dangling_nodes": [node for check in checks for node in check["dangling"]],
+        "duplicate_nodes": [duplicate for check in checks for duplicate in check["duplicates"]],
+        "missing_collection_links": [link for check in checks for link in check["missing_links"]],
+    }
+    report["seconds"] = time.perf_counter() - t0
+    return report
+
+
+def repair_plan(report, chunk_size=500):
+    """Turn a scan report into batches of repairs.
+
+    The missing collection links are added, so collections that are only referenced by nodes
+    of unlinked images are kept. Unlinked and dangling nodes, all but the first node of duplicates
+    and the remaining unlinked collections are deleted.
+
+    Returns:
+        Dict with the batches of (image_id, collection_id) 'links' to add and of annotation ids
+        to 'delete'.
+    """
+    links = list(dict.fromkeys(
+        (link["image_id"], link["collection_id"]) for link in report["missing_collection_links"]
+    ))
+    relinked = {coll_id for _, coll_id in links}
+    delete = dict.fromkeys(report["unlinked_nodes"])
+    delete.update(dict.fromkeys(node["node_id"] for node in report["dangling_nodes"]))
+    for duplicate in report["duplicate_nodes"]:
+        delete.update(dict.fromkeys(duplicate["node_ids"][1:]))
+    delete.update(dict.fromkeys(coll_id for coll_id in report["unlinked_collections"] if coll_id not in relinked))
+    return {"links": list(_chunks(links, chunk_size)), "delete": list(_chunks(list(delete), chunk_size))}
+
+
+def apply_repair_plan(conn, plan, max_pending=8, poll_interval=0.2):
+    """Add the links and delete the annotations of a repair plan.
+
+    Every batch of links is saved in one transaction, every batch of deletions is one delete
+    request of which up to `max_pending` run at the same time.
+
+    Returns:
+        Dict with the number of added 'links', 'deleted' annotations and the 'errors' reported
+        by the server.
+    """
+    result = {"links": 0, "deleted": 0, "errors": []}
+    update_service = conn.getUpdateService()
+    for batch in plan["links"]:
+        links = []
+        for image_id, coll_id in batch:
+            link = ImageAnnotationLinkI()
+            link.setParent(ImageI(image_id, False))
+            link.setChild(MapAnnotationI(coll_id, False))
+            links.append(link)
+        update_service.saveAndReturnArray(links, conn.SERVICE_OPTS)
+        result["links"] += len(links)
+
+    if plan["delete"]:
+        ids = [ann_id for batch in plan["delete"] for ann_id in batch]
+        chunk_size = len(plan["delete"][0])
+        _submit_and_poll(conn, "Annotation", ids, chunk_size, max_pending, poll_interval, result["errors"])
+    failed = {ann_id for error in result["errors"] for ann_id in error["ids"]}
+    result["deleted"] = sum(ann_id not in failed for batch in plan["delete"] for ann_id in batch)
+
+    cache = get_cache(conn)
+    if cache is not None:
+        cache.clear()
+    return result
@@ -0,0 +1,111 @@
+"""Resident process for `biohack` commands, see `biohack daemon start`.
+
+The daemon imports the OMERO modules once and keeps one connection per user open, joined to
+the cached session. Commands arrive as JSON lines on a unix socket that only the user can
+access, run one at a time in the daemon and send back their output and exit code.
+"""
+import contextlib
+import io
+import json
+import os
+import socketserver
+import sys
+import threading
+
+
+def _run_command(argv, cwd):
+    from . import cli
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    previous_cwd = os.getcwd()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            os.chdir(cwd)
+            exit_code = cli.run(argv)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+        except Exception as e:
+            exit_code = 1
+            print(f"{type(e).__name__}: {e}", file=sys.stderr)
+        finally:
+            os.chdir(previous_cwd)
+    return {"exit_code": exit_code, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        if request.get("ping"):
+            response = {"pid": os.getpid()}
+        elif request.get("stop"):
+            response = {"pid": os.getpid()}
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        else:
+            # Commands share the redirected stdout and the working directory, so they run one at a time.
+            with self.server.command_lock:
+                response = _run_command(request["argv"], request.get("cwd", os.getcwd()))
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, _Handler)
+        self.command_lock = threading.Lock()
+
+
+def _detach():
+    """Fork into the background and detach from the terminal.
+    """
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def serve(path, detach=True):
+    """Serve commands on the unix socket at `path` until `biohack daemon stop`.
+    """
+    from . import cli
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        if cli._send_to_daemon({"ping": True}) is not None:
+            print("The daemon is already running.")
+            return
+        os.remove(path)
+
+    # Import the heavy modules once, up front.
+    import numpy  # noqa: F401
+    import omero.gateway  # noqa: F401
+    from . import bulk_delete, omero_annotation, upload  # noqa: F401
+
+    print(f"Starting the daemon on {path}")
+    if detach:
+        _detach()
+
+    cli._daemon_connections = {}
+    old_umask = os.umask(0o177)
+    try:
+        server = _Server(path)
+    finally:
+        os.umask(old_umask)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        from .session import close_connection
+        for conn in cli._daemon_connections.values():
+            close_connection(conn)
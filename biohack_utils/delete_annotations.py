@@ -1,3 +1,4 @@
+from .session import close_connection
 from .util import connect_to_omero, omero_credential_parser
 
 
@@ -27,4 +28,4 @@ def main():
     except AttributeError:
         print("Well, seems like there were no matching collection metadata.")
 
-    conn.close()
+    close_connection(conn)
@@ -1,3 +1,4 @@
+from .session import close_connection
 from .util import connect_to_omero, omero_credential_parser
 
 
@@ -27,7 +28,7 @@ def delete_annotations():
     except AttributeError:
         print("Well, seems like there were no matching collection metadata.")
 
-    conn.close()
+    close_connection(conn)
 
 
 def _delete_ims(conn, image_id: int):
@@ -47,4 +48,4 @@ def delete_images():
     _delete_ims(conn, args.image_id)
     # print("Well, seems like there were no matching image for the given ids.")
 
-    conn.close()
+    close_connection(conn)
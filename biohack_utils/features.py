@@ -0,0 +1,380 @@
+"""Per-instance features of label images, stored as OMERO tables next to the collection.
+
+The label image is streamed block by block (by default one z-plane of a few server tiles at a
+time). Every block is reduced to one row per instance with `bincount`-style reductions, and the
+partial rows are merged once they outgrow the merged table. Memory is therefore bounded by the
+block size plus a few rows per instance, independent of the image size.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .relabel import _block_slices
+from .session import _worker_pool
+
+
+NS_FEATURES = "ome/collection/features"
+
+_AXIS_NAMES = "tzyx"
+
+
+def _axis_names(ndim):
+    return _AXIS_NAMES[-ndim:] if ndim <= len(_AXIS_NAMES) else [f"axis{i}" for i in range(ndim)]
+
+
+def _compact_ids(labels):
+    """Map the label values to consecutive ids. Returns the unique labels and the ids of all values.
+    """
+    max_label = int(labels.max())
+    if max_label <= 4 * labels.size + 1024:
+        # Dense lookup table, much faster than sorting when the labels are not too sparse.
+        present = np.bincount(labels, minlength=max_label + 1) > 0
+        lut = np.cumsum(present) - 1
+        return np.flatnonzero(present), lut[labels]
+    return np.unique(labels, return_inverse=True)
+
+
+def _block_features(labels, intensities, offset):
+    """Reduce a block to the partial features of the instances in it.
+    """
+    labels = np.asarray(labels)
+    flat = labels.reshape(-1)
+    foreground = np.flatnonzero(flat)
+    if foreground.size == 0:
+        return None
+    ids, inverse = _compact_ids(flat[foreground].astype("uint64", copy=False))
+    n = len(ids)
+
+    area = np.bincount(inverse, minlength=n).astype("int64")
+    coords = np.unravel_index(foreground, labels.shape)
+    bbox_min = np.empty((labels.ndim, n), dtype="int64")
+    bbox_max = np.empty((labels.ndim, n), dtype="int64")
+    coord_sums = np.empty((labels.ndim, n), dtype="float64")
+    for axis, (coord, start) in enumerate(zip(coords, offset)):
+        bbox_min[axis] = np.iinfo("int64").max
+        bbox_max[axis] = -1
+        np.minimum.at(bbox_min[axis], inverse, coord)
+        np.maximum.at(bbox_max[axis], inverse, coord)
+        bbox_min[axis] += start
+        bbox_max[axis] += start
+        coord_sums[axis] = np.bincount(inverse, weights=coord, minlength=n) + area * start
+
+    partial = {
+        "label": ids.astype("int64"),
+        "area": area,
+        "bbox_min": bbox_min,
+        "bbox_max": bbox_max,
+        "coord_sums": coord_sums,
+    }
+    if intensities is not None:
+        values = np.asarray(intensities).reshape(-1)[foreground]
+        partial["intensity_sum"] = np.bincount(inverse, weights=values, minlength=n)
+    return partial
+
+
+def _merge(partials):
+    """Merge partial features, the same label may appear in several of them.
+    """
+    if len(partials) == 1:
+        return partials[0]
+    all_labels = np.concatenate([p["label"] for p in partials])
+    labels, inverse = np.unique(all_labels, return_inverse=True)
+    n = len(labels)
+
+    areas = np.concatenate([p["area"] for p in partials])
+    merged = {"label": labels, "area": np.bincount(inverse, weights=areas, minlength=n).astype("int64")}
+    bbox_min = np.concatenate([p["bbox_min"] for p in partials], axis=1)
+    bbox_max = np.concatenate([p["bbox_max"] for p in partials], axis=1)
+    coord_sums = np.concatenate([p["coord_sums"] for p in partials], axis=1)
+    merged["bbox_min"] = np.full((len(bbox_min), n), np.iinfo("int64").max, dtype="int64")
+    merged["bbox_max"] = np.full((len(bbox_max), n), -1, dtype="int64")
+    merged["coord_sums"] = np.empty((len(coord_sums), n), dtype="float64")
+    for axis in range(len(bbox_min)):
+        np.minimum.at(merged["bbox_min"][axis], inverse, bbox_min[axis])
+        np.maximum.at(merged["bbox_max"][axis], inverse, bbox_max[axis])
+        merged["coord_sums"][axis] = np.bincount(inverse, weights=coord_sums[axis], minlength=n)
+    if "intensity_sum" in partials[0]:
+        merged["intensity_sum"] = np.bincount(
+            inverse, weights=np.concatenate([p["intensity_sum"] for p in partials]), minlength=n
+        )
+    return merged
+
+
+def _default_block_shape(shape, chunks=None):
+    """One plane of up to 2048 x 2048 pixels, aligned to the chunks of the source if it has any.
+    """
+    block_shape = [1] * (len(shape) - 2) + [min(s, 2048) for s in shape[-2:]]
+    if chunks is not None:
+        chunk_y, chunk_x = chunks[-2:]
+        block_shape[-2] = max(chunk_y, block_shape[-2] // chunk_y * chunk_y)
+        block_shape[-1] = max(chunk_x, block_shape[-1] // chunk_x * chunk_x)
+    return tuple(block_shape)
+
+
+def instance_features(labels, intensities=None, block_shape=None, axis_names=None):
+    """Compute the area, bounding box, centroid and mean intensity of every label instance.
+
+    Args:
+        labels: Array-like label image with `shape`, `dtype` and numpy-style slicing,
+            e.g. a numpy array or a `biohack_utils.pixels.PixelsSource`.
+        intensities: Array-like intensity image of the same shape, for the mean intensity.
+        block_shape: The shape of the blocks that are read at once, by default one plane
+            of up to 2048 x 2048 pixels.
+        axis_names: Names of the axes used for the column names, by default the last
+            axes of 'tzyx'.
+
+    Returns:
+        Dict of column name -> numpy array, with one row per instance ordered by label:
+        'label', 'area', 'bbox_min_<axis>', 'bbox_max_<axis>' (inclusive), 'centroid_<axis>'
+        and 'mean_intensity' if `intensities` are given.
+    """
+    shape = tuple(labels.shape)
+    if intensities is not None and tuple(intensities.shape) != shape:
+        raise ValueError(f"The intensities have shape {intensities.shape}, the labels {shape}")
+    axis_names = axis_names or _axis_names(len(shape))
+    block_shape = block_shape or _default_block_shape(shape, getattr(labels, "chunks", None))
+
+    merged, partials, n_pending = None, [], 0
+    for block_slice in _block_slices(shape, block_shape):
+        partial = _block_features(
+            labels[block_slice], None if intensities is None else intensities[block_slice],
+            [sl.start for sl in block_slice],
+        )
+        if partial is None:
+            continue
+        partials.append(partial)
+        n_pending += len(partial["label"])
+        # Merge once the partial rows outgrow the merged table, so each row is merged O(log n) times.
+        if n_pending > max(100_000, 0 if merged is None else len(merged["label"])):
+            merged = _merge(partials if merged is None else [merged] + partials)
+            partials, n_pending = [], 0
+    if partials:
+        merged = _merge(partials if merged is None else [merged] + partials)
+
+    if merged is None:
+        ndim = len(shape)
+        merged = {
+            "label": np.zeros(0, dtype="int64"), "area": np.zeros(0, dtype="int64"),
+            "bbox_min": np.zeros((ndim, 0), dtype="int64"), "bbox_max": np.zeros((ndim, 0), dtype="int64"),
+            "coord_sums": np.zeros((ndim, 0)), "intensity_sum": np.zeros(0),
+        }
+
+    columns = {"label": merged["label"], "area": merged["area"]}
+    for axis, name in enumerate(axis_names):
+        columns[f"bbox_min_{name}"] = merged["bbox_min"][axis]
+        columns[f"bbox_max_{name}"] = merged["bbox_max"][axis]
+    for axis, name in enumerate(axis_names):
+        columns[f"centroid_{name}"] = merged["coord_sums"][axis] / merged["area"]
+    if intensities is not None:
+        columns["mean_intensity"] = merged["intensity_sum"] / merged["area"]
+    return columns
+
+
+class _PlaneStack:
+    """The (z, y, x) stack of one channel and timepoint of a `PixelsSource`.
+    """
+    def __init__(self, source, c=0, t=0):
+        self._source = source
+        self._c, self._t = c, t
+        self.shape = source.shape[2:]
+        self.dtype = source.dtype
+        self.chunks = source.chunks[2:]
+
+    def __getitem__(self, key):
+        return self._source[(self._t, self._c) + tuple(key)]
+
+    def close(self):
+        self._source.close()
+
+
+def _open_stack(conn, image_id, c=0, t=0, prefetch_workers=2):
+    from .pixels import PixelsSource
+
+    image = conn.getObject("Image", image_id)
+    if image is None:
+        raise ValueError(f"Image {image_id} not found")
+    if not 0 <= c < image.getSizeC() or not 0 <= t < image.getSizeT():
+        raise ValueError(f"Image {image_id} has no channel {c} at timepoint {t}")
+    return _PlaneStack(PixelsSource(conn, image, prefetch_workers=prefetch_workers), c, t)
+
+
+def compute_image_features(conn, label_image_id, raw_image_id=None, channel=0, t=0, block_shape=None):
+    """Compute the instance features of a label image in OMERO, see `instance_features`.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        label_image_id: The id of the label image.
+        raw_image_id: The id of the intensity image for the mean intensity.
+        channel: The channel of the intensity image.
+        t: The timepoint of both images.
+        block_shape: The (z, y, x) shape of the blocks that are read at once.
+
+    Returns:
+        Dict of column name -> numpy array with one row per instance.
+    """
+    labels = _open_stack(conn, label_image_id, t=t)
+    intensities = None if raw_image_id is None else _open_stack(conn, raw_image_id, c=channel, t=t)
+    try:
+        return instance_features(labels, intensities, block_shape=block_shape, axis_names="zyx")
+    finally:
+        labels.close()
+        if intensities is not None:
+            intensities.close()
+
+
+def _table_columns(features):
+    from omero.grid import DoubleColumn, LongColumn
+
+    return [
+        (LongColumn if values.dtype.kind in "iu" else DoubleColumn)(name, "", [])
+        for name, values in features.items()
+    ]
+
+
+def save_features_table(
+    conn, features, name, image_id, node_ann_id=None, description="", ns=NS_FEATURES, chunk_size=10_000,
+):
+    """Write the features as an OMERO table and link it to the image and its node annotation.
+
+    The rows are sent in chunks, so large tables are not serialized in one message.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        features: Dict of column name -> numpy array, see `instance_features`.
+        name: The name of the table file.
+        image_id: The id of the image the table is attached to.
+        node_ann_id: The id of the image's node annotation, the table is linked to it as well.
+        description: The description of the file annotation.
+        ns: The namespace of the file annotation.
+        chunk_size: Number of rows per call.
+
+    Returns:
+        The id of the file annotation.
+    """
+    from omero.model import (
+        AnnotationAnnotationLinkI, FileAnnotationI, ImageAnnotationLinkI, ImageI, MapAnnotationI, OriginalFileI,
+    )
+    from omero.rtypes import rstring
+
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, name, conn.SERVICE_OPTS)
+    if table is None:
+        raise RuntimeError("The OMERO server does not provide OMERO.tables")
+    try:
+        columns = _table_columns(features)
+        table.initialize(columns)
+        n_rows = len(next(iter(features.values()))) if features else 0
+        for start in range(0, n_rows, chunk_size):
+            for column, values in zip(columns, features.values()):
+                column.values = values[start:start + chunk_size].tolist()
+            table.addData(columns)
+        file_id = table.getOriginalFile().getId().getValue()
+    finally:
+        table.close()
+
+    file_ann = FileAnnotationI()
+    file_ann.setFile(OriginalFileI(file_id, False))
+    file_ann.setNs(rstring(ns))
+    file_ann.setDescription(rstring(description))
+
+    image_link = ImageAnnotationLinkI()
+    image_link.setParent(ImageI(image_id, False))
+    image_link.setChild(file_ann)
+    links = [image_link]
+    update_service = conn.getUpdateService()
+    saved = update_service.saveAndReturnArray(links, conn.SERVICE_OPTS)
+    file_ann_id = saved[0].getChild().getId().getValue()
+
+    if node_ann_id is not None:
+        node_link = AnnotationAnnotationLinkI()
+        node_link.setParent(MapAnnotationI(node_ann_id, False))
+        node_link.setChild(FileAnnotationI(file_ann_id, False))
+        update_service.saveAndReturnArray([node_link], conn.SERVICE_OPTS)
+    return file_ann_id
+
+
+def _node_ann_id(node_anns, collection_id):
+    for ann_id, kv in node_anns:
+        if kv.get("collection_id") == str(collection_id):
+            return ann_id
+    return None
+
+
+def compute_collection_features(
+    conn, collection_id, label_type="Labels", raw_type="Intensities", channel=0, n_workers=4, save=True, pool=None,
+):
+    """Compute and store the instance features of all label images in a collection.
+
+    The label images are processed in parallel, each with its own connection of the pool. Their
+    intensity values are read from the member of type `raw_type`, if the collection has exactly one.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        collection_id: The id of the collection annotation.
+        label_type: The node type of the label images.
+        raw_type: The node type of the intensity image.
+        channel: The channel of the intensity image.
+        n_workers: Number of label images processed at the same time.
+        save: Whether to write the features as OMERO tables linked to the label nodes.
+        pool: A `biohack_utils.session.ConnectionPool` to borrow the connections from. By default
+            a pool joined to the session of `conn` is used and closed afterwards.
+
+    Returns:
+        Dict {label image id: {'features': features}}, with the id of the table's file
+        annotation under 'file_annotation_id' if `save` is set.
+    """
+    from . import omero_annotation
+
+    members_by_coll, nodes_by_image = omero_annotation._resolve_members(conn, [collection_id])
+    members = [
+        (image_id, _node_ann_id(nodes_by_image[image_id], collection_id),
+         omero_annotation._node_for_collection(nodes_by_image[image_id], collection_id) or {})
+        for image_id in members_by_coll[collection_id]
+    ]
+    raw_ids = [image_id for image_id, _, kv in members if kv.get("type") == raw_type]
+    raw_id = raw_ids[0] if len(raw_ids) == 1 else None
+    labels = [(image_id, ann_id, kv) for image_id, ann_id, kv in members if kv.get("type") == label_type]
+
+    results = {}
+    lock = threading.Lock()
+
+    def _compute(worker_conn, image_id, node_ann_id, kv):
+        features = compute_image_features(worker_conn, image_id, raw_id, channel=channel)
+        result = {"features": features}
+        if save:
+            result["file_annotation_id"] = save_features_table(
+                worker_conn, features, f"{kv.get('name', image_id)}_features.h5", image_id, node_ann_id,
+                description=f"collection_id={collection_id}, raw_image_id={raw_id}",
+            )
+        with lock:
+            results[image_id] = result
+
+    n_workers = max(1, min(n_workers, len(labels)))
+    with _worker_pool(conn, pool, n_workers) as pool:
+        def _process(member):
+            if pool is None:
+                return _compute(conn, *member)
+            with pool.connection() as pool_conn:
+                return _compute(pool_conn, *member)
+
+        with ThreadPoolExecutor(n_workers) as executor:
+            for future in [executor.submit(_process, member) for member in labels]:
+                future.result()
+    return results
+
+
+def load_features_table(conn, file_ann_id):
+    """Read a features table written by `save_features_table` back into a dict of numpy arrays.
+    """
+    file_ann = conn.getObject("FileAnnotation", file_ann_id)
+    if file_ann is None:
+        raise ValueError(f"FileAnnotation {file_ann_id} not found")
+    table = conn.c.sf.sharedResources().openTable(file_ann.getFile()._obj, conn.SERVICE_OPTS)
+    try:
+        headers = table.getHeaders()
+        columns = table.read(list(range(len(headers))), 0, table.getNumberOfRows()).columns
+        return {column.name: np.asarray(column.values) for column in columns}
+    finally:
+        table.close()
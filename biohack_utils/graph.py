@@ -0,0 +1,210 @@
+"""Compact, array-backed representation of the collection graph.
+
+Collections and images are stored as sorted id arrays, the memberships as CSR adjacency in both
+directions (collection -> images and image -> collections). The node type and name of each
+membership are integer codes into interned vocabularies, so a graph with millions of members
+needs a few tens of bytes per membership and can be memory-mapped from disk.
+"""
+import json
+import os
+
+import numpy as np
+
+
+_ARRAYS = (
+    "collection_ids", "image_ids", "coll_indptr", "coll_indices", "type_codes", "name_codes",
+    "image_indptr", "image_indices",
+)
+
+
+def _intern(values):
+    """Map the values to integer codes, code 0 is reserved for missing values (None).
+    """
+    vocab = [None]
+    codes = {None: 0}
+    out = np.empty(len(values), dtype="int32")
+    for i, value in enumerate(values):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(vocab)
+            vocab.append(value)
+        out[i] = code
+    return out, vocab
+
+
+def _gather(indptr, rows):
+    """Concatenate the CSR rows `rows`. Returns the positions of the entries and their row numbers.
+    """
+    starts, stops = indptr[rows], indptr[rows + 1]
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+    row_numbers = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[row_numbers] + offsets, row_numbers
+
+
+class CollectionGraph:
+    """Memberships of images in collections, with the node type and name of every membership.
+
+    Build it with `from_edges`, `from_index` or `from_server`, store it with `save` and
+    memory-map it again with `load`.
+    """
+    def __init__(self, arrays, types, names):
+        for name in _ARRAYS:
+            setattr(self, name, arrays[name])
+        self.types = types
+        self.names = names
+        self._type_codes = {value: code for code, value in enumerate(types)}
+
+    @classmethod
+    def from_edges(cls, collection_ids, image_ids, node_types=None, node_names=None):
+        """Build the graph from one entry per membership.
+
+        Args:
+            collection_ids: The collection annotation id of each membership.
+            image_ids: The image id of each membership.
+            node_types: The node type of each membership, None if the image has no node.
+            node_names: The node name of each membership.
+        """
+        edge_colls = np.asarray(collection_ids, dtype="int64")
+        edge_images = np.asarray(image_ids, dtype="int64")
+        n_edges = len(edge_colls)
+        type_codes, types = _intern(node_types if node_types is not None else [None] * n_edges)
+        name_codes, names = _intern(node_names if node_names is not None else [None] * n_edges)
+
+        coll_ids, coll_rows = np.unique(edge_colls, return_inverse=True)
+        img_ids, img_cols = np.unique(edge_images, return_inverse=True)
+
+        # Keep the first entry of duplicated memberships, in the order given.
+        order = np.lexsort((np.arange(n_edges), img_cols, coll_rows))
+        keep = np.ones(n_edges, dtype=bool)
+        keep[1:] = (np.diff(coll_rows[order]) != 0) | (np.diff(img_cols[order]) != 0)
+        order = order[keep]
+        coll_rows, img_cols = coll_rows[order], img_cols[order]
+
+        coll_indptr = np.zeros(len(coll_ids) + 1, dtype="int64")
+        np.cumsum(np.bincount(coll_rows, minlength=len(coll_ids)), out=coll_indptr[1:])
+
+        # The transposed adjacency stores the positions of the entries in the collection rows.
+        by_image = np.argsort(img_cols, kind="stable")
+        image_indptr = np.zeros(len(img_ids) + 1, dtype="int64")
+        np.cumsum(np.bincount(img_cols, minlength=len(img_ids)), out=image_indptr[1:])
+
+        arrays = {
+            "collection_ids": coll_ids,
+            "image_ids": img_ids,
+            "coll_indptr": coll_indptr,
+            "coll_indices": img_cols.astype("int32" if len(img_ids) < 2**31 else "int64"),
+            "type_codes": type_codes[order].astype("int16" if len(types) < 2**15 else "int32"),
+            "name_codes": name_codes[order],
+            "image_indptr": image_indptr,
+            "image_indices": by_image.astype("int64"),
+        }
+        return cls(arrays, types, names)
+
+    @classmethod
+    def from_index(cls, index):
+        """Build the graph from a `biohack_utils.index.CollectionIndex`.
+        """
+        from .omero_annotation import NS_COLLECTION
+
+        rows = index._db.execute(
+            "select l.ann_id, l.image_id, n.node_type, n.name from image_links l "
+            "join annotations c on c.id = l.ann_id and c.ns = ? "
+            "left join image_links nl on nl.image_id = l.image_id "
+            "and nl.ann_id in (select id from annotations where collection_id = l.ann_id) "
+            "left join annotations n on n.id = nl.ann_id order by l.id",
+            (NS_COLLECTION,),
+        ).fetchall()
+        if not rows:
+            return cls.from_edges([], [])
+        coll_ids, image_ids, types, names = zip(*rows)
+        return cls.from_edges(coll_ids, image_ids, list(types), list(names))
+
+    @classmethod
+    def from_server(cls, conn, collection_ids):
+        """Build the graph of the given collections with two projection queries.
+        """
+        from .omero_annotation import _node_for_collection, _resolve_members
+
+        members_by_coll, nodes_by_image = _resolve_members(conn, list(collection_ids))
+        edges = []
+        for coll_id, member_ids in members_by_coll.items():
+            for member_id in member_ids:
+                node = _node_for_collection(nodes_by_image[member_id], coll_id) or {}
+                edges.append((coll_id, member_id, node.get("type"), node.get("name")))
+        if not edges:
+            return cls.from_edges([], [])
+        coll_ids, image_ids, types, names = zip(*edges)
+        return cls.from_edges(coll_ids, image_ids, list(types), list(names))
+
+    @property
+    def n_memberships(self):
+        return len(self.coll_indices)
+
+    def _rows(self, ids, known):
+        ids = np.atleast_1d(np.asarray(ids, dtype="int64"))
+        rows = np.searchsorted(known, ids)
+        rows = np.minimum(rows, max(len(known) - 1, 0))
+        found = known[rows] == ids if len(known) else np.zeros(len(ids), dtype=bool)
+        return rows[found]
+
+    def _type_mask(self, positions, node_type):
+        if node_type is None:
+            return np.ones(len(positions), dtype=bool)
+        code = self._type_codes.get(node_type)
+        if code is None:
+            return np.zeros(len(positions), dtype=bool)
+        return self.type_codes[positions] == code
+
+    def members(self, collection_ids, node_type=None):
+        """Return the ids of the images in the collection(s), optionally only nodes of this type.
+        """
+        positions, _ = _gather(self.coll_indptr, self._rows(collection_ids, self.collection_ids))
+        positions = positions[self._type_mask(positions, node_type)]
+        return self.image_ids[self.coll_indices[positions]]
+
+    def collections_of(self, image_ids):
+        """Return the ids of the collections the image(s) are members of.
+        """
+        positions, _ = _gather(self.image_indptr, self._rows(image_ids, self.image_ids))
+        edge_positions = self.image_indices[positions]
+        coll_rows = np.searchsorted(self.coll_indptr, edge_positions, side="right") - 1
+        return np.unique(self.collection_ids[coll_rows])
+
+    def related_images(self, image_id, node_type=None):
+        """Return the other members of all collections of the image.
+
+        Returns:
+            Arrays with the image id, collection id and the type and name codes of each
+            membership, see `types` and `names` for the vocabularies.
+        """
+        coll_rows = self._rows(self.collections_of(image_id), self.collection_ids)
+        positions, row_numbers = _gather(self.coll_indptr, coll_rows)
+        image_ids = self.image_ids[self.coll_indices[positions]]
+        mask = (image_ids != image_id) & self._type_mask(positions, node_type)
+        positions = positions[mask]
+        return (
+            image_ids[mask], self.collection_ids[coll_rows[row_numbers[mask]]],
+            self.type_codes[positions], self.name_codes[positions],
+        )
+
+    def save(self, path):
+        """Write the graph to a directory of `.npy` files that `load` can memory-map.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump({"types": self.types, "names": self.names}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load a graph written by `save`, memory-mapped by default.
+        """
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in _ARRAYS}
+        with open(os.path.join(path, "vocab.json")) as f:
+            vocab = json.load(f)
+        return cls(arrays, vocab["types"], vocab["names"])
@@ -0,0 +1,271 @@
+"""Local SQLite index of the collection memberships on an OMERO server.
+
+The index stores the collection annotations, the node annotations, their links to images and
+the datasets of the member images. `CollectionIndex.sync` only queries the annotations and links
+whose update event is newer than the last sync, plus the deletions logged since then, so that
+membership and node type lookups are answered locally without scanning datasets.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from omero.rtypes import rlist, rstring
+from omero.sys import ParametersI
+
+from .omero_annotation import NS_COLLECTION, NS_NODE, _projection, _rows_to_maps
+
+
+_SCHEMA = """
+create table if not exists meta (key text primary key, value text);
+create table if not exists annotations (
+    id integer primary key, ns text, name text, version text, collection_id integer, node_type text
+);
+create table if not exists image_links (id integer primary key, image_id integer, ann_id integer);
+create table if not exists dataset_links (id integer primary key, dataset_id integer, image_id integer);
+create table if not exists images (id integer primary key, name text);
+create index if not exists image_links_ann on image_links (ann_id);
+create index if not exists image_links_image on image_links (image_id);
+create index if not exists dataset_links_image on dataset_links (image_id);
+create index if not exists annotations_collection on annotations (collection_id, node_type);
+"""
+
+_LAST_EVENT_QUERY = "select max(e.id) from Event e"
+_CHANGED_ANNOTATIONS_QUERY = (
+    "select a.id from MapAnnotation a "
+    "where a.ns in (:nss) and a.details.updateEvent.id > :since order by a.id"
+)
+_ANNOTATION_VALUES_QUERY = (
+    "select a.id, a.ns, mv.name, mv.value from MapAnnotation a join a.mapValue mv "
+    "where a.id in (:ids)"
+)
+_CHANGED_IMAGE_LINKS_QUERY = (
+    "select l.id, l.parent.id, l.child.id from ImageAnnotationLink l "
+    "where l.child.ns in (:nss) and l.details.updateEvent.id > :since order by l.id"
+)
+_MEMBERS = "(select m.parent.id from ImageAnnotationLink m where m.child.ns in (:nss))"
+_NEW_MEMBERS = (
+    "(select m.parent.id from ImageAnnotationLink m "
+    "where m.child.ns in (:nss) and m.details.updateEvent.id > :since)"
+)
+# Images that became members since the last sync bring their older dataset links and names with them.
+_CHANGED_DATASET_LINKS_QUERY = (
+    "select l.id, l.parent.id, l.child.id from DatasetImageLink l "
+    "where (l.details.updateEvent.id > :since and l.child.id in " + _MEMBERS + ") "
+    "or l.child.id in " + _NEW_MEMBERS + " order by l.id"
+)
+_CHANGED_IMAGES_QUERY = (
+    "select i.id, i.name from Image i "
+    "where (i.details.updateEvent.id > :since and i.id in " + _MEMBERS + ") "
+    "or i.id in " + _NEW_MEMBERS + " order by i.id"
+)
+_DELETIONS_QUERY = (
+    "select el.entityType, el.entityId from EventLog el "
+    "where el.action = 'DELETE' and el.event.id > :since and el.entityType in (:types) order by el.id"
+)
+# Deleted entity type -> the tables and columns that reference it.
+_DELETED_TYPES = {
+    "ome.model.annotations.MapAnnotation": [("annotations", "id"), ("image_links", "ann_id")],
+    "ome.model.annotations.ImageAnnotationLink": [("image_links", "id")],
+    "ome.model.containers.DatasetImageLink": [("dataset_links", "id")],
+    "ome.model.core.Image": [("images", "id"), ("image_links", "image_id"), ("dataset_links", "image_id")],
+}
+
+
+def default_index_path(host):
+    """The default location of the index for an OMERO server, next to the session cache.
+    """
+    path = os.environ.get("BIOHACK_INDEX_DIR")
+    if not path:
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        path = os.path.join(cache_dir, "biohack_utils")
+    return os.path.join(path, f"collections-{host}.sqlite")
+
+
+def _paged(conn, query, params, page_size):
+    """Run a projection query page by page, the query must have a stable order.
+    """
+    offset = 0
+    while True:
+        params.page(offset, page_size)
+        rows = _projection(conn, query, params)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class CollectionIndex:
+    """Persistent index of collection memberships, refreshed incrementally with `sync`.
+
+    Args:
+        path: The SQLite file, see `default_index_path`. ":memory:" keeps the index in memory.
+        refresh_interval: Seconds during which `sync` is skipped after the last sync.
+        page_size: Number of rows fetched per query while syncing.
+    """
+    def __init__(self, path, refresh_interval=30.0, page_size=5000):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._last_sync = None
+
+    @classmethod
+    def for_connection(cls, conn, **kwargs):
+        """Open the index of the server this connection is connected to at its default location.
+        """
+        return cls(default_index_path(conn.host), **kwargs)
+
+    @property
+    def last_event_id(self):
+        row = self._db.execute("select value from meta where key = 'last_event_id'").fetchone()
+        return -1 if row is None else int(row[0])
+
+    def _params(self, since):
+        params = ParametersI()
+        params.addLong("since", since)
+        params.add("nss", rlist([rstring(NS_COLLECTION), rstring(NS_NODE)]))
+        return params
+
+    def _sync_annotations(self, conn, since):
+        ann_ids = [ann_id for ann_id, in _paged(conn, _CHANGED_ANNOTATIONS_QUERY, self._params(since), self.page_size)]
+        rows = []
+        for chunk in _chunks(ann_ids, self.page_size):
+            params = ParametersI()
+            params.addIds(chunk)
+            values = _projection(conn, _ANNOTATION_VALUES_QUERY, params)
+            by_namespace = _rows_to_maps([(ns, ann_id, key, value) for ann_id, ns, key, value in values])
+            for ns, anns in by_namespace.items():
+                for ann_id, kv in anns.items():
+                    collection_id = kv.get("collection_id")
+                    rows.append((
+                        ann_id, ns, kv.get("name"), kv.get("version"),
+                        int(collection_id) if collection_id and collection_id.isdigit() else None, kv.get("type"),
+                    ))
+        self._db.executemany("insert or replace into annotations values (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def sync(self, conn, force=False):
+        """Fetch the changes since the last sync from the server.
+
+        Args:
+            conn: BlitzGateway connection to omero.
+            force: Sync even if the last sync is more recent than `refresh_interval`.
+
+        Returns:
+            Dict with the number of updated annotations, image links, dataset links and images,
+            and the number of deleted entities.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_sync is not None and now - self._last_sync < self.refresh_interval:
+                return None
+
+            since = self.last_event_id
+            # Changes after this event are picked up by the next sync, re-applying them is harmless.
+            (last_event_id,), = _projection(conn, _LAST_EVENT_QUERY, ParametersI())
+            stats = {"annotations": self._sync_annotations(conn, since)}
+
+            links = list(_paged(conn, _CHANGED_IMAGE_LINKS_QUERY, self._params(since), self.page_size))
+            self._db.executemany("insert or replace into image_links values (?, ?, ?)", links)
+            stats["image_links"] = len(links)
+
+            links = list(_paged(conn, _CHANGED_DATASET_LINKS_QUERY, self._params(since), self.page_size))
+            self._db.executemany("insert or replace into dataset_links values (?, ?, ?)", links)
+            stats["dataset_links"] = len(links)
+
+            images = list(_paged(conn, _CHANGED_IMAGES_QUERY, self._params(since), self.page_size))
+            self._db.executemany("insert or replace into images values (?, ?)", images)
+            stats["images"] = len(images)
+
+            stats["deleted"] = 0
+            if since >= 0:
+                params = ParametersI()
+                params.addLong("since", since)
+                params.add("types", rlist([rstring(entity_type) for entity_type in _DELETED_TYPES]))
+                for entity_type, entity_id in _paged(conn, _DELETIONS_QUERY, params, self.page_size):
+                    for table, column in _DELETED_TYPES[entity_type]:
+                        self._db.execute(f"delete from {table} where {column} = ?", (entity_id,))
+                    stats["deleted"] += 1
+
+            self._db.execute(
+                "insert or replace into meta values ('last_event_id', ?)", (str(max(since, last_event_id or -1)),)
+            )
+            self._db.commit()
+            self._last_sync = now
+            return stats
+
+    def members(self, collection_id, node_type=None, dataset_id=None, limit=None):
+        """Return the members of a collection as (image id, image name, node type, node name) tuples.
+
+        Args:
+            collection_id: The id of the collection annotation.
+            node_type: Only return members whose node in this collection has this type.
+            dataset_id: Only return members in this dataset.
+            limit: The maximal number of members.
+        """
+        query = (
+            "select distinct l.image_id, i.name, n.node_type, n.name from image_links l "
+            "left join images i on i.id = l.image_id "
+            "left join image_links nl on nl.image_id = l.image_id "
+            "and nl.ann_id in (select id from annotations where collection_id = :cid) "
+            "left join annotations n on n.id = nl.ann_id "
+            "where l.ann_id = :cid"
+        )
+        args = {"cid": int(collection_id)}
+        if node_type is not None:
+            query += " and n.node_type = :node_type"
+            args["node_type"] = node_type
+        if dataset_id is not None:
+            query += " and l.image_id in (select image_id from dataset_links where dataset_id = :did)"
+            args["did"] = int(dataset_id)
+        query += " order by l.id"
+        if limit is not None:
+            query += " limit :limit"
+            args["limit"] = int(limit)
+        with self._lock:
+            return self._db.execute(query, args).fetchall()
+
+    def collections(self, image_id):
+        """Return the (id, name, version) of all collections the image is a member of.
+        """
+        with self._lock:
+            return self._db.execute(
+                "select a.id, a.name, a.version from image_links l join annotations a on a.id = l.ann_id "
+                "where l.image_id = ? and a.ns = ? order by a.id",
+                (int(image_id), NS_COLLECTION),
+            ).fetchall()
+
+    def datasets(self, image_id):
+        """Return the ids of the datasets containing the image.
+        """
+        with self._lock:
+            rows = self._db.execute("select dataset_id from dataset_links where image_id = ?", (int(image_id),))
+            return [dataset_id for dataset_id, in rows.fetchall()]
+
+    def clear(self):
+        """Drop all entries, the next sync rebuilds the index from scratch.
+        """
+        with self._lock:
+            for table in ("meta", "annotations", "image_links", "dataset_links", "images"):
+                self._db.execute(f"delete from {table}")
+            self._db.commit()
+            self._last_sync = None
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,303 @@
+"""Streaming comparison of label image versions and sparse delta storage.
+
+Two label images are compared block by block, so neither is ever loaded completely. The diff
+reports the changed pixels and, per label, the pixels that were removed from and added to it.
+The changed pixels can also be kept as a sparse delta: the positions (delta-encoded within each
+block) and new values of the changed pixels. Such a delta is stored compressed next to the
+parent label image instead of a full dense copy, and `load_delta_version` reconstructs any
+region of the new version from the parent and the delta of the blocks it touches.
+"""
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .features import _compact_ids, _default_block_shape, _open_stack
+from .pixels import _normalize_key
+from .relabel import _block_slices
+
+
+NS_DELTA = "ome/collection/deltas"
+
+_STAT_COLUMNS = ("area_a", "area_b", "removed", "added")
+
+
+def _block_stats(a, b, changed):
+    """Per-label pixel counts of a block: the area in both versions and the removed and added pixels.
+    """
+    in_a, in_b = a != 0, b != 0
+    values_a, values_b = a[in_a], b[in_b]
+    if values_a.size + values_b.size == 0:
+        return None
+    ids, inverse = _compact_ids(np.concatenate([values_a, values_b]).astype("uint64", copy=False))
+    inverse_a, inverse_b = inverse[:values_a.size], inverse[values_a.size:]
+    n = len(ids)
+    return {
+        "label": ids.astype("int64"),
+        "area_a": np.bincount(inverse_a, minlength=n),
+        "area_b": np.bincount(inverse_b, minlength=n),
+        "removed": np.bincount(inverse_a[changed[in_a]], minlength=n),
+        "added": np.bincount(inverse_b[changed[in_b]], minlength=n),
+    }
+
+
+def _merge_stats(partials):
+    if len(partials) == 1:
+        return partials[0]
+    labels, inverse = np.unique(np.concatenate([p["label"] for p in partials]), return_inverse=True)
+    merged = {"label": labels}
+    for column in _STAT_COLUMNS:
+        values = np.concatenate([p[column] for p in partials])
+        merged[column] = np.bincount(inverse, weights=values, minlength=len(labels)).astype("int64")
+    return merged
+
+
+def diff_labels(labels_a, labels_b, block_shape=None, return_delta=False):
+    """Compare two versions of a label image block by block.
+
+    Args:
+        labels_a: Array-like label image with `shape`, `dtype` and numpy-style slicing, the parent.
+        labels_b: Array-like label image of the same shape, the new version.
+        block_shape: The shape of the blocks that are read at once, by default one plane
+            of up to 2048 x 2048 pixels.
+        return_delta: Whether to also return the sparse delta from labels_a to labels_b.
+
+    Returns:
+        Dict with 'n_pixels', 'n_changed', 'changed_fraction', the number of 'new_instances',
+        'deleted_instances' and 'modified_instances' and 'instances', a dict of arrays with
+        'label', 'area_a', 'area_b', 'removed' and 'added' pixels per label. With `return_delta`
+        also the delta, see `apply_delta`.
+    """
+    shape = tuple(labels_a.shape)
+    if tuple(labels_b.shape) != shape:
+        raise ValueError(f"The label images have different shapes: {shape} and {tuple(labels_b.shape)}")
+    block_shape = tuple(block_shape or _default_block_shape(shape, getattr(labels_a, "chunks", None)))
+    dtype = np.dtype(labels_b.dtype)
+
+    n_changed = 0
+    merged, partials, n_pending = None, [], 0
+    block_index, counts, positions, values = [], [], [], []
+    for i, block_slice in enumerate(_block_slices(shape, block_shape)):
+        a = np.asarray(labels_a[block_slice]).reshape(-1)
+        b = np.asarray(labels_b[block_slice]).reshape(-1)
+        changed = a != b
+        changed_positions = np.flatnonzero(changed)
+        n_changed += changed_positions.size
+        if return_delta and changed_positions.size:
+            block_index.append(i)
+            counts.append(changed_positions.size)
+            positions.append(np.diff(changed_positions, prepend=0).astype("uint32"))
+            values.append(b[changed_positions].astype(dtype, copy=False))
+
+        partial = _block_stats(a, b, changed)
+        if partial is None:
+            continue
+        partials.append(partial)
+        n_pending += len(partial["label"])
+        if n_pending > max(100_000, 0 if merged is None else len(merged["label"])):
+            merged = _merge_stats(partials if merged is None else [merged] + partials)
+            partials, n_pending = [], 0
+    if partials:
+        merged = _merge_stats(partials if merged is None else [merged] + partials)
+    if merged is None:
+        merged = {column: np.zeros(0, dtype="int64") for column in ("label",) + _STAT_COLUMNS}
+
+    n_pixels = int(np.prod(shape, dtype="int64"))
+    modified = (merged["area_a"] > 0) & (merged["area_b"] > 0) & ((merged["removed"] > 0) | (merged["added"] > 0))
+    diff = {
+        "n_pixels": n_pixels,
+        "n_changed": n_changed,
+        "changed_fraction": n_changed / n_pixels if n_pixels else 0.0,
+        "new_instances": int((merged["area_a"] == 0).sum()),
+        "deleted_instances": int((merged["area_b"] == 0).sum()),
+        "modified_instances": int(modified.sum()),
+        "instances": merged,
+    }
+    if not return_delta:
+        return diff
+
+    delta = {
+        "shape": np.array(shape, dtype="int64"),
+        "block_shape": np.array(block_shape, dtype="int64"),
+        "block_index": np.array(block_index, dtype="int64"),
+        "offsets": np.concatenate([[0], np.cumsum(counts, dtype="int64")]),
+        "positions": np.concatenate(positions) if positions else np.zeros(0, dtype="uint32"),
+        "values": np.concatenate(values) if values else np.zeros(0, dtype=dtype),
+    }
+    return diff, delta
+
+
+class DeltaLabels:
+    """Read-only array-like view of a label version stored as a delta against its parent.
+
+    Supports `shape`, `dtype` and numpy-style slicing; reading a region reads the same region
+    of the parent and applies the changed pixels of the blocks it overlaps.
+
+    Args:
+        parent: Array-like parent label image.
+        delta: The delta from the parent to this version, see `diff_labels`.
+    """
+    def __init__(self, parent, delta):
+        self._parent = parent
+        self._delta = delta
+        self.shape = tuple(int(s) for s in delta["shape"])
+        if tuple(parent.shape) != self.shape:
+            raise ValueError(f"The delta is for shape {self.shape}, the parent has shape {tuple(parent.shape)}")
+        self.ndim = len(self.shape)
+        self.dtype = delta["values"].dtype
+        self.chunks = tuple(int(s) for s in delta["block_shape"])
+        self._grid = tuple(-(-s // b) for s, b in zip(self.shape, self.chunks))
+        self._blocks = {int(block): i for i, block in enumerate(delta["block_index"])}
+
+    def _block_changes(self, block_id):
+        """The global coordinates and new values of the changed pixels of a block.
+        """
+        i = self._blocks.get(block_id)
+        if i is None:
+            return None
+        start, stop = self._delta["offsets"][i], self._delta["offsets"][i + 1]
+        positions = np.cumsum(self._delta["positions"][start:stop], dtype="int64")
+        grid_position = np.unravel_index(block_id, self._grid)
+        origin = [g * b for g, b in zip(grid_position, self.chunks)]
+        block_shape = [min(b, s - o) for b, s, o in zip(self.chunks, self.shape, origin)]
+        coords = np.unravel_index(positions, block_shape)
+        return [c + o for c, o in zip(coords, origin)], self._delta["values"][start:stop]
+
+    def __getitem__(self, key):
+        slices, drop = _normalize_key(key, self.shape)
+        out = np.array(self._parent[tuple(slices)], dtype=self.dtype)
+
+        ranges = [range(sl.start // b, -(-sl.stop // b)) for sl, b in zip(slices, self.chunks)]
+        for grid_position in np.ndindex(*[len(r) for r in ranges]):
+            block_id = np.ravel_multi_index([r[g] for r, g in zip(ranges, grid_position)], self._grid)
+            changes = self._block_changes(int(block_id))
+            if changes is None:
+                continue
+            coords, values = changes
+            inside = np.ones(len(values), dtype=bool)
+            for c, sl in zip(coords, slices):
+                inside &= (c >= sl.start) & (c < sl.stop)
+            out[tuple(c[inside] - sl.start for c, sl in zip(coords, slices))] = values[inside]
+
+        return out.squeeze(axis=drop) if drop else out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        if hasattr(self._parent, "close"):
+            self._parent.close()
+
+
+def apply_delta(parent, delta):
+    """Return the new version of the label image as a `DeltaLabels` view.
+    """
+    return DeltaLabels(parent, delta)
+
+
+#
+# Label versions in OMERO.
+#
+
+
+def diff_images(conn, image_id_a, image_id_b, t=0, block_shape=None):
+    """Compare two label images on the server, see `diff_labels`.
+    """
+    labels_a = _open_stack(conn, image_id_a, t=t)
+    labels_b = _open_stack(conn, image_id_b, t=t)
+    try:
+        return diff_labels(labels_a, labels_b, block_shape=block_shape)
+    finally:
+        labels_a.close()
+        labels_b.close()
+
+
+def store_delta_version(
+    conn, parent_image_id, labels, name, collection_id=None, node_type="Labels", t=0, block_shape=None,
+):
+    """Store a new version of a label image as a compressed delta against its parent.
+
+    The delta is attached to the parent image as a file annotation, and to the parent's node
+    annotation in the collection if one is given. Its description holds the node type and
+    name of the new version, the parent and the diff statistics.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        parent_image_id: The id of the parent label image.
+        labels: Array-like new version with the (z, y, x) shape of the parent.
+        name: The node name of the new version.
+        collection_id: The id of the collection of the parent.
+        node_type: The node type of the new version.
+        t: The timepoint of the parent.
+        block_shape: The (z, y, x) shape of the delta blocks.
+
+    Returns:
+        The id of the file annotation and the diff, see `diff_labels`.
+    """
+    from omero.model import AnnotationAnnotationLinkI, FileAnnotationI, MapAnnotationI
+
+    from .matching import _node_ann_id
+
+    parent = _open_stack(conn, parent_image_id, t=t)
+    try:
+        diff, delta = diff_labels(parent, labels, block_shape=block_shape, return_delta=True)
+    finally:
+        parent.close()
+
+    info = {
+        "type": node_type, "name": name, "collection_id": collection_id, "parent_image_id": parent_image_id,
+        "t": t, "n_changed": diff["n_changed"], "changed_fraction": diff["changed_fraction"],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f"{name}.delta.npz")
+        np.savez_compressed(path, **delta)
+        file_ann = conn.createFileAnnfromLocalFile(
+            path, mimetype="application/octet-stream", ns=NS_DELTA, desc=json.dumps(info)
+        )
+
+    parent_image = conn.getObject("Image", parent_image_id)
+    parent_image.linkAnnotation(file_ann)
+    node_ann_id = None if collection_id is None else _node_ann_id(conn, parent_image_id, collection_id)
+    if node_ann_id is not None:
+        link = AnnotationAnnotationLinkI()
+        link.setParent(MapAnnotationI(node_ann_id, False))
+        link.setChild(FileAnnotationI(file_ann.getId(), False))
+        conn.getUpdateService().saveAndReturnArray([link], conn.SERVICE_OPTS)
+    return file_ann.getId(), diff
+
+
+def list_delta_versions(conn, parent_image_id):
+    """List the label versions stored as deltas against an image.
+
+    Returns:
+        List of (file annotation id, info dict) tuples.
+    """
+    image = conn.getObject("Image", parent_image_id)
+    if image is None:
+        raise ValueError(f"Image {parent_image_id} not found")
+    return [
+        (ann.getId(), json.loads(ann.getDescription() or "{}")) for ann in image.listAnnotations(ns=NS_DELTA)
+    ]
+
+
+def load_delta_version(conn, file_ann_id, prefetch_workers=2):
+    """Load a label version stored with `store_delta_version`.
+
+    Returns:
+        A `DeltaLabels` view of the (z, y, x) label image, reading the parent from the server.
+    """
+    file_ann = conn.getObject("FileAnnotation", file_ann_id)
+    if file_ann is None:
+        raise ValueError(f"FileAnnotation {file_ann_id} not found")
+    info = json.loads(file_ann.getDescription() or "{}")
+    buffer = io.BytesIO()
+    for chunk in file_ann.getFileInChunks():
+        buffer.write(chunk)
+    buffer.seek(0)
+    with np.load(buffer) as data:
+        delta = {key: data[key] for key in data.files}
+    parent = _open_stack(conn, info["parent_image_id"], t=info.get("t", 0), prefetch_workers=prefetch_workers)
+    return DeltaLabels(parent, delta)
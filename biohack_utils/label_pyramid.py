@@ -0,0 +1,189 @@
+"""Label-safe multiscale pyramids for label images.
+
+Averaging or interpolating a label image invents instance ids that don't exist. The levels are
+instead downsampled with the most frequent label of each window ('mode') or its top-left pixel
+('nearest'), so every pixel of a lower resolution keeps an id of the full resolution.
+
+Each level is computed from the previous one block by block in a process pool and kept in a
+temporary file, so only a few blocks are in memory at a time. `upload_label_pyramid` uploads the
+levels of a label image in OMERO and registers them as `multiscale` nodes of its collection.
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .relabel import _block_slices
+
+
+_METHODS = ("mode", "nearest")
+
+
+def _window_mode(windows):
+    """The most frequent value of every row, ties go to the value that comes first.
+    """
+    counts = (windows[:, :, None] == windows[:, None, :]).sum(axis=2)
+    return windows[np.arange(len(windows)), counts.argmax(axis=1)]
+
+
+def downsample_labels(block, factor=2, method="mode"):
+    """Downsample the last two axes of a label block by an integer factor.
+
+    Sizes that are not divisible by the factor are padded with the edge values.
+    """
+    if method not in _METHODS:
+        raise ValueError(f"Invalid method {method}, choose one of {_METHODS}")
+    block = np.asarray(block)
+    if method == "nearest":
+        return block[..., ::factor, ::factor]
+
+    pad = [(0, 0)] * (block.ndim - 2) + [(0, -s % factor) for s in block.shape[-2:]]
+    if any(p for _, p in pad):
+        block = np.pad(block, pad, mode="edge")
+    *lead, size_y, size_x = block.shape
+    out_shape = (*lead, size_y // factor, size_x // factor)
+    windows = block.reshape(*lead, size_y // factor, factor, size_x // factor, factor)
+    windows = np.moveaxis(windows, -3, -2).reshape(-1, factor * factor)
+    return _window_mode(windows).reshape(out_shape)
+
+
+def _default_n_levels(shape, factor, min_size=256):
+    n_levels = 1
+    size_y, size_x = shape[-2:]
+    while max(size_y, size_x) > min_size:
+        size_y, size_x = -(-size_y // factor), -(-size_x // factor)
+        n_levels += 1
+    return n_levels
+
+
+def _level_shape(shape, factor):
+    return tuple(shape[:-2]) + tuple(-(-s // factor) for s in shape[-2:])
+
+
+def build_label_pyramid(
+    data, n_levels=None, factor=2, method="mode", block_shape=None, n_workers=None, tmp_dir=None,
+):
+    """Compute the lower resolution levels of a label image.
+
+    Args:
+        data: Array-like label image with `shape`, `dtype` and numpy-style slicing. The last two
+            axes (y, x) are downsampled, the others are kept.
+        n_levels: The number of levels including the full resolution, by default until the
+            largest side is at most 256 pixels.
+        factor: The downsampling factor between consecutive levels.
+        method: 'mode' for the most frequent label of each window, 'nearest' for its top-left pixel.
+        block_shape: The shape of the blocks that are downsampled at once, the last two sizes are
+            rounded to multiples of the factor. By default one plane of up to 2048 x 2048 pixels.
+        n_workers: Number of processes, by default the number of CPUs. 0 computes the blocks in
+            this process.
+        tmp_dir: Directory for the temporary files with the levels.
+
+    Returns:
+        List of the levels 1 to n_levels - 1 as memory-mapped numpy arrays.
+    """
+    shape = tuple(data.shape)
+    n_levels = n_levels or _default_n_levels(shape, factor)
+    dtype = np.dtype(data.dtype)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+
+    executor = ProcessPoolExecutor(n_workers) if n_workers else None
+    levels, source = [], data
+    try:
+        for _ in range(1, n_levels):
+            source_shape = tuple(source.shape)
+            block = list(block_shape or [1] * (len(source_shape) - 2) + [2048, 2048])
+            block[-2:] = [max(factor, b // factor * factor) for b in block[-2:]]
+            block = [min(b, s) for b, s in zip(block, source_shape)]
+
+            level = np.memmap(tempfile.TemporaryFile(dir=tmp_dir), dtype=dtype, mode="w+",
+                              shape=_level_shape(source_shape, factor))
+            slices = list(_block_slices(source_shape, block))
+
+            def _target(block_slice):
+                return tuple(block_slice[:-2]) + tuple(
+                    slice(sl.start // factor, -(-sl.stop // factor)) for sl in block_slice[-2:]
+                )
+
+            # Submit in batches, so only a few blocks per process are in memory.
+            batch_size = max(1, 2 * (n_workers or 1))
+            for start in range(0, len(slices), batch_size):
+                batch = slices[start:start + batch_size]
+                blocks = [np.asarray(source[block_slice]) for block_slice in batch]
+                if executor is None:
+                    results = [downsample_labels(b, factor, method) for b in blocks]
+                else:
+                    results = executor.map(downsample_labels, blocks, [factor] * len(blocks), [method] * len(blocks))
+                for block_slice, result in zip(batch, results):
+                    level[_target(block_slice)] = result
+            level.flush()
+            levels.append(level)
+            source = level
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return levels
+
+
+def upload_label_pyramid(
+    conn, image_id, collection_id, n_levels=None, factor=2, method="mode", dataset_id=None, n_workers=None,
+):
+    """Build a label-safe pyramid of a label image in OMERO and register its levels in the collection.
+
+    Every level is uploaded as an image of its own and gets a node annotation of type
+    'multiscale' with the full resolution image, its level and scale as attributes.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image_id: The id of the full resolution label image.
+        collection_id: The id of the collection annotation of the label image.
+        n_levels: The number of levels including the full resolution, see `build_label_pyramid`.
+        factor: The downsampling factor between consecutive levels.
+        method: 'mode' or 'nearest', see `downsample_labels`.
+        dataset_id: The dataset to put the level images in.
+        n_workers: Number of processes downsampling the blocks.
+
+    Returns:
+        Dict {level: image id}, level 0 is the full resolution image.
+    """
+    from . import omero_annotation
+    from .features import _open_stack
+    from .upload import upload_array
+
+    image = conn.getObject("Image", image_id)
+    if image is None:
+        raise ValueError(f"Image {image_id} not found")
+    if image.getSizeT() > 1 or image.getSizeC() > 1:
+        raise ValueError(f"Image {image_id} has more than one timepoint or channel, expected a label image")
+    node = omero_annotation._node_for_collection(
+        omero_annotation._list_map_annotations(conn, image_id, omero_annotation.NS_NODE), collection_id
+    ) or {}
+    name = node.get("name") or image.getName()
+
+    labels = _open_stack(conn, image_id)
+    try:
+        levels = build_label_pyramid(labels, n_levels=n_levels, factor=factor, method=method, n_workers=n_workers)
+    finally:
+        labels.close()
+
+    level_ids = {0: image_id}
+    for level, data in enumerate(levels, start=1):
+        level_ids[level] = upload_array(conn, data, f"{name}_level{level}", axes="zyx", dataset_id=dataset_id)
+
+    omero_annotation._bulk_add_node_annotations(conn, [
+        {
+            "image_id": level_image_id,
+            "collection_id": collection_id,
+            "type": "multiscale",
+            "name": f"{name}/{level}",
+            "attributes": {
+                "multiscale_of": image_id,
+                "level": level,
+                "scale": [1, factor ** level, factor ** level],
+                "downsampling": method,
+                "ome-iviewer:voxelType": "labels",
+            },
+        }
+        for level, level_image_id in level_ids.items() if level > 0
+    ])
+    return level_ids
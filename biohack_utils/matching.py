@@ -0,0 +1,264 @@
+"""Instance matching between label images and stable instance ids across label versions.
+
+The overlap of two label images is counted block by block into a sparse contingency table,
+i.e. one (label_a, label_b, count) row per pair of overlapping labels, so millions of objects
+never need a dense overlap matrix. The IoU of the overlapping pairs gives one-to-one matches.
+
+A stable instance id is the (image id, label) at which the instance first appeared. When a
+new label version is matched against its parent, matched instances inherit the parent's ids and
+new instances get their own. The ids are stored as an OMERO table attached to the label image.
+"""
+import numpy as np
+
+from .features import _compact_ids, _default_block_shape, _open_stack, load_features_table, save_features_table
+from .relabel import _block_slices
+
+
+NS_INSTANCES = "ome/collection/instances"
+
+
+def _block_contingency(labels_a, labels_b):
+    """Count the pixels of every (label_a, label_b) pair in a block, pixels that are 0 in both are skipped.
+    """
+    a = np.asarray(labels_a).reshape(-1)
+    b = np.asarray(labels_b).reshape(-1)
+    foreground = np.flatnonzero((a != 0) | (b != 0))
+    if foreground.size == 0:
+        return None
+    ids_a, inverse_a = _compact_ids(a[foreground].astype("uint64", copy=False))
+    ids_b, inverse_b = _compact_ids(b[foreground].astype("uint64", copy=False))
+    n_b = len(ids_b)
+    codes = inverse_a.astype("int64") * n_b + inverse_b
+    if len(ids_a) * n_b <= 4 * foreground.size:
+        counts = np.bincount(codes, minlength=len(ids_a) * n_b)
+        codes = np.flatnonzero(counts)
+        counts = counts[codes]
+    else:
+        codes, counts = np.unique(codes, return_counts=True)
+    return ids_a[codes // n_b].astype("int64"), ids_b[codes % n_b].astype("int64"), counts.astype("int64")
+
+
+def _merge_pairs(partials):
+    """Sum the counts of the same (label_a, label_b) pair across partial contingency tables.
+    """
+    a = np.concatenate([p[0] for p in partials])
+    b = np.concatenate([p[1] for p in partials])
+    counts = np.concatenate([p[2] for p in partials])
+    order = np.lexsort((b, a))
+    a, b, counts = a[order], b[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], (a[1:] != a[:-1]) | (b[1:] != b[:-1])]))
+    return a[starts], b[starts], np.add.reduceat(counts, starts) if len(counts) else counts
+
+
+def contingency_table(labels_a, labels_b, block_shape=None):
+    """Count the overlap of all pairs of labels in two label images of the same shape.
+
+    Args:
+        labels_a: Array-like label image with `shape` and numpy-style slicing.
+        labels_b: Array-like label image with the same shape.
+        block_shape: The shape of the blocks that are read at once, by default one plane
+            of up to 2048 x 2048 pixels.
+
+    Returns:
+        Arrays label_a, label_b and count, sorted by (label_a, label_b), with one entry per
+        overlapping pair. Label 0 is the background, e.g. (label_a, 0) counts the pixels of
+        label_a that are background in labels_b.
+    """
+    shape = tuple(labels_a.shape)
+    if tuple(labels_b.shape) != shape:
+        raise ValueError(f"The label images have different shapes: {shape} and {tuple(labels_b.shape)}")
+    block_shape = block_shape or _default_block_shape(shape, getattr(labels_a, "chunks", None))
+
+    merged, partials, n_pending = None, [], 0
+    for block_slice in _block_slices(shape, block_shape):
+        partial = _block_contingency(labels_a[block_slice], labels_b[block_slice])
+        if partial is None:
+            continue
+        partials.append(partial)
+        n_pending += len(partial[0])
+        if n_pending > max(100_000, 0 if merged is None else len(merged[0])):
+            merged = _merge_pairs(partials if merged is None else [merged] + partials)
+            partials, n_pending = [], 0
+    if partials:
+        merged = _merge_pairs(partials if merged is None else [merged] + partials)
+    if merged is None:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+    return merged
+
+
+def _areas(labels, counts):
+    """The area of every label from the contingency rows. Returns the labels and their areas.
+    """
+    unique, inverse = np.unique(labels, return_inverse=True)
+    return unique, np.bincount(inverse, weights=counts, minlength=len(unique)).astype("int64")
+
+
+def pair_iou(label_a, label_b, count):
+    """The IoU of the overlapping foreground pairs of a contingency table.
+
+    Returns:
+        Arrays label_a, label_b and iou of the pairs where both labels are not 0.
+    """
+    ids_a, areas_a = _areas(label_a, count)
+    ids_b, areas_b = _areas(label_b, count)
+    both = (label_a != 0) & (label_b != 0)
+    label_a, label_b, count = label_a[both], label_b[both], count[both]
+    union = areas_a[np.searchsorted(ids_a, label_a)] + areas_b[np.searchsorted(ids_b, label_b)] - count
+    return label_a, label_b, count / union
+
+
+def _first_per_group(groups, iou, tiebreak):
+    """Row index of the highest IoU in each group, ties go to the smallest tiebreak value.
+    """
+    order = np.lexsort((tiebreak, -iou, groups))
+    sorted_groups = groups[order]
+    return order[np.concatenate([[True], sorted_groups[1:] != sorted_groups[:-1]])]
+
+
+def match_iou(label_a, label_b, iou, threshold=0.5):
+    """One-to-one matching of label pairs by IoU.
+
+    Pairs that are each other's best candidate are matched and removed with all other pairs of
+    their labels, until no pair is left. This equals the greedy matching in the order of
+    decreasing IoU, but every round is vectorised. Above a threshold of 0.5 every label has at
+    most one candidate and a single round suffices.
+
+    Returns:
+        Arrays label_a, label_b and iou of the matched pairs.
+    """
+    keep = iou > threshold
+    label_a, label_b, iou = label_a[keep], label_b[keep], iou[keep]
+    matches = []
+    while len(label_a):
+        best_for_a = _first_per_group(label_a, iou, label_b)
+        best_for_b = _first_per_group(label_b, iou, label_a)
+        mutual = np.intersect1d(best_for_a, best_for_b, assume_unique=True)
+        matches.append((label_a[mutual], label_b[mutual], iou[mutual]))
+        left = ~(np.isin(label_a, label_a[mutual]) | np.isin(label_b, label_b[mutual]))
+        label_a, label_b, iou = label_a[left], label_b[left], iou[left]
+    if not matches:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64"), np.zeros(0, dtype="float64")
+    matched_a, matched_b, matched_iou = (np.concatenate(values) for values in zip(*matches))
+    order = np.argsort(matched_a)
+    return matched_a[order], matched_b[order], matched_iou[order]
+
+
+def match_instances(labels_a, labels_b, threshold=0.5, block_shape=None):
+    """Match the instances of two label images of the same shape, see `match_iou`.
+
+    Returns:
+        Dict with the matched pairs ('label_a', 'label_b', 'iou') and all labels of each
+        image with their areas ('labels_a', 'areas_a', 'labels_b', 'areas_b').
+    """
+    label_a, label_b, count = contingency_table(labels_a, labels_b, block_shape)
+    ids_a, areas_a = _areas(label_a, count)
+    ids_b, areas_b = _areas(label_b, count)
+    matched_a, matched_b, matched_iou = match_iou(*pair_iou(label_a, label_b, count), threshold=threshold)
+    return {
+        "label_a": matched_a, "label_b": matched_b, "iou": matched_iou,
+        "labels_a": ids_a[ids_a != 0], "areas_a": areas_a[ids_a != 0],
+        "labels_b": ids_b[ids_b != 0], "areas_b": areas_b[ids_b != 0],
+    }
+
+
+#
+# Stable instance ids in OMERO.
+#
+
+
+def _node_ann_id(conn, image_id, collection_id):
+    from . import omero_annotation
+
+    node_anns = omero_annotation._list_map_annotations(conn, image_id, omero_annotation.NS_NODE)
+    for ann_id, kv in node_anns:
+        if collection_id is None or kv.get("collection_id") == str(collection_id):
+            return ann_id
+    return None
+
+
+def load_instance_ids(conn, image_id):
+    """Load the stable instance ids of a label image.
+
+    Returns:
+        Dict with the arrays 'label', 'origin_image_id' and 'origin_label', or None if no
+        ids were assigned to the image yet.
+    """
+    image = conn.getObject("Image", image_id)
+    if image is None:
+        raise ValueError(f"Image {image_id} not found")
+    file_ann_ids = [ann.getId() for ann in image.listAnnotations(ns=NS_INSTANCES)]
+    if not file_ann_ids:
+        return None
+    return load_features_table(conn, max(file_ann_ids))
+
+
+def _own_ids(image_id, labels):
+    """The instance id table of labels that all start with this image.
+    """
+    return {
+        "label": labels,
+        "origin_image_id": np.full(len(labels), image_id, dtype="int64"),
+        "origin_label": labels.copy(),
+        "parent_label": np.zeros(len(labels), dtype="int64"),
+        "iou": np.zeros(len(labels)),
+    }
+
+
+def _save_instance_ids(conn, image_id, collection_id, table, parent_image_id):
+    return save_features_table(
+        conn, table, f"instances_{image_id}.h5", image_id, _node_ann_id(conn, image_id, collection_id),
+        description=f"collection_id={collection_id}, parent_image_id={parent_image_id}", ns=NS_INSTANCES,
+    )
+
+
+def assign_stable_ids(conn, image_id, parent_image_id=None, collection_id=None, threshold=0.5, t=0):
+    """Assign stable instance ids to a label image and store them next to it.
+
+    Instances that match an instance of the parent label image with an IoU above the threshold
+    keep the parent's id, the others get (image_id, label) as their id. A parent without ids
+    first gets its own labels as ids. Both images are streamed from the server.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image_id: The id of the label image.
+        parent_image_id: The id of the previous version of the label image.
+        collection_id: The collection of the images, the tables are also linked to the nodes
+            of the images in this collection.
+        threshold: The minimal IoU of matched instances.
+        t: The timepoint of both images.
+
+    Returns:
+        The instance id table, a dict with the arrays 'label', 'origin_image_id', 'origin_label',
+        'parent_label' (0 for new instances) and 'iou', and the id of its file annotation.
+    """
+    labels = _open_stack(conn, image_id, t=t)
+    parent = None if parent_image_id is None else _open_stack(conn, parent_image_id, t=t)
+    try:
+        # Without a parent, the table of the image with itself lists its labels.
+        matches = match_instances(labels if parent is None else parent, labels, threshold=threshold)
+    finally:
+        labels.close()
+        if parent is not None:
+            parent.close()
+
+    table = _own_ids(image_id, matches["labels_b"])
+    if parent is not None:
+        parent_ids = load_instance_ids(conn, parent_image_id)
+        if parent_ids is None:
+            parent_ids = _own_ids(parent_image_id, matches["labels_a"])
+            _save_instance_ids(conn, parent_image_id, collection_id, parent_ids, None)
+
+        parent_rows = np.searchsorted(parent_ids["label"], matches["label_a"])
+        if len(parent_rows) and (
+            parent_rows.max() >= len(parent_ids["label"])
+            or (parent_ids["label"][parent_rows] != matches["label_a"]).any()
+        ):
+            raise ValueError(f"The instance ids of image {parent_image_id} don't cover all of its labels")
+        rows = np.searchsorted(table["label"], matches["label_b"])
+        table["origin_image_id"][rows] = parent_ids["origin_image_id"][parent_rows]
+        table["origin_label"][rows] = parent_ids["origin_label"][parent_rows]
+        table["parent_label"][rows] = matches["label_a"]
+        table["iou"][rows] = matches["iou"]
+
+    file_ann_id = _save_instance_ids(conn, image_id, collection_id, table, parent_image_id)
+    return table, file_ann_id
@@ -1,11 +1,80 @@
 import json
 
-from omero.rtypes import rstring
-from omero.model import MapAnnotationI, NamedValue
+from omero.rtypes import rlist, rlong, rstring, unwrap
+from omero.model import ImageAnnotationLinkI, ImageI, MapAnnotationI, NamedValue
+from omero.sys import ParametersI
+
+from .cache import cached, get_cache, invalidate
+from .tracing import traced_operation
 
 
 NS_COLLECTION = "ome/collection"
 NS_NODE = "ome/collection/nodes"
+NS_LINK = "ome/collection/links"
+
+# Prefix of the node attribute values that are stored as JSON, so strings like "1" stay strings.
+_JSON_PREFIX = "json:"
+
+# Projection queries used to resolve a whole collection graph in a fixed number of round-trips.
+_COLLECTIONS_OF_IMAGE_QUERY = (
+    "select a.id, mv.name, mv.value "
+    "from MapAnnotation a join a.mapValue mv, ImageAnnotationLink l "
+    "where l.child.id = a.id and l.parent.id = :iid and a.ns = :ns "
+    "order by a.id"
+)
+_MEMBERS_OF_COLLECTIONS_QUERY = (
+    "select l.child.id, l.parent.id from ImageAnnotationLink l "
+    "where l.child.id in (:cids) order by l.id"
+)
+_EXISTING_COLLECTION_LINKS_QUERY = (
+    "select l.child.id, l.parent.id from ImageAnnotationLink l "
+    "where l.child.id in (:cids) and l.parent.id in (:ids)"
+)
+_NODES_OF_IMAGES_QUERY = (
+    "select l.parent.id, a.id, mv.name, mv.value "
+    "from MapAnnotation a join a.mapValue mv, ImageAnnotationLink l "
+    "where l.child.id = a.id and l.parent.id in (:ids) and a.ns = :ns "
+    "order by a.id"
+)
+
+_IMAGES_WITH_ANNOTATION_QUERY = (
+    "select distinct l.parent.id from ImageAnnotationLink l "
+    "where l.parent.id in (:ids) and l.child.ns = :ns"
+)
+_LINKS_OF_IMAGES_QUERY = (
+    "select l.parent.id, mv.value "
+    "from MapAnnotation a join a.mapValue mv, ImageAnnotationLink l "
+    "where l.child.id = a.id and l.parent.id in (:ids) and a.ns = :ns and mv.name = 'link'"
+)
+
+
+def _filtered_members_query(by_type=False, by_name=False, paged=False):
+    """The query for the (collection id, image id) of the members of collections, ordered by image id.
+
+    The node type and name predicates are evaluated on the server, on the map values of the
+    member's node annotation whose collection_id is the collection of the link, so a member of
+    several collections is only selected in the collections where its own node matches.
+    """
+    if not (by_type or by_name):
+        query = "select distinct l.child.id, l.parent.id from ImageAnnotationLink l where l.child.id in (:cids)"
+    else:
+        joins = ["join a.mapValue c"]
+        conditions = ["c.name = 'collection_id'", "c.value = str(l.child.id)"]
+        if by_type:
+            joins.append("join a.mapValue t")
+            conditions += ["t.name = 'type'", "t.value in (:types)"]
+        if by_name:
+            joins.append("join a.mapValue nm")
+            conditions += ["nm.name = 'name'", "nm.value in (:names)"]
+        query = (
+            "select distinct l.child.id, l.parent.id "
+            f"from MapAnnotation a {' '.join(joins)}, ImageAnnotationLink n, ImageAnnotationLink l "
+            "where l.child.id in (:cids) and n.parent.id = l.parent.id and n.child.id = a.id and a.ns = :ns "
+            f"and {' and '.join(conditions)}"
+        )
+    if paged:
+        query += " and l.parent.id > :after"
+    return query + " order by l.parent.id"
 
 
 def _build_image_url(image_id):
@@ -13,62 +82,168 @@ def _build_image_url(image_id):
     return f"https://omero-training.gerbi-gmb.de/webclient/img_detail/{image_id}/"
 
 
-def _append_link_to_node_annotation(conn, image_id, link):
-    """Append `link` to the 'attributes.link' field of the first NS_NODE
-    map annotation of the given image.
+def _get_image(conn, image_id):
+    """Get the image wrapper, through the metadata cache if one is attached.
     """
-    img = conn.getObject("Image", image_id)
-    if img is None:
-        raise ValueError(f"Image {image_id} not found")
+    return cached(conn, ("Image", image_id), lambda: conn.getObject("Image", image_id))
 
-    anns = list(img.listAnnotations(ns=NS_NODE))
-    if not anns:
-        raise RuntimeError(
-            f"No node annotation (ns={NS_NODE}) found for Image {image_id}"
-        )
 
-    node_ann = anns[0]  # you seem to expect exactly one node per image
+def _get_map_annotation(conn, ann_id):
+    """Get the map annotation wrapper, through the metadata cache if one is attached.
+    """
+    return cached(conn, ("MapAnnotation", ann_id), lambda: conn.getObject("MapAnnotation", ann_id))
 
-    # Current key–value dict for this annotation
-    kv = _map_ann_to_dict(node_ann)
 
-    # Read existing links from "attributes.link" (JSON list or simple string)
-    raw_links = kv.get("attributes.link")
-    if raw_links is None:
-        links = []
-    else:
-        links = json.loads(raw_links)
-        if not isinstance(links, list):
-            links = [str(links)]
+def _list_map_annotations(conn, image_id, ns):
+    """List the map annotations of an image in the given namespace.
+    Returns a list of (annotation id, key-value dict) tuples.
+    """
+    def _load():
+        img = _get_image(conn, image_id)
+        if img is None:
+            return None
+        return [(ann.getId(), _map_ann_to_dict(ann)) for ann in img.listAnnotations(ns=ns)]
 
-    # Append if not already present
-    if link not in links:
-        links.append(link)
+    return cached(conn, ("anns", image_id, ns), _load) or []
 
-    # Store back as JSON string
-    kv["attributes.link"] = json.dumps(links)
 
-    # Convert back to list of NamedValue
-    kv_pairs = [NamedValue(str(k), str(v)) for k, v in kv.items()]
+def _link_annotation(image_id, link):
+    """An unsaved link annotation of the image, linked to it through an ImageAnnotationLink.
+    """
+    ann = MapAnnotationI()
+    ann.setNs(rstring(NS_LINK))
+    ann.setMapValue([NamedValue("link", str(link))])
+    image_link = ImageAnnotationLinkI()
+    image_link.setParent(ImageI(image_id, False))
+    image_link.setChild(ann)
+    return image_link
 
-    # Get the underlying IObject to update
-    qs = conn.getQueryService()
-    iann = qs.get("MapAnnotation", node_ann.getId())
 
-    iann.setMapValue(kv_pairs)
+def _bulk_append_links(conn, links, chunk_size=500):
+    """Append links to the nodes of many images, saving one chunk per server call.
+
+    Every link is a small map annotation of its own (namespace NS_LINK), so appending never
+    rewrites the node annotation and costs the same however many links a node has already.
+    Links that the image has already are skipped.
 
+    Args:
+        conn: BlitzGateway connection to omero.
+        links: Iterable of (image_id, link) tuples.
+        chunk_size: Number of links saved per server call.
+
+    Returns:
+        The number of links that were added.
+    """
     update_service = conn.getUpdateService()
-    update_service.saveObject(iann)
+    n_added = 0
+
+    def _save_chunk(chunk):
+        params = ParametersI()
+        params.addIds(list({image_id for image_id, _ in chunk}))
+        params.addString("ns", NS_NODE)
+        with_node = {row[0] for row in _projection(conn, _IMAGES_WITH_ANNOTATION_QUERY, params)}
+        missing = sorted({image_id for image_id, _ in chunk} - with_node)
+        if missing:
+            raise RuntimeError(f"No node annotation (ns={NS_NODE}) found for Image(s) {missing}")
+
+        params.addString("ns", NS_LINK)
+        existing = {tuple(row) for row in _projection(conn, _LINKS_OF_IMAGES_QUERY, params)}
+        new_links = []
+        for image_id, link in chunk:
+            if (image_id, str(link)) not in existing:
+                existing.add((image_id, str(link)))
+                new_links.append(_link_annotation(image_id, link))
+        if new_links:
+            update_service.saveAndReturnArray(new_links)
+        for image_id in {image_id for image_id, _ in chunk}:
+            invalidate(conn, ("anns", image_id, NS_LINK))
+        return len(new_links)
+
+    chunk = []
+    for image_id, link in links:
+        chunk.append((image_id, link))
+        if len(chunk) == chunk_size:
+            n_added += _save_chunk(chunk)
+            chunk = []
+    if chunk:
+        n_added += _save_chunk(chunk)
+    return n_added
+
+
+def _append_link_to_node_annotation(conn, image_id, link):
+    """Append `link` to the links of the node of the given image.
+    See `_bulk_append_links` to append many links at once.
+    """
+    _bulk_append_links(conn, [(image_id, link)])
+
+
+def _get_node_links(conn, image_id):
+    """Get the links of the node of an image.
+
+    Combines the link annotations with the links stored in 'attributes.link' of the node
+    annotation by older versions, without duplicates.
+    """
+    links = {}
+    node_kv = _get_node_info(conn, image_id) or {}
+    links.update(dict.fromkeys(_legacy_links(node_kv.get("attributes.link"))))
+    for _, kv in _list_map_annotations(conn, image_id, NS_LINK):
+        links.setdefault(kv["link"], None)
+    return list(links)
+
+
+def _bulk_get_node_links(conn, image_ids, chunk_size=500):
+    """Get the link annotations of many images with one projection query per chunk.
+    Returns dict {image_id: [links]}, without the legacy 'attributes.link' of the node annotations.
+    """
+    links = {image_id: {} for image_id in image_ids}
+    image_ids = list(links)
+    for start in range(0, len(image_ids), chunk_size):
+        params = ParametersI()
+        params.addIds(image_ids[start:start + chunk_size])
+        params.addString("ns", NS_LINK)
+        for image_id, link in _projection(conn, _LINKS_OF_IMAGES_QUERY, params):
+            links[image_id].setdefault(link, None)
+    return {image_id: list(image_links) for image_id, image_links in links.items()}
 
 
 def _map_ann_to_dict(ann):
     return {k: v for k, v in ann.getValue()}
 
 
-def _create_collection(conn, name, version="0.x"):
-    """Create a collection annotation (not linked to any image yet).
-    Returns the annotation ID.
+def _encode_attribute(value):
+    """Store strings as they are and everything else as JSON tagged with the 'json:' prefix.
+    """
+    if isinstance(value, str) and not value.startswith(_JSON_PREFIX):
+        return value
+    return _JSON_PREFIX + json.dumps(value)
+
+
+def _decode_attribute(value):
+    return json.loads(value[len(_JSON_PREFIX):]) if value.startswith(_JSON_PREFIX) else value
+
+
+def _legacy_links(value):
+    """The links of an 'attributes.link' value, written as a plain JSON list by older versions.
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = _decode_attribute(value)
+    if isinstance(value, str) and value.startswith("["):
+        value = json.loads(value)
+    return value if isinstance(value, list) else [str(value)]
+
+
+def _node_attributes(kv):
+    """Collect the 'attributes.*' entries of a node as a dict, decoding the JSON-tagged values.
     """
+    return {
+        key[len("attributes."):]: _decode_attribute(value)
+        for key, value in kv.items() if key.startswith("attributes.")
+    }
+
+
+def _collection_annotation(name, version):
     map_annotation = MapAnnotationI()
     map_annotation.setNs(rstring(NS_COLLECTION))
 
@@ -78,6 +253,14 @@ def _create_collection(conn, name, version="0.x"):
         NamedValue("name", name)
     ]
     map_annotation.setMapValue(kv_pairs)
+    return map_annotation
+
+
+def _create_collection(conn, name, version="0.x"):
+    """Create a collection annotation (not linked to any image yet).
+    Returns the annotation ID.
+    """
+    map_annotation = _collection_annotation(name, version)
 
     # We save this in a server.
     update_service = conn.getUpdateService()
@@ -86,11 +269,22 @@ def _create_collection(conn, name, version="0.x"):
     return saved.getId().getValue()
 
 
+def _create_collections(conn, names, version="0.x"):
+    """Create several collection annotations with a single server call.
+    Returns the annotation IDs in the order of the names.
+    """
+    if not names:
+        return []
+    update_service = conn.getUpdateService()
+    saved = update_service.saveAndReturnArray([_collection_annotation(name, version) for name in names])
+    return [ann.getId().getValue() for ann in saved]
+
+
 def _link_collection_to_image(conn, collection_ann_id, image_id):
     """Link an existing collection annotation to an image.
     """
-    image = conn.getObject("Image", image_id)
-    annotation = conn.getObject("MapAnnotation", collection_ann_id)
+    image = _get_image(conn, image_id)
+    annotation = _get_map_annotation(conn, collection_ann_id)
 
     if image is None:
         raise ValueError("Image {} not found".format(image_id))
@@ -98,6 +292,7 @@ def _link_collection_to_image(conn, collection_ann_id, image_id):
         raise ValueError("Annotation {} not found".format(collection_ann_id))
 
     image.linkAnnotation(annotation)
+    invalidate(conn, ("anns", image_id, NS_COLLECTION), ("members", collection_ann_id))
 
 
 def _create_map_annotation(conn, kv, namespace):
@@ -112,14 +307,13 @@ def _create_map_annotation(conn, kv, namespace):
 
     update_service = conn.getUpdateService()
     saved = update_service.saveAndReturnObject(ann)
-    return conn.getObject("MapAnnotation", saved.getId().getValue())
+    ann_id = saved.getId().getValue()
+    invalidate(conn, ("MapAnnotation", ann_id))
+    return _get_map_annotation(conn, ann_id)
 
 
-def _add_node_annotation(
-    conn, image_id, node_type, collection_ann_id, node_name=None, attributes=None
-):
-    """Add a node annotation to an image describing its role in the collection.
-    Returns the created annotation id.
+def _node_kv(node_type, collection_ann_id, node_name=None, attributes=None):
+    """Build the key-value dict of a node annotation.
     """
     kv = {
         "type": node_type,
@@ -128,15 +322,27 @@ def _add_node_annotation(
     if node_name:
         kv["name"] = node_name
     if attributes:
+        # Structured values (e.g. RFC-8 attributes from OME-Zarr) are stored as tagged JSON.
         for key, value in attributes.items():
-            kv["attributes.{}".format(key)] = str(value)
+            kv["attributes.{}".format(key)] = _encode_attribute(value)
+    return kv
+
+
+def _add_node_annotation(
+    conn, image_id, node_type, collection_ann_id, node_name=None, attributes=None
+):
+    """Add a node annotation to an image describing its role in the collection.
+    Returns the created annotation id.
+    """
+    kv = _node_kv(node_type, collection_ann_id, node_name, attributes)
 
-    image = conn.getObject("Image", image_id)
+    image = _get_image(conn, image_id)
     if image is None:
         raise ValueError(f"Image {image_id} not found")
 
     ann = _create_map_annotation(conn, kv, NS_NODE)
     image.linkAnnotation(ann)
+    invalidate(conn, ("anns", image_id, NS_NODE))
     return ann.getId()
 
     ann = _create_map_annotation(conn, kv, NS_NODE)
@@ -144,53 +350,322 @@ def _add_node_annotation(
     return ann.getId()
 
 
+@traced_operation("bulk_add_node_annotations")
+def _bulk_add_node_annotations(conn, nodes, chunk_size=500, add_links=True):
+    """Link images to their collections and add their node annotations in bulk.
+
+    All MapAnnotationI and ImageAnnotationLinkI objects are built on the client and saved
+    with one `saveAndReturnArray` call per chunk, so every chunk is written in one transaction.
+    Images that are already linked to their collection only get the node annotation.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        nodes: Iterable of dicts with the keys "image_id", "collection_id" and "type",
+            and optionally "name" and "attributes".
+        chunk_size: Number of nodes saved per server call.
+        add_links: Whether to add the image URL as link of the node right away,
+            instead of appending it afterwards via `_bulk_append_links`. URLs that are already
+            links of the image, e.g. of its node in another collection, are not added again.
+
+    Returns:
+        Dict mapping each image id to the id of its new node annotation.
+    """
+    update_service = conn.getUpdateService()
+    node_ann_ids = {}
+
+    def _save_chunk(chunk):
+        params = ParametersI()
+        params.add("cids", rlist([rlong(cid) for cid in {node["collection_id"] for node in chunk}]))
+        params.addIds(list({node["image_id"] for node in chunk}))
+        existing = {tuple(row) for row in _projection(conn, _EXISTING_COLLECTION_LINKS_QUERY, params)}
+        existing_links = set()
+        if add_links:
+            # Like `_bulk_append_links`, skip the image URLs that are already links of the image.
+            link_params = ParametersI()
+            link_params.addIds(list({node["image_id"] for node in chunk}))
+            link_params.addString("ns", NS_LINK)
+            existing_links = {tuple(row) for row in _projection(conn, _LINKS_OF_IMAGES_QUERY, link_params)}
+
+        # The saved links come back in the order they were sent, remember where the nodes are.
+        links, node_positions = [], []
+        for node in chunk:
+            image_id, coll_id = node["image_id"], node["collection_id"]
+            if (coll_id, image_id) not in existing:
+                existing.add((coll_id, image_id))
+                coll_link = ImageAnnotationLinkI()
+                coll_link.setParent(ImageI(image_id, False))
+                coll_link.setChild(MapAnnotationI(coll_id, False))
+                links.append(coll_link)
+
+            kv = _node_kv(node["type"], coll_id, node.get("name"), node.get("attributes"))
+            url = _build_image_url(image_id)
+            if add_links and "attributes.link" not in kv and (image_id, url) not in existing_links:
+                existing_links.add((image_id, url))
+                links.append(_link_annotation(image_id, url))
+            ann = MapAnnotationI()
+            ann.setNs(rstring(NS_NODE))
+            ann.setMapValue([NamedValue(str(k), str(v)) for k, v in kv.items()])
+
+            node_link = ImageAnnotationLinkI()
+            node_link.setParent(ImageI(image_id, False))
+            node_link.setChild(ann)
+            node_positions.append((image_id, len(links)))
+            links.append(node_link)
+
+        saved = update_service.saveAndReturnArray(links)
+        for image_id, position in node_positions:
+            node_ann_ids[image_id] = saved[position].getChild().getId().getValue()
+
+        for node in chunk:
+            invalidate(
+                conn,
+                ("anns", node["image_id"], NS_COLLECTION),
+                ("anns", node["image_id"], NS_NODE),
+                ("anns", node["image_id"], NS_LINK),
+                ("members", node["collection_id"]),
+            )
+
+    chunk = []
+    for node in nodes:
+        chunk.append(node)
+        if len(chunk) == chunk_size:
+            _save_chunk(chunk)
+            chunk = []
+    if chunk:
+        _save_chunk(chunk)
+
+    return node_ann_ids
+
+
 def _get_collection_members(conn, collection_ann_id):
     """Get all images linked to a collection annotation.
     """
-    images = conn.getObjectsByAnnotations("Image", [collection_ann_id])
-    return [img.getId() for img in images]
+    def _load():
+        images = conn.getObjectsByAnnotations("Image", [collection_ann_id])
+        return [img.getId() for img in images]
+
+    return cached(conn, ("members", collection_ann_id), _load)
 
 
 def _get_node_info(conn, image_id):
     """Get the node annotation (first one) for an image.
     Returns a dict or None.
     """
-    img = conn.getObject("Image", image_id)
-    if img is None:
-        return None
-
-    anns = list(img.listAnnotations(ns=NS_NODE))
-    for ann in anns:
-        return _map_ann_to_dict(ann)
+    for _, kv in _list_map_annotations(conn, image_id, NS_NODE):
+        return kv
     return None
 
 
-def _get_collections(conn, image_id):
-    """Get all collections an image is part of.
-    Returns a list of dicts of how collections metadata should look like.
+def _projection(conn, query, params):
+    """Run a projection query and return the rows as lists of plain python values.
+    """
+    qs = conn.getQueryService()
+    rows = qs.projection(query, params, conn.SERVICE_OPTS)
+    return [unwrap(row) for row in rows]
+
+
+def _rows_to_maps(rows):
+    """Group (owner_id, ann_id, key, value) rows into {owner_id: {ann_id: kv_dict}}.
+    Insertion order follows the row order, i.e. the first annotation id comes first.
+    """
+    maps = {}
+    for owner_id, ann_id, key, value in rows:
+        maps.setdefault(owner_id, {}).setdefault(ann_id, {})[key] = value
+    return maps
+
+
+def _cache_lookup(conn, key):
+    cache = get_cache(conn)
+    return None if cache is None else cache.get(key)
+
+
+def _cache_store(conn, key, value):
+    cache = get_cache(conn)
+    if cache is not None:
+        cache.put(key, value)
+
+
+def _members_from_rows(collection_ids, member_rows):
+    """Group (collection_id, image_id) link rows into {collection_id: [image ids]}.
+    Keeps the link order, but drops duplicated links of the same image.
+    """
+    members = {coll_id: {} for coll_id in collection_ids}
+    for coll_id, member_id in member_rows:
+        members[coll_id].setdefault(member_id, None)
+    return {coll_id: list(member_ids) for coll_id, member_ids in members.items()}
+
+
+def _resolve_members(conn, collection_ids):
+    """Resolve the members of the given collections and all node annotations of the members.
+
+    Needs at most two projection queries: the image links of the collections and the node
+    map values of all members. Cached entries are not queried and query results are cached.
+
+    Returns:
+        Dict {collection_id: [member image ids]} and dict {image_id: [(node ann id, kv dict)]}.
     """
-    img = conn.getObject("Image", image_id)
-    if img is None:
+    members_by_coll = {coll_id: _cache_lookup(conn, ("members", coll_id)) for coll_id in collection_ids}
+    missing_colls = [coll_id for coll_id, members in members_by_coll.items() if members is None]
+    if missing_colls:
+        params = ParametersI()
+        params.add("cids", rlist([rlong(coll_id) for coll_id in missing_colls]))
+        member_rows = _projection(conn, _MEMBERS_OF_COLLECTIONS_QUERY, params)
+
+        for coll_id, members in _members_from_rows(missing_colls, member_rows).items():
+            members_by_coll[coll_id] = members
+            _cache_store(conn, ("members", coll_id), members)
+
+    member_ids = sorted({mid for mids in members_by_coll.values() for mid in mids})
+    return members_by_coll, _resolve_nodes(conn, member_ids)
+
+
+def _resolve_nodes(conn, image_ids):
+    """Get the node annotations of the images with at most one projection query.
+    Returns dict {image_id: [(node ann id, kv dict)]}.
+    """
+    nodes_by_image = {mid: _cache_lookup(conn, ("anns", mid, NS_NODE)) for mid in image_ids}
+    missing_nodes = [mid for mid, anns in nodes_by_image.items() if anns is None]
+    if missing_nodes:
+        params = ParametersI()
+        params.addIds(missing_nodes)
+        params.addString("ns", NS_NODE)
+        node_maps = _rows_to_maps(_projection(conn, _NODES_OF_IMAGES_QUERY, params))
+        for mid in missing_nodes:
+            nodes_by_image[mid] = list(node_maps.get(mid, {}).items())
+            _cache_store(conn, ("anns", mid, NS_NODE), nodes_by_image[mid])
+    return nodes_by_image
+
+
+def _as_list(values):
+    return None if values is None else [values] if isinstance(values, str) else list(values)
+
+
+def _filtered_member_rows(conn, collection_ids, node_types=None, node_names=None, after=None, limit=None):
+    """The (collection id, image id) of the members whose node in the collection has one of the
+    given types and names, ordered by image id. Filtering happens on the server.
+    """
+    node_types, node_names = _as_list(node_types), _as_list(node_names)
+    params = ParametersI()
+    params.add("cids", rlist([rlong(coll_id) for coll_id in collection_ids]))
+    if node_types is not None or node_names is not None:
+        params.addString("ns", NS_NODE)
+    if node_types is not None:
+        params.add("types", rlist([rstring(node_type) for node_type in node_types]))
+    if node_names is not None:
+        params.add("names", rlist([rstring(node_name) for node_name in node_names]))
+    if after is not None:
+        params.addLong("after", after)
+    if limit is not None:
+        params.page(0, limit)
+    query = _filtered_members_query(node_types is not None, node_names is not None, after is not None)
+    return _projection(conn, query, params)
+
+
+def _filtered_members(conn, collection_ids, node_types=None, node_names=None):
+    """Resolve the members of the collections with the given node types and names.
+
+    Needs two projection queries: the filtered member ids and the node map values of the
+    matching members only.
+
+    Returns:
+        List of (collection_id, image_id, node kv dict) tuples, ordered by image id.
+    """
+    rows = _filtered_member_rows(conn, collection_ids, node_types, node_names)
+    nodes_by_image = _resolve_nodes(conn, sorted({mid for _, mid in rows}))
+    return [(coll_id, mid, _node_for_collection(nodes_by_image[mid], coll_id)) for coll_id, mid in rows]
+
+
+def iter_collection_members(conn, collection_id, node_type=None, node_name=None, page_size=1000):
+    """Iterate over the members of a collection page by page, filtered on the server.
+
+    Only one page of members and their node annotations is held in memory, and the first
+    members are yielded after two projection queries, however large the collection is.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        collection_id: The id of the collection annotation.
+        node_type: A node type or a list of node types to select, e.g. "Labels".
+        node_name: A node name or a list of node names to select.
+        page_size: Number of members fetched per page.
+
+    Yields:
+        Dicts with the 'image_id', 'collection_id' and 'nodes' (the node kv dict) of the members.
+    """
+    after = 0
+    while True:
+        rows = _filtered_member_rows(conn, [collection_id], node_type, node_name, after=after, limit=page_size)
+        if not rows:
+            return
+        member_ids = [mid for _, mid in rows]
+        nodes_by_image = _resolve_nodes(conn, member_ids)
+        for mid in member_ids:
+            yield {
+                "image_id": mid,
+                "collection_id": collection_id,
+                "nodes": _node_for_collection(nodes_by_image[mid], collection_id),
+            }
+        if len(rows) < page_size:
+            return
+        after = member_ids[-1]
+
+
+def _node_for_collection(node_anns, collection_id):
+    """Pick the node annotation that belongs to the collection, falling back to the first one.
+    """
+    for _, kv in node_anns:
+        if kv.get("collection_id") == str(collection_id):
+            return kv
+    return node_anns[0][1] if node_anns else None
+
+
+def _collection_annotations(conn, image_id):
+    """Get the collection annotations of an image with at most one projection query.
+    Returns a list of (collection ann id, kv dict).
+    """
+    coll_anns = _cache_lookup(conn, ("anns", image_id, NS_COLLECTION))
+    if coll_anns is None:
+        params = ParametersI()
+        params.addLong("iid", image_id)
+        params.addString("ns", NS_COLLECTION)
+        coll_rows = _projection(conn, _COLLECTIONS_OF_IMAGE_QUERY, params)
+        coll_anns = list(_rows_to_maps([(image_id, *row) for row in coll_rows]).get(image_id, {}).items())
+        if coll_anns:
+            _cache_store(conn, ("anns", image_id, NS_COLLECTION), coll_anns)
+    return coll_anns
+
+
+def _resolve_collections(conn, image_id):
+    """Resolve all collections of an image, their members and the members' node info.
+
+    This needs at most three projection queries, independent of the number of collections
+    and members: the collection annotations of the image, the image links of these collections
+    and the node map values of all members. Entries found in the metadata cache are not queried,
+    and the query results are written to the cache.
+
+    Returns the same structure as `_get_collections`.
+    """
+    coll_anns = _collection_annotations(conn, image_id)
+    if not coll_anns:
         return []
 
-    coll_anns = list(img.listAnnotations(ns=NS_COLLECTION))
+    members_by_coll, nodes_by_image = _resolve_members(conn, [coll_id for coll_id, _ in coll_anns])
+    return _assemble_collections(coll_anns, members_by_coll, nodes_by_image)
 
-    collections = []
-    for coll_ann in coll_anns:
-        coll_ann_id = coll_ann.getId()
-        coll_info = _map_ann_to_dict(coll_ann)
 
-        member_ids = _get_collection_members(conn, coll_ann_id)
+def _assemble_collections(coll_anns, members_by_coll, nodes_by_image):
+    """Build the `_get_collections` structure from the resolved annotations and members.
+    """
+    collections = []
+    for coll_id, coll_info in coll_anns:
         members = []
-        for member_id in member_ids:
-            node_info = _get_node_info(conn, member_id)
+        for member_id in members_by_coll[coll_id]:
             members.append({
                 "image_id": member_id,
-                "nodes": node_info,
+                "nodes": _node_for_collection(nodes_by_image[member_id], coll_id),
             })
 
         collections.append({
-            "collection_id": coll_ann_id,
+            "collection_id": coll_id,
             "name": coll_info.get("name"),
             "version": coll_info.get("version"),
             "members": members,
@@ -199,14 +674,51 @@ def _get_collections(conn, image_id):
     return collections
 
 
-def _find_related_images(conn, image_id, node_type=None):
+@traced_operation("get_collections")
+def _get_collections(conn, image_id):
+    """Get all collections an image is part of.
+    Returns a list of dicts of how collections metadata should look like.
+    """
+    return _resolve_collections(conn, image_id)
+
+
+@traced_operation("find_related_images")
+def _find_related_images(conn, image_id, node_type=None, graph=None):
     """Given an image, find all related images in the same collection(s).
     Optionally filter by node_type (e.g., "label", "multiscale").
+    With a `biohack_utils.graph.CollectionGraph` the query is answered from the graph,
+    whose nodes only hold the type and name. Otherwise the node type is filtered on the server,
+    so only the node annotations of matching members are transferred.
 
     Returns list of dicts
     """
-    collections = _get_collections(conn, image_id)
+    if graph is not None:
+        image_ids, coll_ids, type_codes, name_codes = graph.related_images(image_id, node_type)
+        return [
+            {
+                "image_id": int(mid),
+                "collection_id": int(coll_id),
+                "nodes": {"type": graph.types[type_code], "name": graph.names[name_code]} if type_code else None,
+            }
+            for mid, coll_id, type_code, name_code in zip(image_ids, coll_ids, type_codes, name_codes)
+        ]
+
+    if node_type is None:
+        return _related_members(_get_collections(conn, image_id), image_id, node_type)
+
+    coll_ids = [coll_id for coll_id, _ in _collection_annotations(conn, image_id)]
+    if not coll_ids:
+        return []
+    return [
+        {"image_id": mid, "collection_id": coll_id, "nodes": node_info}
+        for coll_id, mid, node_info in _filtered_members(conn, coll_ids, node_types=[node_type])
+        if mid != image_id
+    ]
 
+
+def _related_members(collections, image_id, node_type=None):
+    """Collect the other members of the collections, see `_find_related_images`.
+    """
     related = []
     for coll in collections:
         coll_id = coll["collection_id"]
@@ -225,21 +737,35 @@ def _find_related_images(conn, image_id, node_type=None):
     return related
 
 
+@traced_operation("find_images_with_collection_id_in_dataset")
 def _find_images_with_collection_id_in_dataset(
     conn,
     collection_id,
     dataset_id,
     node_type=None,
     limit=None,
+    index=None,
 ):
     """
     Find images in a given dataset that are members of a collection
     (identified by collection_id) and optionally have a given node_type.
 
+    If a `biohack_utils.index.CollectionIndex` is given, it is synced and the
+    lookup is answered from the index instead of listing the dataset.
+
     Returns a list of tuples:
         (image_id, image_name, collection_id)
     where collection_id is the collection annotation ID.
     """
+    if index is not None:
+        index.sync(conn)
+        images = [
+            (mid, name, int(collection_id))
+            for mid, name, _, _ in index.members(collection_id, node_type=node_type, dataset_id=dataset_id, limit=limit)
+        ]
+        print(f"Found {len(images)} images with collection_id={collection_id} in dataset {dataset_id}")
+        return images
+
     dataset = conn.getObject("Dataset", dataset_id)
     if dataset is None:
         print(f"Dataset {dataset_id} not found")
@@ -265,7 +791,7 @@ def _find_images_with_collection_id_in_dataset(
         img = dataset_by_id[mid]
 
         if node_type is not None:
-            node_info = _get_node_info(conn, mid)
+            node_info = _node_for_collection(_list_map_annotations(conn, mid, NS_NODE), collection_id)
             if not node_info or node_info.get("type") != node_type:
                 continue
 
@@ -280,57 +806,98 @@ def _find_images_with_collection_id_in_dataset(
     return images
 
 
-def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_type="Labels"):
-    """Fetch label data for a given raw image using collections/nodes.
+def _lazy_image(conn, img, prefetch_workers=2, multiscale=True):
+    """The image as a list of lazy arrays, one per resolution level, or only the full resolution array.
+    """
+    from .pixels import get_pyramid_lazy
+
+    pyramid = get_pyramid_lazy(conn, img, prefetch_workers)
+    return pyramid if multiscale else pyramid[0]
 
-    Returns the raw and label array data.
+
+@traced_operation("fetch_collection_layers")
+def fetch_collection_layers(
+    conn, image_id, node_types=("Labels",), prefetch_workers=2, load_raw=True, multiscale=True,
+):
+    """Fetch the members of all requested node types for a given raw image in a single pass.
+
+    The collection graph is resolved once, with the node types filtered on the server, and every
+    member is loaded lazily as (t, c, z, y, x) dask arrays built from the server's resolution levels.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image_id: The id of the raw image.
+        node_types: The node types to load, e.g. ("Labels", "Intensities"). `None` loads all members.
+        prefetch_workers: Number of threads prefetching neighbouring tiles per resolution level.
+        load_raw: Whether to open the raw image, which costs a few server calls. If not, the
+            raw data is None.
+        multiscale: Whether to return the list of all resolution levels of every image, or only
+            the full resolution array.
+
+    Returns:
+        The raw data and a dict {node_type: {node_name: data}}.
     """
-    raw_img = conn.getObject("Image", image_id)
+    raw_img = _get_image(conn, image_id)
     if raw_img is None:
         raise ValueError(f"Image {image_id} not found")
 
-    collections = _get_collections(conn, image_id)
-    if not collections:
+    coll_anns = _collection_annotations(conn, image_id)
+    if not coll_anns:
         raise RuntimeError("Image is not part of any collection (namespace NS_COLLECTION).")
 
-    labels_dict = {}
+    layers = {} if node_types is None else {node_type: {} for node_type in node_types}
 
-    # Go through ALL collections this image is in
-    for coll in collections:
-        coll_id = coll["collection_id"]
-        print(f"Processing collection {coll_id} (name={coll.get('name')})")
+    # The members of ALL collections this image is in.
+    if node_types is None:
+        members = [
+            (coll["collection_id"], member["image_id"], member["nodes"])
+            for coll in _get_collections(conn, image_id) for member in coll["members"]
+        ]
+    else:
+        # Filter by node type, e.g. "Labels", on the server.
+        members = _filtered_members(conn, [coll_id for coll_id, _ in coll_anns], node_types=list(node_types))
 
-        for member in coll["members"]:
-            mid = member["image_id"]
-            node_info = member["nodes"] or {}
+    for coll_id, mid, node_info in members:
+        node_info = node_info or {}
+        node_type = node_info.get("type")
 
-            # Skip the raw image itself
-            if mid == image_id:
-                continue
+        # Skip the raw image itself
+        if mid == image_id:
+            continue
 
-            # Filter by node type, e.g. "Labels"
-            if label_node_type is not None and node_info.get("type") != label_node_type:
-                continue
+        img = _get_image(conn, mid)
+        if img is None:
+            continue
 
-            img = conn.getObject("Image", mid)
-            if img is None:
-                continue
+        # Use node "name" as key; fall back to image id
+        node_name = node_info.get("name") or f"image_{mid}"
+        print(f"Found {node_type} image: ID={mid}, node_name='{node_name}' in collection {coll_id}")
 
-            # Use node "name" as key; fall back to image id
-            node_name = node_info.get("name") or f"image_{mid}"
-            print(f"Found label image: ID={mid}, node_name='{node_name}'")
+        layers.setdefault(node_type, {})[node_name] = _lazy_image(conn, img, prefetch_workers, multiscale)
 
-            from napari_omero.plugins.loaders import get_data_lazy
-            label_array = get_data_lazy(img)
+    raw_data = _lazy_image(conn, raw_img, prefetch_workers, multiscale) if load_raw else None
+    return raw_data, layers
 
-            labels_dict[node_name] = label_array
+
+@traced_operation("fetch_omero_labels_in_napari")
+def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_type="Labels", multiscale=False):
+    """Fetch label data for a given raw image using collections/nodes.
+
+    Returns the raw and label array data as lazy full resolution arrays, or as multiscale lists
+    of them if `multiscale` is set.
+    """
+    node_types = None if label_node_type is None else [label_node_type]
+    _, layers = fetch_collection_layers(conn, image_id, node_types, load_raw=False, multiscale=multiscale)
+
+    labels_dict = {}
+    for node_layers in layers.values():
+        labels_dict.update(node_layers)
 
     if not labels_dict:
         return labels_dict
 
-    raw_data = get_data_lazy(raw_img)
-
     if return_raw:
-        return raw_data, labels_dict
+        # The raw image is only opened when there are labels to return with it.
+        return _lazy_image(conn, _get_image(conn, image_id), multiscale=multiscale), labels_dict
     else:
         return labels_dict
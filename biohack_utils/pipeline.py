@@ -0,0 +1,309 @@
+"""Concurrent fetch -> segment -> upload -> annotate pipeline for OMERO images.
+
+Each stage runs in its own thread(s) and the stages are connected by bounded queues,
+so that network I/O (download, upload, annotation) overlaps with the inference. A connection
+must not be used by several threads at once, so the download and upload workers borrow their
+connections from a `session.ConnectionPool`.
+"""
+import queue
+import threading
+import time
+
+from . import omero_annotation
+
+
+_DONE = object()
+
+
+class StageMetrics:
+    """Throughput metrics of a single pipeline stage.
+    """
+    def __init__(self, name, n_workers):
+        self.name = name
+        self.n_workers = n_workers
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.start = None
+        self.stop = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds, n_items=1, failed=False):
+        with self._lock:
+            now = time.perf_counter()
+            if self.start is None:
+                self.start = now - seconds
+            self.stop = now
+            self.items += n_items
+            self.busy += seconds
+            if failed:
+                self.errors += n_items
+
+    def summary(self):
+        wall = 0.0 if self.start is None else self.stop - self.start
+        return {
+            "stage": self.name,
+            "workers": self.n_workers,
+            "items": self.items,
+            "errors": self.errors,
+            "busy_seconds": self.busy,
+            "wall_seconds": wall,
+            "items_per_second": self.items / wall if wall > 0 else 0.0,
+            # Fraction of the time the workers of this stage were busy.
+            "utilization": self.busy / (wall * self.n_workers) if wall > 0 else 0.0,
+        }
+
+
+def _fetch_plane(conn, image_id, channel=0):
+    from .util import _omero_image_to_2d_array
+
+    img = conn.getObject("Image", image_id)
+    if img is None:
+        raise ValueError(f"Image {image_id} not found")
+    return _omero_image_to_2d_array(img, z=0, c=channel, t=0)
+
+
+def _upload_labels(conn, image_id, labels, dataset_id=None):
+    from .util import _upload_image
+
+    dataset = None if dataset_id is None else conn.getObject("Dataset", dataset_id)
+    return _upload_image(conn, labels, f"segmentation_{image_id}", dataset=dataset)
+
+
+def _annotate_batch(
+    conn, pairs, collection_name, version, raw_node=("Intensities", "Raw"), label_node=("Labels", "Segmentation"),
+):
+    """Create one collection per (raw image, label image) pair with two server calls per batch.
+    Returns the collection ids.
+    """
+    coll_ids = omero_annotation._create_collections(conn, [collection_name] * len(pairs), version)
+    nodes = []
+    for (raw_id, label_id), coll_id in zip(pairs, coll_ids):
+        nodes.append({"image_id": raw_id, "collection_id": coll_id, "type": raw_node[0], "name": raw_node[1]})
+        nodes.append({"image_id": label_id, "collection_id": coll_id, "type": label_node[0], "name": label_node[1]})
+    omero_annotation._bulk_add_node_annotations(conn, nodes)
+    return coll_ids
+
+
+def _worker(stage, process, in_q, out_q, metrics, finished):
+    while True:
+        item = in_q.get()
+        if item is _DONE:
+            break
+
+        if item.get("error") is None:
+            t0 = time.perf_counter()
+            try:
+                process(item)
+                failed = False
+            except Exception as e:
+                item["error"] = f"{stage}: {e!r}"
+                failed = True
+            metrics.record(time.perf_counter() - t0, failed=failed)
+
+        out_q.put(item)
+    finished()
+
+
+def _start_stage(stage, process, n_workers, in_q, out_q, n_consumers, metrics):
+    """Start the workers of a stage. The last worker to finish forwards the end signal.
+    """
+    remaining = [n_workers]
+    lock = threading.Lock()
+
+    def _finished():
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(n_consumers):
+                out_q.put(_DONE)
+
+    threads = [
+        threading.Thread(
+            target=_worker, args=(stage, process, in_q, out_q, metrics, _finished),
+            name=f"{stage}-{i}", daemon=True,
+        )
+        for i in range(n_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_segmentation_pipeline(
+    conn,
+    image_ids,
+    segment,
+    fetch=None,
+    upload=None,
+    annotate=None,
+    n_download=4,
+    n_upload=4,
+    max_in_flight=8,
+    annotation_batch_size=32,
+    annotation_timeout=1.0,
+    collection_name="segmentation",
+    version="0.0.1",
+    channel=0,
+    dataset_id=None,
+    pool=None,
+):
+    """Segment OMERO images and register the results as collections, with overlapping stages.
+
+    The stages are: a download pool, a single inference worker, an upload pool and an annotation
+    stage that writes the collections in batches. At most `max_in_flight` images are between
+    download and annotation at any time, so that a slow stage holds back the faster ones.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image_ids: The ids of the raw images.
+        segment: Callable mapping the fetched image array to a label array.
+        fetch: Callable `fetch(image_id) -> array`. By default the plane of `channel` at z=0, t=0 is fetched.
+        upload: Callable `upload(image_id, labels) -> label image id`.
+            By default the labels are uploaded as 'segmentation_<image_id>' to `dataset_id`.
+        annotate: Callable `annotate(pairs) -> collection ids` for a list of (raw id, label id) pairs.
+            By default one collection per pair is created in bulk.
+        n_download: Number of download threads.
+        n_upload: Number of upload threads.
+        max_in_flight: Maximal number of images in the pipeline at once.
+        annotation_batch_size: Maximal number of pairs annotated with one batch.
+        annotation_timeout: Time in seconds after which an incomplete batch is annotated anyway.
+        collection_name: Name of the created collections.
+        version: Version of the created collections.
+        channel: The channel fetched by the default `fetch`.
+        dataset_id: The dataset the default `upload` puts the label images in.
+        pool: A `biohack_utils.session.ConnectionPool` for the default `fetch` and `upload`.
+            By default a pool joined to the session of `conn` with one connection per download
+            and upload thread is created and closed at the end. `conn` is only used by the
+            annotation stage, which runs in the calling thread.
+
+    Returns:
+        List of dicts with the keys "image_id", "label_id", "collection_id" and "error",
+        one per image in the order they finished, and the per-stage metrics.
+    """
+    own_pool = pool is None and (fetch is None or upload is None)
+    if own_pool:
+        from .session import ConnectionPool
+        pool = ConnectionPool.from_connection(conn, size=n_download + n_upload)
+
+    if fetch is None:
+        from .tile_cache import attach_tile_cache, get_tile_cache
+        tile_cache = get_tile_cache(conn)
+
+        def fetch(image_id):
+            with pool.connection() as pool_conn:
+                # The pooled connections read through the tile cache of `conn`, which is thread-safe.
+                if tile_cache is not None and get_tile_cache(pool_conn) is not tile_cache:
+                    attach_tile_cache(pool_conn, tile_cache)
+                return _fetch_plane(pool_conn, image_id, channel)
+    if upload is None:
+        def upload(image_id, labels):
+            with pool.connection() as pool_conn:
+                return _upload_labels(pool_conn, image_id, labels, dataset_id)
+    if annotate is None:
+        def annotate(pairs):
+            return _annotate_batch(conn, pairs, collection_name, version)
+
+    # A batch can never be larger than the number of images in flight.
+    annotation_batch_size = min(annotation_batch_size, max_in_flight)
+
+    try:
+        return _run_stages(
+            image_ids, fetch, segment, upload, annotate, n_download, n_upload, max_in_flight,
+            annotation_batch_size, annotation_timeout,
+        )
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def _run_stages(
+    image_ids, fetch, segment, upload, annotate, n_download, n_upload, max_in_flight, annotation_batch_size,
+    annotation_timeout,
+):
+    """Run the stages, the annotation stage in the calling thread, see `run_segmentation_pipeline`.
+    """
+    metrics = {
+        "download": StageMetrics("download", n_download),
+        "segment": StageMetrics("segment", 1),
+        "upload": StageMetrics("upload", n_upload),
+        "annotate": StageMetrics("annotate", 1),
+    }
+
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    download_q = queue.Queue(maxsize=max_in_flight)
+    segment_q = queue.Queue(maxsize=max_in_flight)
+    upload_q = queue.Queue(maxsize=max_in_flight)
+    annotate_q = queue.Queue(maxsize=max_in_flight)
+
+    def _download(item):
+        item["data"] = fetch(item["image_id"])
+
+    def _segment(item):
+        item["labels"] = segment(item.pop("data"))
+
+    def _upload(item):
+        item["label_id"] = upload(item["image_id"], item.pop("labels"))
+
+    threads = []
+    threads += _start_stage("download", _download, n_download, download_q, segment_q, 1, metrics["download"])
+    threads += _start_stage("segment", _segment, 1, segment_q, upload_q, n_upload, metrics["segment"])
+    threads += _start_stage("upload", _upload, n_upload, upload_q, annotate_q, 1, metrics["upload"])
+
+    def _feed():
+        for image_id in image_ids:
+            in_flight.acquire()
+            download_q.put({"image_id": image_id, "label_id": None, "collection_id": None, "error": None})
+        for _ in range(n_download):
+            download_q.put(_DONE)
+
+    feeder = threading.Thread(target=_feed, name="feed", daemon=True)
+    feeder.start()
+
+    # The annotation stage runs in this thread.
+    results = []
+
+    def _flush(batch):
+        if not batch:
+            return
+        valid = [item for item in batch if item["error"] is None]
+        if valid:
+            t0 = time.perf_counter()
+            try:
+                coll_ids = annotate([(item["image_id"], item["label_id"]) for item in valid])
+                for item, coll_id in zip(valid, coll_ids):
+                    item["collection_id"] = coll_id
+                failed = False
+            except Exception as e:
+                for item in valid:
+                    item["error"] = f"annotate: {e!r}"
+                failed = True
+            metrics["annotate"].record(time.perf_counter() - t0, n_items=len(valid), failed=failed)
+
+        results.extend(batch)
+        for _ in batch:
+            in_flight.release()
+        batch.clear()
+
+    batch = []
+    while True:
+        try:
+            item = annotate_q.get(timeout=annotation_timeout)
+        except queue.Empty:
+            _flush(batch)
+            continue
+
+        if item is _DONE:
+            _flush(batch)
+            break
+
+        batch.append(item)
+        if len(batch) >= annotation_batch_size:
+            _flush(batch)
+
+    feeder.join()
+    for thread in threads:
+        thread.join()
+
+    return results, {name: stage.summary() for name, stage in metrics.items()}
@@ -0,0 +1,258 @@
+"""Tile-wise access to the pixel data of OMERO images, at all resolution levels.
+
+`PixelsSource` behaves like a read-only (t, c, z, y, x) numpy array of one resolution level.
+Tiles are fetched on demand through raw pixels stores (one per thread), kept in a small LRU
+cache and the neighbouring tiles of each request are prefetched in the background. If a
+`biohack_utils.tile_cache.TileCache` is attached to the connection, tiles are read from it first.
+"""
+import contextvars
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .tile_cache import get_tile_cache, image_version, tile_key
+
+
+_DTYPES = {
+    "bit": "uint8",
+    "int8": "int8",
+    "uint8": "uint8",
+    "int16": "int16",
+    "uint16": "uint16",
+    "int32": "int32",
+    "uint32": "uint32",
+    "float": "float32",
+    "double": "float64",
+}
+
+
+def _open_store(conn, pixels_id, resolution_level=None):
+    rps = conn.createRawPixelsStore()
+    rps.setPixelsId(pixels_id, False, conn.SERVICE_OPTS)
+    if resolution_level is not None:
+        rps.setResolutionLevel(resolution_level, conn.SERVICE_OPTS)
+    return rps
+
+
+def get_resolution_levels(conn, image):
+    """Return the (size_y, size_x) of all resolution levels of the image, full resolution first.
+    """
+    rps = _open_store(conn, image.getPixelsId())
+    try:
+        if rps.getResolutionLevels(conn.SERVICE_OPTS) <= 1:
+            return [(image.getSizeY(), image.getSizeX())]
+        return [(desc.sizeY, desc.sizeX) for desc in rps.getResolutionDescriptions(conn.SERVICE_OPTS)]
+    finally:
+        rps.close()
+
+
+def _normalize_key(key, shape):
+    """Turn a numpy-style index into one slice per axis and the axes to drop afterwards.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (len(shape) - len(key) + 1) + key[i + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    slices, drop = [], []
+    for axis, (k, size) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(size)
+            if step != 1:
+                raise IndexError("Only slices with step 1 are supported.")
+            slices.append(slice(start, max(start, stop)))
+        else:
+            k = int(k) + size if int(k) < 0 else int(k)
+            if not 0 <= k < size:
+                raise IndexError(f"Index {k} is out of bounds for axis {axis} with size {size}")
+            slices.append(slice(k, k + 1))
+            drop.append(axis)
+    return slices, tuple(drop)
+
+
+class PixelsSource:
+    """Read-only (t, c, z, y, x) array-like view of one resolution level of an OMERO image.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        image: The image wrapper.
+        level: The resolution level, 0 is the full resolution.
+        n_levels: The number of resolution levels of the image, see `get_resolution_levels`.
+        level_shape: The (size_y, size_x) of this level.
+        prefetch_workers: Number of threads fetching neighbouring tiles, 0 disables the prefetching.
+        max_tiles: Number of tiles kept in memory.
+    """
+    def __init__(self, conn, image, level=0, n_levels=1, level_shape=None, prefetch_workers=2, max_tiles=256):
+        self._conn = conn
+        self.pixels_id = image.getPixelsId()
+        self.image_id = image.getId()
+        self._version = image_version(image)
+        self.level = level
+        # The raw pixels store counts the resolution levels the other way round.
+        self._resolution_level = None if n_levels <= 1 else n_levels - 1 - level
+
+        size_y, size_x = level_shape or (image.getSizeY(), image.getSizeX())
+        self.shape = (image.getSizeT(), image.getSizeC(), image.getSizeZ(), size_y, size_x)
+        self.ndim = 5
+        self.dtype = np.dtype(_DTYPES[image.getPixelsType()])
+
+        self._local = threading.local()
+        self._stores = []
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()
+        self._pending = {}
+        self.max_tiles = max_tiles
+
+        rps = self._store()
+        tile_w, tile_h = rps.getTileSize(conn.SERVICE_OPTS)
+        self.tile_shape = (min(tile_h, size_y), min(tile_w, size_x))
+
+        self._executor = ThreadPoolExecutor(prefetch_workers) if prefetch_workers else None
+        self._finalizer = weakref.finalize(self, PixelsSource._close, self._stores, self._executor)
+
+    @property
+    def chunks(self):
+        return (1, 1, 1) + self.tile_shape
+
+    def _store(self):
+        rps = getattr(self._local, "rps", None)
+        if rps is None:
+            rps = _open_store(self._conn, self.pixels_id, self._resolution_level)
+            self._local.rps = rps
+            with self._lock:
+                self._stores.append(rps)
+        return rps
+
+    def _tile_region(self, ty, tx):
+        th, tw = self.tile_shape
+        y, x = ty * th, tx * tw
+        return x, y, min(tw, self.shape[4] - x), min(th, self.shape[3] - y)
+
+    def _read_tile(self, t, c, z, ty, tx):
+        x, y, w, h = self._tile_region(ty, tx)
+
+        def _fetch():
+            data = self._store().getTile(z, c, t, x, y, w, h, self._conn.SERVICE_OPTS)
+            return np.frombuffer(data, dtype=self.dtype.newbyteorder(">")).reshape(h, w).astype(self.dtype)
+
+        tile_cache = get_tile_cache(self._conn)
+        if tile_cache is None:
+            return _fetch()
+        key = tile_key(self.pixels_id, self._resolution_level, z, c, t, (x, y, w, h), self._version)
+        return tile_cache.get_or_fetch(key, _fetch)
+
+    def _fetch_tile(self, key):
+        try:
+            tile = self._read_tile(*key)
+        except Exception:
+            with self._lock:
+                self._pending.pop(key, None)
+            raise
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+            self._pending.pop(key, None)
+        return tile
+
+    def get_tile(self, t, c, z, ty, tx, prefetch=True):
+        """Return the tile at tile grid position (ty, tx) of the plane (t, c, z).
+        """
+        key = (t, c, z, ty, tx)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            future = self._pending.get(key)
+
+        if tile is None:
+            tile = future.result() if future is not None else self._fetch_tile(key)
+        if prefetch:
+            self._prefetch(t, c, z, ty, tx)
+        return tile
+
+    def _prefetch(self, t, c, z, ty, tx):
+        if self._executor is None:
+            return
+        n_ty = -(-self.shape[3] // self.tile_shape[0])
+        n_tx = -(-self.shape[4] // self.tile_shape[1])
+        for dy, dx in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+            ny, nx = ty + dy, tx + dx
+            if not (0 <= ny < n_ty and 0 <= nx < n_tx):
+                continue
+            key = (t, c, z, ny, nx)
+            with self._lock:
+                if key in self._tiles or key in self._pending:
+                    continue
+                # The prefetched calls are traced under the operation that triggered them.
+                self._pending[key] = self._executor.submit(contextvars.copy_context().run, self._fetch_tile, key)
+
+    def __getitem__(self, key):
+        slices, drop = _normalize_key(key, self.shape)
+        st, sc, sz, sy, sx = slices
+        out = np.zeros([sl.stop - sl.start for sl in slices], dtype=self.dtype)
+
+        th, tw = self.tile_shape
+        for t in range(st.start, st.stop):
+            for c in range(sc.start, sc.stop):
+                for z in range(sz.start, sz.stop):
+                    for ty in range(sy.start // th, -(-sy.stop // th)):
+                        for tx in range(sx.start // tw, -(-sx.stop // tw)):
+                            tile = self.get_tile(t, c, z, ty, tx)
+                            y0, x0 = max(sy.start, ty * th), max(sx.start, tx * tw)
+                            y1, x1 = min(sy.stop, (ty + 1) * th), min(sx.stop, (tx + 1) * tw)
+                            out[
+                                t - st.start, c - sc.start, z - sz.start,
+                                y0 - sy.start:y1 - sy.start, x0 - sx.start:x1 - sx.start,
+                            ] = tile[y0 - ty * th:y1 - ty * th, x0 - tx * tw:x1 - tx * tw]
+
+        return out.squeeze(axis=drop) if drop else out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    @staticmethod
+    def _close(stores, executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for rps in stores:
+            try:
+                rps.close()
+            except Exception:
+                pass
+        stores.clear()
+
+    def close(self):
+        self._finalizer()
+
+
+def get_pyramid_sources(conn, image, prefetch_workers=2, max_tiles=256):
+    """Return a `PixelsSource` for every resolution level of the image, full resolution first.
+    """
+    levels = get_resolution_levels(conn, image)
+    return [
+        PixelsSource(conn, image, level, len(levels), shape, prefetch_workers=prefetch_workers, max_tiles=max_tiles)
+        for level, shape in enumerate(levels)
+    ]
+
+
+def get_pyramid_lazy(conn, image, prefetch_workers=2, max_tiles=256):
+    """Return the image as a list of lazy (t, c, z, y, x) dask arrays, one per resolution level.
+
+    The chunks correspond to the server tiles, so napari only fetches the tiles in view.
+    """
+    import dask.array as da
+
+    return [
+        da.from_array(
+            source, chunks=source.chunks, asarray=False, fancy=False,
+            name=f"omero-pixels-{source.pixels_id}-{source.level}",
+        )
+        for source in get_pyramid_sources(conn, image, prefetch_workers, max_tiles)
+    ]
@@ -0,0 +1,184 @@
+"""Block-wise connected component labelling for volumes that don't fit into memory.
+
+The data is labelled block by block into a temporary file, the labels of objects that touch
+across block faces are merged with a union-find on the boundary pairs, and the result is read
+through a lookup table with the smallest data type that fits the number of objects.
+"""
+import itertools
+import tempfile
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+
+
+_LABEL_DTYPES = ("uint8", "uint16", "uint32", "uint64")
+
+
+def _minimal_dtype(max_value):
+    for dtype in _LABEL_DTYPES:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Too many objects: {max_value}")
+
+
+def _default_block_shape(shape):
+    side = 4096 if len(shape) == 2 else 256
+    return tuple(min(s, side) for s in shape)
+
+
+def _block_slices(shape, block_shape):
+    grid = [range(0, s, b) for s, b in zip(shape, block_shape)]
+    for start in itertools.product(*grid):
+        yield tuple(slice(st, min(st + b, s)) for st, b, s in zip(start, block_shape, shape))
+
+
+class RelabelledArray:
+    """Read-only array with the final labels, computed on access from the provisional labels.
+
+    Supports `shape`, `dtype` and numpy-style slicing, so it can be passed to
+    `biohack_utils.upload.upload_array` to stream the labels to OMERO.
+    """
+    def __init__(self, provisional, lut, tmp_file):
+        self._provisional = provisional
+        self._lut = lut
+        self._tmp_file = tmp_file
+        self.shape = provisional.shape
+        self.ndim = provisional.ndim
+        self.dtype = lut.dtype
+        self.n_objects = int(lut.max()) if lut.size else 0
+
+    def __getitem__(self, key):
+        return self._lut[self._provisional[key]]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        """Remove the temporary file with the provisional labels.
+        """
+        self._provisional = None
+        self._tmp_file.close()
+
+
+def _offsets(n_lateral, connectivity):
+    """The lateral offsets of neighbours across a face for the given connectivity.
+    Crossing the face is one step, so at most `connectivity - 1` lateral steps are allowed.
+    """
+    offsets = []
+    for offset in itertools.product((-1, 0, 1), repeat=n_lateral):
+        if sum(o != 0 for o in offset) <= connectivity - 1:
+            offsets.append(offset)
+    return offsets
+
+
+def _face_pairs(data, provisional, axis, boundary, core, offsets):
+    """Find the pairs of provisional labels with the same value that touch across a block face.
+
+    `core` are the slices of the block in all axes but `axis`. The voxels before the face are
+    compared with the neighbours after it, which may lie in the adjacent blocks.
+    """
+    shape = provisional.shape
+    lateral_axes = [ax for ax in range(len(shape)) if ax != axis]
+    lo = [max(sl.start - 1, 0) for sl in core]
+    hi = [min(sl.stop + 1, shape[ax]) for sl, ax in zip(core, lateral_axes)]
+
+    def _index(position, slices):
+        index = list(slices)
+        index.insert(axis, position)
+        return tuple(index)
+
+    before = _index(boundary - 1, core)
+    after = _index(boundary, [slice(l, h) for l, h in zip(lo, hi)])
+    labels_a, values_a = provisional[before], np.asarray(data[before])
+    labels_b, values_b = provisional[after], np.asarray(data[after])
+
+    pairs = []
+    for offset in offsets:
+        slices_a, slices_b = [], []
+        for sl, o, l, h in zip(core, offset, lo, hi):
+            size = sl.stop - sl.start
+            j0, j1 = max(0, l - sl.start - o), min(size, h - sl.start - o)
+            if j1 <= j0:
+                break
+            b0 = sl.start + j0 + o - l
+            slices_a.append(slice(j0, j1))
+            slices_b.append(slice(b0, b0 + j1 - j0))
+        else:
+            la, va = labels_a[tuple(slices_a)], values_a[tuple(slices_a)]
+            lb, vb = labels_b[tuple(slices_b)], values_b[tuple(slices_b)]
+            mask = (va == vb) & (va != 0)
+            if mask.any():
+                pairs.append(np.stack([la[mask], lb[mask]], axis=1))
+
+    if not pairs:
+        return None
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def relabel_blockwise(data, block_shape=None, connectivity=None, tmp_dir=None):
+    """Label the connected components of the data block by block.
+
+    Like `skimage.measure.label(data)`, neighbouring voxels with the same non-zero value form one
+    object. Peak memory is a few blocks plus one lookup table entry per provisional label; the
+    provisional labels are kept in a temporary file.
+
+    Args:
+        data: Array-like source with `shape`, `dtype` and numpy-style slicing.
+        block_shape: The shape of the blocks that are labelled at once.
+        connectivity: Maximal number of orthogonal steps between neighbours, by default `data.ndim`.
+        tmp_dir: Directory for the temporary file with the provisional labels.
+
+    Returns:
+        A `RelabelledArray` with consecutive labels in the smallest unsigned data type that
+        fits the number of objects (see `RelabelledArray.n_objects`).
+    """
+    shape = tuple(data.shape)
+    ndim = len(shape)
+    block_shape = block_shape or _default_block_shape(shape)
+    connectivity = connectivity or ndim
+
+    # Provisional labels are unique across blocks, so their number is bounded by the number of voxels.
+    tmp_dtype = "uint32" if np.prod(shape, dtype="uint64") < np.iinfo("uint32").max else "uint64"
+    tmp_file = tempfile.TemporaryFile(dir=tmp_dir)
+    provisional = np.memmap(tmp_file, dtype=tmp_dtype, mode="w+", shape=shape)
+
+    n_provisional = 0
+    for block_slice in _block_slices(shape, block_shape):
+        block_labels, n = label(np.asarray(data[block_slice]), background=0, connectivity=connectivity, return_num=True)
+        block_labels = block_labels.astype(tmp_dtype, copy=False)
+        block_labels[block_labels > 0] += n_provisional
+        provisional[block_slice] = block_labels
+        n_provisional += n
+    provisional.flush()
+
+    # Merge the objects that touch across block faces.
+    offsets = _offsets(ndim - 1, connectivity)
+    pairs = []
+    for axis in range(ndim):
+        lateral_shape = [s for ax, s in enumerate(shape) if ax != axis]
+        lateral_blocks = [b for ax, b in enumerate(block_shape) if ax != axis]
+        for boundary in range(block_shape[axis], shape[axis], block_shape[axis]):
+            for core in _block_slices(lateral_shape, lateral_blocks):
+                face_pairs = _face_pairs(data, provisional, axis, boundary, core, offsets)
+                if face_pairs is not None:
+                    pairs.append(face_pairs)
+
+    n_nodes = n_provisional + 1
+    if pairs:
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        graph = coo_matrix((np.ones(len(pairs), dtype="uint8"), (pairs[:, 0], pairs[:, 1])), shape=(n_nodes, n_nodes))
+        _, components = connected_components(graph, directed=False)
+    else:
+        components = np.arange(n_nodes)
+
+    # Consecutive final labels, background (provisional label 0) stays 0.
+    lut = np.zeros(n_nodes, dtype="uint64")
+    if n_provisional:
+        _, final = np.unique(components[1:], return_inverse=True)
+        lut[1:] = final + 1
+    lut = lut.astype(_minimal_dtype(int(lut.max())))
+
+    return RelabelledArray(provisional, lut, tmp_file)
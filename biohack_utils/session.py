@@ -0,0 +1,221 @@
+"""Reuse of OMERO sessions across processes and pools of connections joined to one session.
+
+The session key of a login is stored in a user-only readable file, so that later processes
+can join the session instead of logging in again. Joining skips the authentication, and
+the session stays alive on the server until it times out or is closed explicitly.
+"""
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_HOST = "omero-training.gerbi-gmb.de"
+DEFAULT_PORT = 4064  # Default OMERO port
+
+
+def _session_cache_path():
+    path = os.environ.get("BIOHACK_SESSION_CACHE")
+    if path:
+        return path
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "biohack_utils", "sessions.json")
+
+
+def _read_session_keys():
+    try:
+        with open(_session_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_session_keys(keys):
+    """Write the session keys atomically to a file that only the user can read.
+    """
+    path = _session_cache_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(keys, f)
+    os.replace(tmp_path, path)
+
+
+def _session_id(username, host, port):
+    return f"{username}@{host}:{port}"
+
+
+def _store_session_key(username, host, port, session_key):
+    keys = _read_session_keys()
+    keys[_session_id(username, host, port)] = session_key
+    _write_session_keys(keys)
+
+
+def forget_session(username, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Remove the cached session key of this user and server.
+    """
+    keys = _read_session_keys()
+    if keys.pop(_session_id(username, host, port), None) is not None:
+        _write_session_keys(keys)
+
+
+def _keep_session(conn, session_key, host, port, keepalive):
+    # Closing this connection must not close the shared session (see `close_connection`).
+    conn._biohack_session = (session_key, host, port)
+    if keepalive:
+        conn.c.enableKeepAlive(keepalive)
+    return conn
+
+
+def join_session(session_key, host=DEFAULT_HOST, port=DEFAULT_PORT, keepalive=60):
+    """Join an existing session. Returns the connection or None if the session is gone.
+    """
+    from omero.gateway import BlitzGateway
+
+    conn = BlitzGateway(host=host, port=port)
+    try:
+        connected = conn.connect(sUuid=session_key)
+    except Exception:
+        connected = False
+    if not connected:
+        return None
+    return _keep_session(conn, session_key, host, port, keepalive)
+
+
+def get_session_connection(username, password=None, host=DEFAULT_HOST, port=DEFAULT_PORT, keepalive=60):
+    """Return a connection that joins the cached session of this user, or log in and cache the session.
+
+    Args:
+        username: The OMERO user name.
+        password: The password, only needed if there is no valid cached session.
+        host: The OMERO server.
+        port: The OMERO port.
+        keepalive: Interval in seconds for the keepalive pings, `None` to disable them.
+    """
+    session_key = _read_session_keys().get(_session_id(username, host, port))
+    if session_key is not None:
+        conn = join_session(session_key, host, port, keepalive)
+        if conn is not None:
+            return conn
+
+    if password is None:
+        raise RuntimeError(f"No valid session for {_session_id(username, host, port)}, need a password to log in.")
+
+    from omero.gateway import BlitzGateway
+
+    conn = BlitzGateway(username, password, host=host, port=port)
+    if not conn.connect():
+        raise RuntimeError(f"Failed to connect to {host}:{port} as {username}")
+
+    # Keep the session alive on the server when this process exits.
+    conn.c.getSession().detachOnDestroy()
+    session_key = conn.getSession().getUuid().getValue()
+    _store_session_key(username, host, port, session_key)
+    return _keep_session(conn, session_key, host, port, keepalive)
+
+
+def close_connection(conn):
+    """Close the connection. Connections of a reused session leave the session open for others.
+    """
+    conn.close(hard=getattr(conn, "_biohack_session", None) is None)
+
+
+class ConnectionPool:
+    """Pool of connections that are all joined to the same session, for use from worker threads.
+
+    Connections are created lazily, up to `size`, and block `acquire` when all are in use.
+
+    Args:
+        session_key: The key of the session to join.
+        host: The OMERO server.
+        port: The OMERO port.
+        size: Maximal number of connections.
+        keepalive: Interval in seconds for the keepalive pings of each connection.
+    """
+    def __init__(self, session_key, host=DEFAULT_HOST, port=DEFAULT_PORT, size=4, keepalive=60):
+        self.session_key = session_key
+        self.host = host
+        self.port = port
+        self.size = size
+        self.keepalive = keepalive
+        self._idle = queue.LifoQueue()
+        self._created = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_connection(cls, conn, size=4, keepalive=60):
+        """Create a pool joined to the session of an existing connection.
+        """
+        if getattr(conn, "_biohack_session", None) is not None:
+            session_key, host, port = conn._biohack_session
+        else:
+            session_key, host, port = conn.getSession().getUuid().getValue(), conn.host, conn.port
+        return cls(session_key, host, port, size=size, keepalive=keepalive)
+
+    def acquire(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = len(self._created) < self.size
+            if can_create:
+                # Reserve the slot before connecting, connecting is slow.
+                self._created.append(None)
+
+        if not can_create:
+            return self._idle.get(timeout=timeout)
+
+        conn = join_session(self.session_key, self.host, self.port, self.keepalive)
+        with self._lock:
+            self._created.remove(None)
+            if conn is not None:
+                self._created.append(conn)
+        if conn is None:
+            raise RuntimeError("Could not join the session, it may have expired.")
+        return conn
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            conns = [conn for conn in self._created if conn is not None]
+            self._created = []
+        for conn in conns:
+            close_connection(conn)
+        self._idle = queue.LifoQueue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def _worker_pool(conn, pool=None, n_workers=4):
+    """The connection pool for `n_workers` threads that would otherwise share `conn`.
+
+    Yields the given pool, or a pool joined to the session of `conn` that is closed afterwards.
+    Yields None for a single worker, which can use `conn` itself.
+    """
+    if pool is not None or n_workers <= 1:
+        yield pool
+        return
+    own_pool = ConnectionPool.from_connection(conn, size=n_workers)
+    try:
+        yield own_pool
+    finally:
+        own_pool.close()
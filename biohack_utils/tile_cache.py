@@ -0,0 +1,267 @@
+"""Shared on-disk cache of pixel tiles.
+
+Tiles are keyed by the pixels id, resolution level, (z, c, t), tile region and the update event
+of the image, so a changed image never returns stale tiles. The tile data is stored once per
+content hash (e.g. all empty label tiles share one file) and an SQLite index maps the keys to the
+contents and records the last access for the LRU eviction. Several processes can share a cache
+directory: the index is opened in WAL mode and all changes of the index and the files happen
+in one write transaction.
+
+    cache = attach_tile_cache(conn)
+    ...  # PixelsSource and util._omero_image_to_2d_array read through the cache
+    print(cache.stats())
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+
+_SCHEMA = """
+create table if not exists meta (key text primary key, value integer);
+create table if not exists tiles (
+    key text primary key, hash text, dtype text, shape text, last_access real
+);
+create table if not exists blobs (hash text primary key, size integer, refs integer);
+create index if not exists tiles_access on tiles (last_access);
+create index if not exists tiles_hash on tiles (hash);
+insert or ignore into meta values ('bytes', 0);
+"""
+
+
+def default_tile_cache_path(host):
+    """The default cache directory for an OMERO server, next to the session cache.
+    """
+    path = os.environ.get("BIOHACK_TILE_CACHE_DIR")
+    if not path:
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        path = os.path.join(cache_dir, "biohack_utils", "tiles")
+    return os.path.join(path, host)
+
+
+def tile_key(pixels_id, level, z, c, t, region, version):
+    """The cache key of a tile. `region` is (x, y, width, height), `level` None for single resolution images.
+    """
+    x, y, w, h = region
+    return f"{pixels_id}/{-1 if level is None else level}/{version}/{z}/{c}/{t}/{x},{y},{w},{h}"
+
+
+def image_version(image):
+    """The id of the last update event of the image or its pixels, 0 if it is not loaded.
+    """
+    version = 0
+    objects = [image._obj]
+    pixels = getattr(image._obj, "_pixelsSeq", None)
+    if pixels:
+        objects.append(pixels[0])
+    for obj in objects:
+        try:
+            event = obj.getDetails().getUpdateEvent()
+            version = max(version, event.getId().getValue())
+        except AttributeError:
+            pass
+    return version
+
+
+class TileCache:
+    """LRU cache of pixel tiles in a directory, safe to share between threads and processes.
+
+    Args:
+        path: The cache directory, see `default_tile_cache_path`.
+        max_bytes: Maximal size of the stored tiles, the least recently used ones are evicted first.
+        compression_level: The zlib compression level of the stored tiles.
+    """
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, compression_level=1):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(path, "index.sqlite"), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("pragma synchronous=normal")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def for_connection(cls, conn, **kwargs):
+        """Open the cache of the server this connection is connected to at its default location.
+        """
+        return cls(default_tile_cache_path(conn.host), **kwargs)
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock right away, so that concurrent writers wait instead of failing.
+        self._db.execute("begin immediate")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("rollback")
+            raise
+        self._db.execute("commit")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, "blobs", digest[:2], digest[2:])
+
+    def get(self, key):
+        """Return the cached tile or None. The tile is a writable copy, like a freshly fetched one.
+        """
+        with self._lock:
+            row = self._db.execute("select hash, dtype, shape from tiles where key = ?", (key,)).fetchone()
+            if row is not None:
+                try:
+                    with open(self._blob_path(row[0]), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    # Evicted by another process after the lookup.
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("update tiles set last_access = ? where key = ?", (time.time(), key))
+            self.hits += 1
+
+        digest, dtype, shape = row
+        shape = tuple(int(s) for s in shape.split(",") if s)
+        # The decompressed bytes are immutable, copy them so the tile can be edited in place.
+        return np.frombuffer(bytearray(zlib.decompress(data)), dtype=dtype).reshape(shape)
+
+    def put(self, key, tile):
+        """Store a tile and evict the least recently used tiles if the cache is full.
+        """
+        tile = np.ascontiguousarray(tile)
+        data = zlib.compress(tile.tobytes(), self.compression_level)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        shape = ",".join(str(s) for s in tile.shape)
+
+        with self._lock, self._transaction():
+            old = self._db.execute("select hash from tiles where key = ?", (key,)).fetchone()
+            if old is not None:
+                if old[0] == digest:
+                    self._db.execute("update tiles set last_access = ? where key = ?", (time.time(), key))
+                    return
+                self._drop_tile(key, old[0])
+
+            if self._db.execute("update blobs set refs = refs + 1 where hash = ?", (digest,)).rowcount == 0:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._db.execute("insert into blobs values (?, ?, 1)", (digest, len(data)))
+                self._db.execute("update meta set value = value + ? where key = 'bytes'", (len(data),))
+            self._db.execute(
+                "insert into tiles values (?, ?, ?, ?, ?)", (key, digest, tile.dtype.str, shape, time.time())
+            )
+            self._evict()
+
+    def _drop_tile(self, key, digest):
+        """Delete a tile and its contents if no other tile refers to them. Returns the freed bytes.
+        """
+        self._db.execute("delete from tiles where key = ?", (key,))
+        self._db.execute("update blobs set refs = refs - 1 where hash = ?", (digest,))
+        size, refs = self._db.execute("select size, refs from blobs where hash = ?", (digest,)).fetchone()
+        if refs <= 0:
+            self._db.execute("delete from blobs where hash = ?", (digest,))
+            self._db.execute("update meta set value = value - ? where key = 'bytes'", (size,))
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+            return size
+        return 0
+
+    def _evict(self):
+        total, = self._db.execute("select value from meta where key = 'bytes'").fetchone()
+        while total > self.max_bytes:
+            rows = self._db.execute("select key, hash from tiles order by last_access limit 64").fetchall()
+            if not rows:
+                break
+            for key, digest in rows:
+                total -= self._drop_tile(key, digest)
+                self.evictions += 1
+                # Stop as soon as the cache fits, the rows are only fetched in batches.
+                if total <= self.max_bytes:
+                    break
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached tile or fetch it with `fetch()` and cache it.
+        """
+        tile = self.get(key)
+        if tile is None:
+            tile = fetch()
+            self.put(key, tile)
+        return tile
+
+    def stats(self):
+        """Return the hit / miss counters of this process and the current size of the shared cache.
+        """
+        with self._lock:
+            n_tiles, = self._db.execute("select count(*) from tiles").fetchone()
+            n_blobs, = self._db.execute("select count(*) from blobs").fetchone()
+            size, = self._db.execute("select value from meta where key = 'bytes'").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "tiles": n_tiles,
+                "unique_tiles": n_blobs,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock, self._transaction():
+            for digest, in self._db.execute("select hash from blobs").fetchall():
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+            self._db.execute("delete from tiles")
+            self._db.execute("delete from blobs")
+            self._db.execute("update meta set value = 0 where key = 'bytes'")
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach_tile_cache(conn, cache=None, **kwargs):
+    """Attach a tile cache to the connection and return it.
+
+    All pixel reads of `biohack_utils` on this connection go through the cache. If no cache is
+    given the cache of the server at its default location is opened with `kwargs`.
+    """
+    if cache is None:
+        cache = TileCache.for_connection(conn, **kwargs)
+    conn._biohack_tile_cache = cache
+    return cache
+
+
+def detach_tile_cache(conn):
+    """Remove the tile cache from the connection and return it (or None).
+    """
+    return conn.__dict__.pop("_biohack_tile_cache", None)
+
+
+def get_tile_cache(conn):
+    """Return the tile cache attached to the connection or None.
+    """
+    return getattr(conn, "_biohack_tile_cache", None)
@@ -0,0 +1,302 @@
+"""Opt-in tracing of the OMERO calls made through a connection.
+
+`trace_connection` wraps a connection so that every call of the connection, of the services and
+stores it hands out and of the object wrappers it returns is counted and timed. Each call is
+tagged with the high-level operation that triggered it (see `operation`), e.g.:
+
+    with Tracer() as tracer:
+        conn = trace_connection(conn, tracer)
+        with operation("load labels"):
+            fetch_omero_labels_in_napari(conn, image_id)
+    print(tracer.to_prometheus())
+
+Untraced connections are not touched, and `operation` only sets a context variable while a
+tracer is active, so the instrumentation costs next to nothing when it is not used.
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+_operation = contextvars.ContextVar("biohack_operation", default=None)
+_active_tracers = []
+
+# Calls on object wrappers that go to the server, their other methods are local getters.
+_REMOTE_WRAPPER_METHODS = {
+    "listAnnotations", "linkAnnotation", "listChildren", "countChildren", "getParent", "getAncestry",
+    "getAnnotation", "getPlane", "getPlanes", "getTile", "getTiles", "resetDefaults", "save",
+}
+_PIXEL_CALLS = {"getPlane", "getPlanes", "getTile", "getTiles", "getStack", "getRow", "getCol", "setPlane", "setTile"}
+
+
+def current_operation():
+    """The tag of the operation that is running, nested operations are joined with '/'.
+    """
+    return _operation.get()
+
+
+@contextmanager
+def operation(name):
+    """Tag all traced calls inside the block with this operation and time the block.
+    """
+    if not _active_tracers:
+        yield
+        return
+    parent = _operation.get()
+    tag = name if parent is None else f"{parent}/{name}"
+    token = _operation.set(tag)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t0
+        _operation.reset(token)
+        for tracer in list(_active_tracers):
+            tracer._record_operation(tag, duration)
+
+
+def traced_operation(name):
+    """Decorator version of `operation`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active_tracers:
+                return func(*args, **kwargs)
+            with operation(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer:
+    """Collects the count and duration of OMERO calls per operation and call.
+
+    The tracer only records between `start` and `stop`, or inside a `with` block. An active
+    tracer records all traced calls and operations of the process, so every `start` needs a
+    matching `stop`.
+
+    Args:
+        max_events: Number of individual calls kept for the JSON trace, the aggregated
+            statistics cover all calls.
+    """
+    def __init__(self, max_events=100_000):
+        self.max_events = max_events
+        self.events = []
+        self.dropped_events = 0
+        self._calls = defaultdict(lambda: [0, 0.0, 0.0, 0])  # count, seconds, max seconds, errors
+        self._operations = defaultdict(lambda: [0, 0.0])  # count, seconds
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self not in _active_tracers:
+            _active_tracers.append(self)
+
+    def stop(self):
+        if self in _active_tracers:
+            _active_tracers.remove(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _record_call(self, call, start, duration, error):
+        if self not in _active_tracers:
+            return
+        tag = _operation.get()
+        with self._lock:
+            stats = self._calls[(tag, call)]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] += error
+            if len(self.events) < self.max_events:
+                self.events.append((tag, call, start - self._t0, duration, threading.get_ident(), error))
+            else:
+                self.dropped_events += 1
+
+    def _record_operation(self, tag, duration):
+        with self._lock:
+            stats = self._operations[tag]
+            stats[0] += 1
+            stats[1] += duration
+
+    def summary(self):
+        """Return the statistics per (operation, call) and per operation.
+
+        The operations report their wall time and the time spent in traced calls, the
+        difference is the local work.
+        """
+        with self._lock:
+            calls = [
+                {
+                    "operation": tag, "call": call, "kind": _call_kind(call), "count": count,
+                    "seconds": seconds, "max_seconds": max_seconds, "errors": errors,
+                }
+                for (tag, call), (count, seconds, max_seconds, errors) in sorted(
+                    self._calls.items(), key=lambda item: (str(item[0][0]), item[0][1])
+                )
+            ]
+            operations = {
+                tag: {"count": count, "seconds": seconds} for tag, (count, seconds) in self._operations.items()
+            }
+        for tag, stats in operations.items():
+            # Includes the calls of nested operations.
+            stats["call_seconds"] = sum(
+                c["seconds"] for c in calls if c["operation"] == tag or (c["operation"] or "").startswith(f"{tag}/")
+            )
+            stats["local_seconds"] = max(stats["seconds"] - stats["call_seconds"], 0.0)
+        return {"calls": calls, "operations": operations}
+
+    def to_json(self, path=None):
+        """Export the calls as a Chrome trace (viewable in chrome://tracing or Perfetto) with the summary.
+        """
+        with self._lock:
+            events = list(self.events)
+        trace = {
+            "traceEvents": [
+                {
+                    "name": call, "cat": _call_kind(call), "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                    "pid": 0, "tid": tid, "args": {"operation": tag, "error": bool(error)},
+                }
+                for tag, call, start, duration, tid, error in events
+            ],
+            "droppedEvents": self.dropped_events,
+            "summary": self.summary(),
+        }
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(trace, f)
+        return trace
+
+    def to_prometheus(self, prefix="biohack_omero"):
+        """Export the statistics in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        lines = []
+
+        def _metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}")
+
+        call_labels = [
+            ({"operation": c["operation"] or "", "call": c["call"], "kind": c["kind"]}, c) for c in summary["calls"]
+        ]
+        _metric("calls_total", "Number of OMERO calls.", [(labels, c["count"]) for labels, c in call_labels])
+        _metric(
+            "call_seconds_total", "Time spent in OMERO calls.", [(labels, c["seconds"]) for labels, c in call_labels]
+        )
+        _metric(
+            "call_errors_total", "Number of failed OMERO calls.", [(labels, c["errors"]) for labels, c in call_labels]
+        )
+        _metric(
+            "operation_seconds_total", "Wall time of the traced operations.",
+            [({"operation": tag}, stats["seconds"]) for tag, stats in summary["operations"].items()],
+        )
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _call_kind(call):
+    service, _, method = call.rpartition(".")
+    return "pixels" if service == "RawPixelsStore" or method in _PIXEL_CALLS else "metadata"
+
+
+class _Traced:
+    """Proxy that times the calls of the wrapped object and wraps the objects they return.
+    """
+    __slots__ = ("_target", "_tracer", "_name", "_record_all")
+
+    def __init__(self, target, tracer, name, record_all):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_tracer", tracer)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_record_all", record_all)
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        tracer, call = self._tracer, f"{self._name}.{attr}"
+        record = self._record_all or attr in _REMOTE_WRAPPER_METHODS
+
+        @functools.wraps(value)
+        def _call(*args, **kwargs):
+            if not record:
+                return _wrap(value(*args, **kwargs), tracer, attr)
+            start = time.perf_counter()
+            error = 0
+            try:
+                return _wrap(value(*args, **kwargs), tracer, attr)
+            except Exception:
+                error = 1
+                raise
+            finally:
+                tracer._record_call(call, start, time.perf_counter() - start, error)
+        return _call
+
+    def __setattr__(self, attr, value):
+        setattr(self._target, attr, value)
+
+    def __iter__(self):
+        return (_wrap(item, self._tracer, None) for item in self._target)
+
+    def __repr__(self):
+        return f"Traced({self._target!r})"
+
+
+def _wrap(result, tracer, method):
+    """Wrap services, stores and object wrappers returned by a traced call.
+    """
+    from omero.gateway import BlitzObjectWrapper, ProxyObjectWrapper
+
+    if isinstance(result, BlitzObjectWrapper):
+        return _Traced(result, tracer, getattr(result, "OMERO_CLASS", None) or type(result).__name__, False)
+    if isinstance(result, ProxyObjectWrapper) or method == "createRawPixelsStore":
+        name = method or type(result).__name__
+        for prefix in ("get", "create"):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        return _Traced(result, tracer, name, True)
+    if isinstance(result, list):
+        return [_wrap(item, tracer, None) for item in result]
+    if hasattr(result, "__next__"):  # Generators, e.g. of getObjects or listAnnotations.
+        return (_wrap(item, tracer, None) for item in result)
+    return result
+
+
+def trace_connection(conn, tracer):
+    """Return a traced proxy of the connection that reports to the tracer.
+
+    Connection methods returning services (`get*Service`, `createRawPixelsStore`) are not
+    recorded themselves, but all calls on the services they return are.
+    """
+    return _TracedConnection(conn, tracer)
+
+
+class _TracedConnection(_Traced):
+    __slots__ = ()
+
+    def __init__(self, conn, tracer):
+        super().__init__(conn, tracer, "Gateway", True)
+
+    def __getattr__(self, attr):
+        if attr.startswith("get") and attr.endswith("Service"):
+            value = getattr(self._target, attr)
+            return lambda *args, **kwargs: _Traced(value(*args, **kwargs), self._tracer, attr[len("get"):], True)
+        return super().__getattr__(attr)
@@ -0,0 +1,215 @@
+"""Streaming upload of (large) images and label volumes to OMERO.
+
+The data is read plane by plane, or in strips of rows for planes that are too large for a single
+server call, and written straight into the raw pixels store. Sources only need `shape`, `dtype`
+and numpy-style slicing, e.g. memory-mapped TIFFs, zarr arrays or dask arrays.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from omero.model import DatasetI, DatasetImageLinkI, ImageI
+from omero.sys import ParametersI
+
+
+# Stay well below the default Ice message size limit of OMERO.
+MAX_BYTES_PER_CALL = 32 * 1024 * 1024
+
+_PIXELS_TYPES = {
+    "bool": "uint8",
+    "uint8": "uint8",
+    "int8": "int8",
+    "uint16": "uint16",
+    "int16": "int16",
+    "uint32": "uint32",
+    "int32": "int32",
+    "float32": "float",
+    "float64": "double",
+}
+_DEFAULT_AXES = {2: "yx", 3: "zyx", 4: "czyx", 5: "tczyx"}
+
+
+def open_lazy(path):
+    """Open image data without loading it into memory.
+
+    TIFFs are memory-mapped if possible and opened through their zarr interface otherwise,
+    zarr / OME-Zarr data is opened with zarr (the full resolution of an OME-Zarr group).
+    Other formats are read with imageio.
+    """
+    path = str(path)
+    if path.rstrip("/").endswith(".zarr") or os.path.isdir(path):
+        import zarr
+
+        data = zarr.open(path, mode="r")
+        return data if isinstance(data, zarr.Array) else data["0"]
+
+    if path.lower().endswith((".tif", ".tiff")):
+        import tifffile
+        import zarr
+
+        try:
+            return tifffile.memmap(path, mode="r")
+        except ValueError:  # Compressed or tiled data can't be memory-mapped.
+            data = zarr.open(tifffile.imread(path, aszarr=True), mode="r")
+            return data if isinstance(data, zarr.Array) else data["0"]
+
+    import imageio.v3 as imageio
+    return imageio.imread(path)
+
+
+def _pixels_type(conn, dtype):
+    dtype = np.dtype(dtype)
+    if dtype.name not in _PIXELS_TYPES:
+        raise ValueError(f"Data type {dtype} is not supported by OMERO.")
+    params = ParametersI()
+    params.addString("pt", _PIXELS_TYPES[dtype.name])
+    return conn.getQueryService().findByQuery("from PixelsType as p where p.value = :pt", params, conn.SERVICE_OPTS)
+
+
+def _to_omero_bytes(block):
+    """OMERO expects the pixel data in big-endian byte order.
+    """
+    if block.dtype == bool:
+        block = block.astype("uint8")
+    return np.ascontiguousarray(block, dtype=block.dtype.newbyteorder(">")).tobytes()
+
+
+def _plane_index(axes, t, c, z):
+    position = {"t": t, "c": c, "z": z}
+    return tuple(position[ax] if ax in position else slice(None) for ax in axes)
+
+
+def _print_progress(name):
+    def _progress(done, total):
+        print(f"\rUploading {name}: {done}/{total} planes", end="\n" if done == total else "")
+    return _progress
+
+
+def upload_array(
+    conn, data, name, axes=None, dataset_id=None, description=None, max_bytes=MAX_BYTES_PER_CALL, progress=None,
+):
+    """Create an OMERO image and stream the data into it.
+
+    At most one plane, or one strip of `max_bytes` for larger planes, is held in memory.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        data: Array-like source with `shape`, `dtype` and numpy-style slicing.
+        name: Name of the image.
+        axes: The axes of the data, a subset of 'tczyx' that contains 'y' and 'x'.
+            By default 'yx', 'zyx', 'czyx' or 'tczyx', depending on the number of dimensions.
+        dataset_id: The dataset to put the image in.
+        description: The image description.
+        max_bytes: Maximal number of bytes sent with one call, larger planes are sent in strips.
+        progress: Callable `progress(done_planes, total_planes)`.
+
+    Returns:
+        The id of the new image.
+    """
+    axes = axes or _DEFAULT_AXES.get(len(data.shape))
+    if axes is None or len(axes) != len(data.shape) or "y" not in axes or "x" not in axes:
+        raise ValueError(f"Invalid axes {axes} for data of shape {data.shape}.")
+
+    sizes = {ax: 1 for ax in "tczyx"}
+    sizes.update(dict(zip(axes, data.shape)))
+    dtype = np.dtype("uint8") if data.dtype == bool else np.dtype(data.dtype)
+
+    pixels_service = conn.getPixelsService()
+    image_id = pixels_service.createImage(
+        sizes["x"], sizes["y"], sizes["z"], sizes["t"], list(range(sizes["c"])),
+        _pixels_type(conn, dtype), name, description or "", conn.SERVICE_OPTS,
+    ).getValue()
+    pixels_id = conn.getObject("Image", image_id).getPixelsId()
+
+    rows_per_call = max(1, max_bytes // (sizes["x"] * dtype.itemsize))
+    y_axis = axes.index("y")
+    # The plane axes keep their relative order, transpose if x comes before y.
+    transpose = axes.index("x") < y_axis
+    n_planes = sizes["t"] * sizes["c"] * sizes["z"]
+    channel_min = [None] * sizes["c"]
+    channel_max = [None] * sizes["c"]
+
+    rps = conn.createRawPixelsStore()
+    try:
+        rps.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+        done = 0
+        for t in range(sizes["t"]):
+            for c in range(sizes["c"]):
+                for z in range(sizes["z"]):
+                    index = _plane_index(axes, t, c, z)
+                    for y0 in range(0, sizes["y"], rows_per_call):
+                        y1 = min(y0 + rows_per_call, sizes["y"])
+                        block_index = list(index)
+                        block_index[y_axis] = slice(y0, y1)
+                        block = np.asarray(data[tuple(block_index)])
+                        if transpose:
+                            block = block.T
+
+                        if block.size:
+                            bmin, bmax = block.min(), block.max()
+                            channel_min[c] = bmin if channel_min[c] is None else min(channel_min[c], bmin)
+                            channel_max[c] = bmax if channel_max[c] is None else max(channel_max[c], bmax)
+
+                        if y0 == 0 and y1 == sizes["y"]:
+                            rps.setPlane(_to_omero_bytes(block), z, c, t, conn.SERVICE_OPTS)
+                        else:
+                            rps.setTile(_to_omero_bytes(block), z, c, t, 0, y0, sizes["x"], y1 - y0, conn.SERVICE_OPTS)
+
+                    done += 1
+                    if progress is not None:
+                        progress(done, n_planes)
+        rps.save(conn.SERVICE_OPTS)
+    finally:
+        rps.close()
+
+    for c in range(sizes["c"]):
+        if channel_min[c] is not None:
+            pixels_service.setChannelGlobalMinMax(
+                pixels_id, c, float(channel_min[c]), float(channel_max[c]), conn.SERVICE_OPTS
+            )
+
+    if dataset_id is not None:
+        link = DatasetImageLinkI()
+        link.setParent(DatasetI(dataset_id, False))
+        link.setChild(ImageI(image_id, False))
+        conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+
+    image = conn.getObject("Image", image_id)
+    image.resetDefaults()
+    return image_id
+
+
+def upload_files(conn, paths, names=None, dataset_id=None, pool=None, max_workers=4, show_progress=True):
+    """Upload several image files concurrently, each one streamed with `upload_array`.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        paths: The file paths.
+        names: The image names, by default the file names.
+        dataset_id: The dataset to put the images in.
+        pool: A `biohack_utils.session.ConnectionPool` to give each upload its own connection.
+            By default a pool joined to the session of `conn` with `max_workers` connections
+            is created and closed at the end.
+        max_workers: Number of concurrent uploads.
+        show_progress: Whether to print the upload progress.
+
+    Returns:
+        List of the new image ids, in the order of the paths.
+    """
+    from .session import _worker_pool
+
+    names = names or [os.path.basename(str(path).rstrip("/")) for path in paths]
+    max_workers = max(1, min(max_workers, len(paths)))
+
+    with _worker_pool(conn, pool, max_workers) as pool:
+        def _upload(path, name):
+            progress = _print_progress(name) if show_progress else None
+            data = open_lazy(path)
+            if pool is None:
+                return upload_array(conn, data, name, dataset_id=dataset_id, progress=progress)
+            with pool.connection() as pool_conn:
+                return upload_array(pool_conn, data, name, dataset_id=dataset_id, progress=progress)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(_upload, paths, names))
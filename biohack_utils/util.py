@@ -1,28 +1,20 @@
 import argparse
-import numpy as np
 
-from omero.gateway import BlitzGateway
+from .session import DEFAULT_HOST, DEFAULT_PORT, get_session_connection
 
 
-def _upload_image(conn, curr, iname):
-    images = [curr]
-    image = conn.createImageFromNumpySeq(
-        (im for im in images),
-        imageName=iname,
-    )
-    return image.id
+def _upload_image(conn, curr, iname, dataset=None):
+    from .upload import upload_array
+
+    dataset_id = None if dataset is None else dataset.getId()
+    return upload_array(conn, curr, iname, axes="yx", dataset_id=dataset_id)
 
 
 def _upload_volume(conn, curr, iname):
-    # Upload the image and corresponding labels
-    image = conn.createImageFromNumpySeq(
-        (plane for plane in curr),
-        sizeZ=curr.shape[0],
-        sizeC=1,
-        sizeT=1,
-        imageName=iname,
-    )
-    return image.id
+    # Upload the image and corresponding labels, streamed plane by plane.
+    from .upload import upload_array
+
+    return upload_array(conn, curr, iname, axes="zyx")
 
 
 def _find_images_with_collection_id_in_dataset(conn, namespace, collection_id, dataset_id, limit=None):
@@ -55,9 +47,20 @@ def _find_images_with_collection_id_in_dataset(conn, namespace, collection_id, d
 
 
 def _omero_image_to_2d_array(img, z=0, c=0, t=0):
-    pixels = img.getPrimaryPixels()
-    plane = pixels.getPlane(z, c, t)
-    return np.asarray(plane)
+    import numpy as np
+    from .tile_cache import get_tile_cache, image_version, tile_key
+
+    def _fetch():
+        pixels = img.getPrimaryPixels()
+        plane = pixels.getPlane(z, c, t)
+        return np.asarray(plane)
+
+    # Read through the tile cache of the connection, if one is attached.
+    tile_cache = get_tile_cache(getattr(img, "_conn", None))
+    if tile_cache is None:
+        return _fetch()
+    region = (0, 0, img.getSizeX(), img.getSizeY())
+    return tile_cache.get_or_fetch(tile_key(img.getPixelsId(), None, z, c, t, region, image_version(img)), _fetch)
 
 
 def fetch_omero_labels_in_napari(conn, image_id, return_raw=False):
@@ -106,8 +109,16 @@ def fetch_omero_labels_in_napari(conn, image_id, return_raw=False):
 def connect_to_omero(args):
     USERNAME = args.username
     PASSWORD = args.password
-    HOST = "omero-training.gerbi-gmb.de"
-    PORT = 4064  # Default OMERO port
+    HOST = DEFAULT_HOST
+    PORT = DEFAULT_PORT
+
+    if getattr(args, "reuse_session", False):
+        # Joins the cached session if it is still alive, logs in and caches it otherwise.
+        conn = get_session_connection(USERNAME, PASSWORD, host=HOST, port=PORT)
+        print("Connected to OMERO")
+        return conn
+
+    from omero.gateway import BlitzGateway
 
     conn = BlitzGateway(USERNAME, PASSWORD, host=HOST, port=PORT)
     conn.connect()
@@ -127,4 +138,8 @@ def omero_credential_parser():
     parser.add_argument("-p", "--password", type=str, required=True)
     parser.add_argument("--image_id", type=int)
     parser.add_argument("--namespace", type=str, default="ome/collection")
+    parser.add_argument(
+        "--reuse_session", action="store_true",
+        help="Join the cached OMERO session of this user instead of logging in again."
+    )
     return parser
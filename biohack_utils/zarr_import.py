@@ -0,0 +1,203 @@
+"""Import of an OME-Zarr collection (RFC-8) into OMERO.
+
+Every multiscale node of the collection becomes an OMERO image, whose full resolution is read
+lazily from the zarr chunks and uploaded in parallel. Afterwards the collection annotation and
+all node annotations, with the RFC-8 `attributes`, are created in bulk; the `link` attribute
+becomes link annotations of the node, without the image URLs of the exporting server. A manifest
+records the progress, so that a re-run skips nodes that were already imported.
+"""
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import omero_annotation
+from .session import _worker_pool
+from .upload import upload_array
+
+
+_IMAGE_URL = re.compile(r"/webclient/img_detail/\d+/?$")
+
+
+def _default_manifest_path(path):
+    return os.path.abspath(str(path)).rstrip("/") + ".omero-import.json"
+
+
+def _read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {"collection_id": None, "nodes": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _open_multiscale(group):
+    """Return the full resolution array of a multiscale group and its axes as a string, e.g. 'czyx'.
+    """
+    attrs = group.attrs.asdict()
+    multiscales = attrs.get("ome", attrs).get("multiscales")
+    if not multiscales:
+        raise ValueError(f"{group.path} is not a multiscale image.")
+    multiscale = multiscales[0]
+    axes = "".join(ax["name"] if isinstance(ax, dict) else ax for ax in multiscale["axes"])
+    return group[multiscale["datasets"][0]["path"]], axes
+
+
+def read_collection(path):
+    """Read the collection metadata of an OME-Zarr collection.
+    Returns the collection attributes and a list of (node path, node dict) for the multiscale nodes.
+    """
+    import zarr
+
+    root = zarr.open_group(str(path), mode="r")
+    ome = root.attrs.asdict().get("ome", {})
+    if ome.get("type") != "collection":
+        raise ValueError(f"{path} is not an OME-Zarr collection.")
+
+    nodes = []
+    for node in ome.get("nodes", []):
+        node_path = os.path.normpath(node["path"])
+        if node.get("type") == "collection":
+            print(f"Skipping nested collection {node_path}")
+            continue
+        nodes.append((node_path, node))
+    return ome, nodes
+
+
+def import_collection(conn, path, dataset_id=None, manifest_path=None, pool=None, n_workers=4, show_progress=True):
+    """Register an OME-Zarr collection in OMERO.
+
+    Args:
+        conn: BlitzGateway connection to omero.
+        path: The path of the OME-Zarr collection.
+        dataset_id: The dataset to put the images in.
+        manifest_path: The path of the manifest, by default next to the collection.
+        pool: A `biohack_utils.session.ConnectionPool` to give each upload its own connection.
+            By default a pool joined to the session of `conn` with `n_workers` connections is
+            created and closed at the end.
+        n_workers: Number of concurrent uploads.
+        show_progress: Whether to print the progress.
+
+    Returns:
+        The id of the collection annotation and a dict {node path: image id}.
+    """
+    import zarr
+
+    ome, nodes = read_collection(path)
+    root = zarr.open_group(str(path), mode="r")
+
+    manifest_path = manifest_path or _default_manifest_path(path)
+    manifest = _read_manifest(manifest_path)
+    lock = threading.Lock()
+
+    if manifest["collection_id"] is None:
+        manifest["collection_id"] = omero_annotation._create_collection(
+            conn, ome.get("name") or os.path.basename(str(path).rstrip("/")), ome.get("version", "0.x")
+        )
+        _write_manifest(manifest_path, manifest)
+    collection_id = manifest["collection_id"]
+
+    def _upload(node_path, node):
+        data, axes = _open_multiscale(root[node_path])
+        name = node.get("name") or node_path
+        progress = None
+        if show_progress:
+            def progress(done, total):
+                print(f"\r{name}: {done}/{total} planes", end="\n" if done == total else "")
+
+        if pool is None:
+            image_id = upload_array(conn, data, name, axes=axes, dataset_id=dataset_id, progress=progress)
+        else:
+            with pool.connection() as pool_conn:
+                image_id = upload_array(pool_conn, data, name, axes=axes, dataset_id=dataset_id, progress=progress)
+
+        with lock:
+            manifest["nodes"][node_path] = {"image_id": image_id, "node_id": None}
+            _write_manifest(manifest_path, manifest)
+
+    todo = [(node_path, node) for node_path, node in nodes if node_path not in manifest["nodes"]]
+    if show_progress:
+        print(f"Importing {len(todo)} of {len(nodes)} nodes ({len(nodes) - len(todo)} imported already).")
+    with _worker_pool(conn, pool, min(n_workers, len(todo))) as pool:
+        with ThreadPoolExecutor(n_workers) as executor:
+            for _ in executor.map(lambda args: _upload(*args), todo):
+                pass
+
+    # A previous run may have written the nodes but stopped before recording them in the manifest.
+    pending = [
+        (node_path, node) for node_path, node in nodes if manifest["nodes"][node_path]["node_id"] is None
+    ]
+    existing = omero_annotation._resolve_nodes(
+        conn, [manifest["nodes"][node_path]["image_id"] for node_path, _ in pending]
+    )
+    for node_path, _ in pending:
+        for node_id, kv in existing[manifest["nodes"][node_path]["image_id"]]:
+            if kv.get("collection_id") == str(collection_id):
+                manifest["nodes"][node_path]["node_id"] = node_id
+                break
+
+    # All missing node annotations are written together.
+    pending = [
+        (node_path, node) for node_path, node in pending if manifest["nodes"][node_path]["node_id"] is None
+    ]
+    # The links are written as link annotations of their own, not as the node's 'link' attribute.
+    attributes = {node_path: dict(node.get("attributes") or {}) for node_path, node in pending}
+    links = {node_path: attributes[node_path].pop("link", None) for node_path, _ in pending}
+    node_ids = omero_annotation._bulk_add_node_annotations(conn, [
+        {
+            "image_id": manifest["nodes"][node_path]["image_id"],
+            "collection_id": collection_id,
+            "type": node.get("type"),
+            "name": node.get("name"),
+            "attributes": attributes[node_path] or None,
+        }
+        for node_path, node in pending
+    ])
+    omero_annotation._bulk_append_links(conn, [
+        (manifest["nodes"][node_path]["image_id"], link)
+        for node_path, node_links in links.items() if node_links is not None
+        for link in (node_links if isinstance(node_links, list) else [node_links])
+        # The image URLs of the exporting server point to other images, each image got its own URL.
+        if not _IMAGE_URL.search(str(link))
+    ])
+    for node_path, _ in pending:
+        manifest["nodes"][node_path]["node_id"] = node_ids[manifest["nodes"][node_path]["image_id"]]
+    _write_manifest(manifest_path, manifest)
+
+    return collection_id, {node_path: manifest["nodes"][node_path]["image_id"] for node_path, _ in nodes}
+
+
+def main():
+    from .session import close_connection
+    from .util import connect_to_omero, omero_credential_parser
+
+    parser = omero_credential_parser()
+    parser.description = "Import an OME-Zarr collection into OMERO."
+    parser.add_argument("-i", "--input", type=str, required=True, help="Path of the OME-Zarr collection.")
+    parser.add_argument("--dataset_id", type=int)
+    parser.add_argument("--manifest", type=str, help="Path of the import manifest.")
+    parser.add_argument("--n_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    conn = connect_to_omero(args)
+    try:
+        collection_id, image_ids = import_collection(
+            conn, args.input, dataset_id=args.dataset_id, manifest_path=args.manifest, n_workers=args.n_workers
+        )
+    finally:
+        close_connection(conn)
+
+    print(f"Collection {collection_id}:")
+    for node_path, image_id in image_ids.items():
+        print(f"  {node_path} -> Image {image_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,25 +7,20 @@ def load_omero_labels_in_napari(conn, image_id, is_3d=False):
     if isinstance(image_id, list):  # If it's a list, only check one image.
         image_id = image_id[0]
 
-    from biohack_utils.omero_annotation import fetch_omero_labels_in_napari
+    from biohack_utils.omero_annotation import fetch_collection_layers
 
-    raw_data, label_dict = fetch_omero_labels_in_napari(
-        conn, image_id, return_raw=True, is_3d=is_3d, label_node_type="Labels"
-    )
-
-    if id_was_a_list:
-        # Well the assumption is there are multiple images. So, gotta catch them all.
-        ldict = fetch_omero_labels_in_napari(
-            conn, image_id, return_raw=False, is_3d=is_3d, label_node_type="Intensities"
-        )
-        label_dict = {**label_dict, **ldict}
+    # Well the assumption is there are multiple images if we get a list. So, gotta catch them all.
+    # All node types are resolved in one pass over the collection graph.
+    node_types = ["Labels", "Intensities"] if id_was_a_list else ["Labels"]
+    raw_data, layers = fetch_collection_layers(conn, image_id, node_types)
 
     # Say hello to napari.
     import napari
     v = napari.Viewer()
-    v.add_image(raw_data, blending="additive")
-    for key, val in label_dict.items():
-        v.add_image(val, name=key)
+    v.add_image(raw_data, blending="additive", multiscale=True)
+    for node_layers in layers.values():
+        for key, val in node_layers.items():
+            v.add_image(val, name=key, multiscale=True)
     napari.run()
 
 
@@ -36,22 +31,15 @@ def write_annotations_to_image_and_labels(conn, image_id, label_id):
     if isinstance(image_id, int):
         image_id = [image_id]
 
-    for curr_iid in image_id:  # Links multiple image ids.
-        # Links the collection to the raw image.
-        omero_annotation._link_collection_to_image(conn, ann_id, curr_iid)
-        # Add node annotations to the raw image
-        omero_annotation._add_node_annotation(conn, curr_iid, "Intensities", ann_id, "Raw")
-
-    # Links the collection to the label image.
-    omero_annotation._link_collection_to_image(conn, ann_id, label_id)
-    # Add node annotation to the label image.
-    omero_annotation._add_node_annotation(conn, label_id, "Labels", ann_id, "Cell_Segmentation")
-
-    # Finally, let's build a pseudo-network by linking all links.
-    all_image_ids = image_id + [label_id]
-    for iid in all_image_ids:
-        link = omero_annotation._build_image_url(iid)
-        omero_annotation._append_link_to_node_annotation(conn, iid, link)
+    # Node annotations for the raw images (linked to multiple image ids) and the label image.
+    nodes = [
+        {"image_id": curr_iid, "collection_id": ann_id, "type": "Intensities", "name": "Raw"}
+        for curr_iid in image_id
+    ]
+    nodes.append({"image_id": label_id, "collection_id": ann_id, "type": "Labels", "name": "Cell_Segmentation"})
+
+    # Links everything to the collection and builds the pseudo-network of links in one go.
+    return omero_annotation._bulk_add_node_annotations(conn, nodes)
 
 
 def main():
@@ -1,9 +1,9 @@
 import argparse
-import imageio.v3 as imageio
 
-from skimage.measure import label
-
-from biohack_utils.util import connect_to_omero, _upload_image, _upload_volume
+from biohack_utils.relabel import relabel_blockwise
+from biohack_utils.session import close_connection
+from biohack_utils.upload import open_lazy, upload_array
+from biohack_utils.util import connect_to_omero
 
 
 def upload_data(conn, fpath, name, labels=False):
@@ -13,21 +13,20 @@ def upload_data(conn, fpath, name, labels=False):
         conn: BlitzGateway conection to omero.web.
         fpath: File path to data.
         name: Name for uploaded data.
-        labels: Specify uploaded data as labels to set data type to uint16.
+        labels: Specify uploaded data as labels. They are relabelled block-wise and stored
+            with the smallest data type that fits the number of objects.
     """
-    arr = imageio.imread(fpath)
+    # The data is opened lazily and streamed to the server plane by plane.
+    arr = open_lazy(fpath)
     if labels:
-        arr = label(arr).astype("uint16")
-
-    if len(arr.shape) == 2:
-        img_id = _upload_image(conn, arr, name)
+        arr = relabel_blockwise(arr)
+        print(f"Found {arr.n_objects} objects, storing them as {arr.dtype}")
 
-    elif len(arr.shape) == 3:
-        img_id = _upload_volume(conn, arr, name)
-
-    else:
+    if len(arr.shape) not in (2, 3):
         raise ValueError("Input data must have 2D or 3D shape.")
 
+    img_id = upload_array(conn, arr, name, progress=lambda done, total: print(f"Uploaded {done}/{total} planes"))
+
     print(f"Created image with ID: {img_id}")
 
 
@@ -47,12 +46,17 @@ def main():
         help="Specify that the uploaded data is a label. Default: Image data."
     )
 
+    parser.add_argument(
+        "--reuse_session", action="store_true",
+        help="Join the cached OMERO session of this user instead of logging in again."
+    )
+
     args = parser.parse_args()
 
     conn = connect_to_omero(args)
     upload_data(conn, args.input, args.name, args.label)
 
-    conn.close()
+    close_connection(conn)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,10 @@ setup(
     entry_points={
         "console_scripts": [
             "biohack_utils.delete_anns = biohack_utils.delete_annotations:main",
+            "biohack_utils.export_zarr = biohack_utils.zarr_export:main",
+            "biohack_utils.import_zarr = biohack_utils.zarr_import:main",
+            "biohack_utils.bulk_delete = biohack_utils.bulk_delete:main",
+            "biohack = biohack_utils.cli:main",
         ]
     }
 )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests share the in-memory `FakeGateway` of the benchmarks.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
@@ -0,0 +1,25 @@
+"""Tests of the connections the `biohack` daemon keeps open between commands.
+"""
+import types
+
+from biohack_utils import cli, util
+
+
+def test_daemon_reuses_a_connection_only_with_the_same_password(monkeypatch):
+    class _Connection:
+        def keepAlive(self):
+            pass
+
+    logins = []
+    monkeypatch.setattr(util, "connect_to_omero", lambda args: logins.append(args.password) or _Connection())
+    monkeypatch.setattr(cli, "_daemon_connections", {})
+
+    def _args(password):
+        return types.SimpleNamespace(username="user", password=password, reuse_session=False)
+
+    conn = cli._connect(_args("secret"))
+    assert cli._connect(_args("secret")) is conn
+    assert cli._connect(_args("wrong")) is not conn
+    assert logins == ["secret", "wrong"]
+    # The passwords are not kept in memory as the keys of the connections.
+    assert all("secret" not in key and "wrong" not in key for key in cli._daemon_connections)
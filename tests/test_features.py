@@ -0,0 +1,72 @@
+"""Tests of the streamed instance features against `skimage.measure.regionprops`.
+"""
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+from skimage.measure import regionprops
+
+from biohack_utils import features
+
+
+def _random_labels(shape, seed):
+    rng = np.random.default_rng(seed)
+    # Few large and sparse label values, so instances span several blocks and the lookup table is skipped.
+    labels = rng.integers(0, 8, size=shape) * 1_000_003
+    return labels.astype("uint64"), rng.random(shape)
+
+
+@pytest.mark.parametrize("block_shape", [None, (3, 5, 7)])
+def test_instance_features_match_regionprops(block_shape):
+    labels, intensities = _random_labels((6, 20, 30), seed=0)
+    result = features.instance_features(labels, intensities, block_shape=block_shape, axis_names="zyx")
+
+    props = regionprops(labels.astype("int64"), intensity_image=intensities)
+    np.testing.assert_array_equal(result["label"], [prop.label for prop in props])
+    np.testing.assert_array_equal(result["area"], [prop.area for prop in props])
+    for axis, name in enumerate("zyx"):
+        np.testing.assert_array_equal(result[f"bbox_min_{name}"], [prop.bbox[axis] for prop in props])
+        # regionprops excludes the upper bound of the bounding box.
+        np.testing.assert_array_equal(result[f"bbox_max_{name}"], [prop.bbox[axis + 3] - 1 for prop in props])
+        np.testing.assert_allclose(result[f"centroid_{name}"], [prop.centroid[axis] for prop in props])
+    np.testing.assert_allclose(result["mean_intensity"], [prop.intensity_mean for prop in props])
+
+
+def test_instance_features_of_an_empty_image():
+    result = features.instance_features(np.zeros((4, 4), dtype="uint16"))
+    assert all(len(values) == 0 for values in result.values())
+    assert set(result) == {
+        "label", "area", "bbox_min_y", "bbox_max_y", "bbox_min_x", "bbox_max_x", "centroid_y", "centroid_x",
+    }
+
+
+def test_compute_collection_features_uses_a_pooled_connection_per_label_image(monkeypatch):
+    pytest.importorskip("omero.rtypes", exc_type=ImportError)
+    from biohack_utils import omero_annotation, session
+
+    class _Pool:
+        closed = False
+
+        @classmethod
+        def from_connection(cls, conn, size):
+            _Pool.instance = cls()
+            return _Pool.instance
+
+        @contextmanager
+        def connection(self):
+            yield "pooled"
+
+        def close(self):
+            self.closed = True
+
+    members = {1: [(11, {"collection_id": "7", "type": "Labels", "name": "a"})],
+               2: [(12, {"collection_id": "7", "type": "Labels", "name": "b"})]}
+    monkeypatch.setattr(session, "ConnectionPool", _Pool)
+    monkeypatch.setattr(omero_annotation, "_resolve_members", lambda conn, ids: ({7: [1, 2]}, members))
+    used = []
+    monkeypatch.setattr(
+        features, "compute_image_features", lambda conn, image_id, raw_id, channel: used.append(conn) or {}
+    )
+
+    assert sorted(features.compute_collection_features("conn", 7, save=False)) == [1, 2]
+    assert used == ["pooled", "pooled"] and _Pool.instance.closed
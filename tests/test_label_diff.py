@@ -0,0 +1,76 @@
+"""Tests of the streamed label diff against dense diffs and of the exact reconstruction from deltas.
+"""
+import io
+
+import numpy as np
+import pytest
+
+from biohack_utils.label_diff import apply_delta, diff_labels
+
+
+def _versions(shape, seed, dtype="uint32"):
+    rng = np.random.default_rng(seed)
+    labels_a = rng.integers(0, 12, size=shape).astype(dtype)
+    labels_b = labels_a.copy()
+    # Edit a few pixels, delete an instance and add a new one.
+    edit = rng.random(shape) < 0.05
+    labels_b[edit] = rng.integers(0, 12, size=edit.sum())
+    labels_b[labels_b == 3] = 0
+    labels_b[(slice(0, 2),) * len(shape)] = 40
+    return labels_a, labels_b
+
+
+def _dense_stats(labels_a, labels_b):
+    changed = labels_a != labels_b
+    labels = np.setdiff1d(np.union1d(labels_a, labels_b), [0])
+    return {
+        "label": labels,
+        "area_a": np.array([(labels_a == label).sum() for label in labels]),
+        "area_b": np.array([(labels_b == label).sum() for label in labels]),
+        "removed": np.array([((labels_a == label) & changed).sum() for label in labels]),
+        "added": np.array([((labels_b == label) & changed).sum() for label in labels]),
+    }
+
+
+@pytest.mark.parametrize("block_shape", [None, (3, 4, 5)])
+def test_diff_labels_matches_dense_diff(block_shape):
+    labels_a, labels_b = _versions((5, 11, 13), seed=0)
+    diff = diff_labels(labels_a, labels_b, block_shape=block_shape)
+
+    expected = _dense_stats(labels_a, labels_b)
+    for column, values in expected.items():
+        np.testing.assert_array_equal(diff["instances"][column], values, err_msg=column)
+    assert diff["n_pixels"] == labels_a.size
+    assert diff["n_changed"] == (labels_a != labels_b).sum()
+    assert diff["changed_fraction"] == pytest.approx(diff["n_changed"] / labels_a.size)
+    assert diff["new_instances"] == 1 and diff["deleted_instances"] == 1
+    modified = (expected["area_a"] > 0) & (expected["area_b"] > 0) & (expected["removed"] + expected["added"] > 0)
+    assert diff["modified_instances"] == modified.sum()
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int64"])
+@pytest.mark.parametrize("block_shape", [(2, 4, 4), (5, 11, 13), (3, 7, 6)])
+def test_apply_delta_reconstructs_the_new_version_exactly(dtype, block_shape):
+    labels_a, labels_b = _versions((5, 11, 13), seed=1, dtype=dtype)
+    _, delta = diff_labels(labels_a, labels_b, block_shape=block_shape, return_delta=True)
+    assert len(delta["values"]) == (labels_a != labels_b).sum()
+
+    # The delta survives the compressed file it is stored in.
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **delta)
+    buffer.seek(0)
+    with np.load(buffer) as stored:
+        version = apply_delta(labels_a, dict(stored))
+
+    assert version.shape == labels_b.shape and version.dtype == labels_b.dtype
+    np.testing.assert_array_equal(np.asarray(version), labels_b)
+    for key in [(slice(1, 4), slice(2, 9), slice(3, 12)), (2, slice(None), 5), (Ellipsis, slice(6, None))]:
+        np.testing.assert_array_equal(version[key], labels_b[key])
+
+
+def test_diff_of_identical_labels_has_an_empty_delta():
+    labels, _ = _versions((4, 6), seed=2)
+    diff, delta = diff_labels(labels, labels.copy(), return_delta=True)
+    assert diff["n_changed"] == 0 and diff["modified_instances"] == 0
+    assert len(delta["block_index"]) == 0
+    np.testing.assert_array_equal(apply_delta(labels, delta)[...], labels)
@@ -0,0 +1,54 @@
+"""Tests of the blockwise label pyramid against downsampling the whole array at once.
+"""
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from biohack_utils.label_pyramid import build_label_pyramid, downsample_labels
+
+
+def _random_labels(shape, seed):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 5, size=shape).astype("uint16")
+
+
+def _whole_array_levels(data, n_levels, factor, method):
+    levels = [data]
+    for _ in range(1, n_levels):
+        levels.append(downsample_labels(levels[-1], factor, method))
+    return levels[1:]
+
+
+def test_downsample_labels_takes_the_first_most_frequent_label():
+    block = _random_labels((2, 9, 7), seed=0)
+    result = downsample_labels(block, factor=3)
+    padded = np.pad(block, [(0, 0), (0, 0), (0, 2)], mode="edge")
+    for z, y, x in np.ndindex(*result.shape):
+        window = padded[z, 3 * y:3 * y + 3, 3 * x:3 * x + 3].ravel().tolist()
+        counts = Counter(window)
+        # Counter keeps the order of the first occurrence, so max returns the first of the ties.
+        assert result[z, y, x] == max(counts, key=counts.get)
+    np.testing.assert_array_equal(downsample_labels(block, 3, "nearest"), block[..., ::3, ::3])
+
+
+@pytest.mark.parametrize("method", ["mode", "nearest"])
+@pytest.mark.parametrize("factor,block_shape", [(2, (1, 6, 10)), (3, (2, 9, 9)), (2, None)])
+def test_build_label_pyramid_matches_whole_array_downsampling(method, factor, block_shape, tmp_path):
+    data = _random_labels((3, 37, 50), seed=1)
+    levels = build_label_pyramid(
+        data, n_levels=4, factor=factor, method=method, block_shape=block_shape, n_workers=0, tmp_dir=tmp_path,
+    )
+    expected = _whole_array_levels(data, 4, factor, method)
+    assert [level.shape for level in levels] == [level.shape for level in expected]
+    for level, expected_level in zip(levels, expected):
+        assert level.dtype == data.dtype
+        np.testing.assert_array_equal(level, expected_level)
+
+
+def test_build_label_pyramid_in_processes_equals_serial(tmp_path):
+    data = _random_labels((2, 64, 48), seed=2)
+    serial = build_label_pyramid(data, n_levels=3, block_shape=(1, 16, 16), n_workers=0, tmp_dir=tmp_path)
+    parallel = build_label_pyramid(data, n_levels=3, block_shape=(1, 16, 16), n_workers=2, tmp_dir=tmp_path)
+    for serial_level, parallel_level in zip(serial, parallel):
+        np.testing.assert_array_equal(serial_level, parallel_level)
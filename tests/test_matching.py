@@ -0,0 +1,80 @@
+"""Tests of the sparse contingency table and IoU matching against dense brute-force versions.
+"""
+import numpy as np
+import pytest
+
+from biohack_utils import matching
+
+
+def _random_labels(shape, n_labels, seed):
+    rng = np.random.default_rng(seed)
+    # Coarse blobs, so the instances of the two images overlap partially.
+    coarse = rng.integers(0, n_labels, size=tuple(-(-s // 4) for s in shape))
+    labels = np.kron(coarse, np.ones((4,) * len(shape), dtype="int64"))[tuple(slice(0, s) for s in shape)]
+    return _perturb(labels, n_labels, rng)
+
+
+def _perturb(labels, n_labels, rng, fraction=0.2):
+    """Relabel the instances and replace a fraction of the pixels by random labels.
+    """
+    labels = np.concatenate([[0], rng.permutation(np.arange(1, n_labels))])[labels]
+    noise = rng.random(labels.shape) < fraction
+    labels[noise] = rng.integers(0, n_labels, size=noise.sum())
+    return labels
+
+
+def _dense_iou(labels_a, labels_b):
+    n_a, n_b = labels_a.max() + 1, labels_b.max() + 1
+    overlap = np.bincount(labels_a.ravel() * n_b + labels_b.ravel(), minlength=n_a * n_b).reshape(n_a, n_b)
+    union = overlap.sum(axis=1)[:, None] + overlap.sum(axis=0)[None, :] - overlap
+    return overlap, np.where(overlap > 0, overlap / np.maximum(union, 1), 0.0)
+
+
+def _greedy_matches(iou, threshold):
+    """Match the pairs in the order of decreasing IoU, skipping pairs whose labels are already matched.
+    """
+    matched_a, matched_b, matches = set(), set(), {}
+    pairs = [(iou[a, b], a, b) for a in range(1, iou.shape[0]) for b in range(1, iou.shape[1]) if iou[a, b] > threshold]
+    for value, a, b in sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2])):
+        if a not in matched_a and b not in matched_b:
+            matched_a.add(a)
+            matched_b.add(b)
+            matches[a] = (b, value)
+    return matches
+
+
+@pytest.mark.parametrize("block_shape", [None, (5, 7)])
+def test_contingency_table_matches_dense_overlap(block_shape):
+    labels_a = _random_labels((30, 40), 20, seed=0)
+    labels_b = _random_labels((30, 40), 25, seed=1)
+    label_a, label_b, count = matching.contingency_table(labels_a, labels_b, block_shape=block_shape)
+
+    overlap, _ = _dense_iou(labels_a, labels_b)
+    overlap[0, 0] = 0
+    expected_a, expected_b = np.nonzero(overlap)
+    np.testing.assert_array_equal(label_a, expected_a)
+    np.testing.assert_array_equal(label_b, expected_b)
+    np.testing.assert_array_equal(count, overlap[expected_a, expected_b])
+
+
+@pytest.mark.parametrize("threshold", [0.0, 0.2, 0.5])
+@pytest.mark.parametrize("seed", range(3))
+def test_match_instances_equals_greedy_matching(threshold, seed):
+    labels_a = _random_labels((40, 40), 30, seed=seed)
+    # A new version of the labels, with partial matches of all IoUs.
+    labels_b = _perturb(labels_a, 30, np.random.default_rng(seed + 10), fraction=0.3)
+    result = matching.match_instances(labels_a, labels_b, threshold=threshold, block_shape=(8, 8))
+
+    _, iou = _dense_iou(labels_a, labels_b)
+    expected = _greedy_matches(iou, threshold)
+    assert result["label_a"].tolist() == sorted(expected)
+    assert result["label_b"].tolist() == [expected[a][0] for a in sorted(expected)]
+    np.testing.assert_allclose(result["iou"], [expected[a][1] for a in sorted(expected)])
+    np.testing.assert_array_equal(result["labels_a"], np.setdiff1d(np.unique(labels_a), [0]))
+    np.testing.assert_array_equal(result["areas_a"], np.bincount(labels_a.ravel())[result["labels_a"]])
+
+
+def test_match_instances_without_foreground():
+    empty = np.zeros((4, 4), dtype="uint8")
+    result = matching.match_instances(empty, empty)
+    assert all(len(values) == 0 for values in result.values())
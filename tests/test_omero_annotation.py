@@ -0,0 +1,88 @@
+"""Tests of the collection helpers against the in-memory `FakeGateway` of the benchmarks.
+"""
+import pytest
+
+pytest.importorskip("omero.rtypes", exc_type=ImportError)
+
+from biohack_utils import omero_annotation as oa  # noqa: E402
+
+from fake_gateway import FakeGateway, make_collection_server  # noqa: E402
+
+
+def test_find_related_images_in_several_collections():
+    gateway = FakeGateway()
+    first_id, second_id = (
+        gateway.add_annotation(oa.NS_COLLECTION, [("type", "collection"), ("name", name)]) for name in ("a", "b")
+    )
+
+    def _add_member(name, nodes):
+        image_id = gateway.add_image(name)
+        for coll_id, node_type in nodes:
+            gateway.add_link(image_id, coll_id)
+            gateway.add_link(image_id, gateway.add_annotation(
+                oa.NS_NODE, [("type", node_type), ("collection_id", coll_id), ("name", f"{name}_{coll_id}")]
+            ))
+        return image_id
+
+    raw_id = _add_member("raw", [(first_id, "Intensities"), (second_id, "Intensities")])
+    label_id = _add_member("label", [(first_id, "Labels")])
+    # A label in the first collection and an intensity image in the second one.
+    shared_id = _add_member("shared", [(first_id, "Labels"), (second_id, "Intensities")])
+
+    filtered = oa._find_related_images(gateway, raw_id, node_type="Labels")
+    assert sorted((member["collection_id"], member["image_id"]) for member in filtered) == [
+        (first_id, label_id), (first_id, shared_id)
+    ]
+    assert all(member["nodes"]["type"] == "Labels" for member in filtered)
+
+    unfiltered = oa._find_related_images(gateway, raw_id)
+    nodes = {(member["collection_id"], member["image_id"]): member["nodes"] for member in unfiltered}
+    assert nodes[(first_id, shared_id)]["type"] == "Labels"
+    assert nodes[(second_id, shared_id)]["type"] == "Intensities"
+
+
+def test_bulk_add_node_annotations_adds_each_image_url_once():
+    gateway = FakeGateway()
+    first_id, second_id = (
+        gateway.add_annotation(oa.NS_COLLECTION, [("type", "collection"), ("name", name)]) for name in ("a", "b")
+    )
+    image_id = gateway.add_image("image")
+    # Two nodes of the image in one chunk, then a re-run that adds its node in another collection.
+    oa._bulk_add_node_annotations(gateway, [
+        {"image_id": image_id, "collection_id": first_id, "type": "Intensities"},
+        {"image_id": image_id, "collection_id": first_id, "type": "Labels"},
+    ])
+    oa._bulk_add_node_annotations(gateway, [{"image_id": image_id, "collection_id": second_id, "type": "Labels"}])
+
+    assert oa._get_node_links(gateway, image_id) == [oa._build_image_url(image_id)]
+    assert len(oa._list_map_annotations(gateway, image_id, oa.NS_LINK)) == 1
+
+
+def test_node_attributes_round_trip_keeps_their_types():
+    attributes = {"a": "1", "b": "true", "c": 1, "d": [1, 2], "e": "json:x", "f": {"g": None}}
+    kv = oa._node_kv("Labels", 1, attributes=attributes)
+    assert oa._node_attributes(kv) == attributes
+    # Links written as plain JSON by older versions.
+    assert oa._legacy_links('["https://example.org/a"]') == ["https://example.org/a"]
+    assert oa._legacy_links(kv["attributes.d"]) == [1, 2]
+
+
+def test_fetch_labels_opens_the_raw_image_only_when_needed(monkeypatch, capsys):
+    from biohack_utils import pixels
+
+    opened = []
+    monkeypatch.setattr(
+        pixels, "get_pyramid_lazy", lambda conn, image, *args: opened.append(image.getId()) or [image.getId(), None]
+    )
+    gateway, _ = make_collection_server(3)
+    raw_id, *label_ids = gateway.images
+
+    assert oa.fetch_omero_labels_in_napari(gateway, raw_id, return_raw=True, label_node_type="Missing") == {}
+    assert opened == []
+
+    raw_data, labels = oa.fetch_omero_labels_in_napari(gateway, raw_id, return_raw=True)
+    assert sorted(opened) == sorted(label_ids + [raw_id])
+    # Only the full resolution arrays, unless multiscale is requested.
+    assert raw_data == raw_id and sorted(labels.values()) == sorted(label_ids)
+    raw_data, labels = oa.fetch_omero_labels_in_napari(gateway, raw_id, return_raw=True, multiscale=True)
+    assert raw_data == [raw_id, None] and all(len(data) == 2 for data in labels.values())
@@ -0,0 +1,88 @@
+"""Tests of the LRU eviction, the shared tile contents and the hits of the on-disk tile cache.
+"""
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+from biohack_utils import tile_cache
+from biohack_utils.tile_cache import TileCache, tile_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock that advances by one second on every call, so the access order is deterministic."""
+    ticks = itertools.count(1)
+    monkeypatch.setattr(tile_cache.time, "time", lambda: float(next(ticks)))
+
+
+def _tile(seed, shape=(32, 32)):
+    return np.random.default_rng(seed).integers(0, 2 ** 16, size=shape, dtype="uint16")
+
+
+def _blob_files(cache):
+    return [name for _, _, names in os.walk(os.path.join(cache.path, "blobs")) for name in names]
+
+
+def test_evicts_the_least_recently_used_tiles(tmp_path, clock):
+    with TileCache(str(tmp_path)) as cache:
+        for i in range(3):
+            cache.put(f"tile{i}", _tile(i))
+        # Room for three and a half tiles of about the same size.
+        cache.max_bytes = cache.stats()["bytes"] * 7 // 6
+        # Reading tile0 makes tile1 the least recently used one.
+        assert cache.get("tile0") is not None
+        cache.put("tile3", _tile(3))
+
+        assert cache.get("tile1") is None
+        for i in (0, 2, 3):
+            np.testing.assert_array_equal(cache.get(f"tile{i}"), _tile(i))
+        stats = cache.stats()
+        assert stats["evictions"] == 1 and stats["tiles"] == 3 and stats["bytes"] <= cache.max_bytes
+        assert len(_blob_files(cache)) == 3
+
+
+def test_identical_tiles_share_their_contents(tmp_path, clock):
+    empty = np.zeros((64, 64), dtype="uint32")
+    with TileCache(str(tmp_path)) as cache:
+        cache.put("a", empty)
+        cache.put("b", empty)
+        stats = cache.stats()
+        assert stats["tiles"] == 2 and stats["unique_tiles"] == 1
+        assert len(_blob_files(cache)) == 1
+
+        # The contents stay as long as one tile refers to them.
+        cache.put("a", _tile(0))
+        np.testing.assert_array_equal(cache.get("b"), empty)
+        cache.put("b", _tile(0))
+        stats = cache.stats()
+        assert stats["tiles"] == 2 and stats["unique_tiles"] == 1
+        assert len(_blob_files(cache)) == 1
+
+        cache.clear()
+        assert cache.stats()["bytes"] == 0 and _blob_files(cache) == []
+
+
+def test_hits_are_writable_copies(tmp_path):
+    tile = _tile(1, shape=(2, 16, 8))
+    with TileCache(str(tmp_path)) as cache:
+        fetched = []
+        key = tile_key(1, None, 0, 0, 0, (0, 0, 8, 16), version=5)
+        assert cache.get_or_fetch(key, lambda: fetched.append(key) or tile) is tile
+
+        hit = cache.get_or_fetch(key, lambda: fetched.append(key) or tile)
+        assert fetched == [key]
+        assert hit.dtype == tile.dtype and hit.flags.writeable
+        hit[:] = 0
+        np.testing.assert_array_equal(cache.get(key), tile)
+        # A new version of the image misses the old tiles.
+        assert cache.get(tile_key(1, None, 0, 0, 0, (0, 0, 8, 16), version=6)) is None
+        assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_the_cache_is_shared_through_its_directory(tmp_path):
+    with TileCache(str(tmp_path)) as cache:
+        cache.put("tile", _tile(2))
+    with TileCache(str(tmp_path)) as cache:
+        np.testing.assert_array_equal(cache.get("tile"), _tile(2))
@@ -0,0 +1,77 @@
+"""Round-trip of a collection through the OME-Zarr export and import.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("omero.rtypes", exc_type=ImportError)
+
+from biohack_utils import omero_annotation as oa  # noqa: E402
+from biohack_utils import zarr_import  # noqa: E402
+from biohack_utils.zarr_export import export_collection  # noqa: E402
+
+from fake_gateway import make_collection_server  # noqa: E402
+
+
+def test_zarr_export_import_keeps_links(tmp_path, monkeypatch):
+    gateway, (collection_id,) = make_collection_server(2)
+    raw_id, label_id = gateway.images
+    oa._bulk_append_links(gateway, [
+        (raw_id, "https://example.org/raw"), (label_id, "https://example.org/label"),
+        (raw_id, oa._build_image_url(raw_id)), (label_id, oa._build_image_url(label_id)),
+    ])
+
+    export_collection(
+        gateway, collection_id, str(tmp_path / "collection.zarr"),
+        source_factory=lambda image_id: [np.zeros((1, 1, 1, 8, 8), dtype="uint8")], n_workers=1,
+    )
+    _, nodes = zarr_import.read_collection(tmp_path / "collection.zarr")
+    assert [node["attributes"]["link"] for _, node in nodes] == [
+        ["https://example.org/raw", oa._build_image_url(raw_id)],
+        ["https://example.org/label", oa._build_image_url(label_id)],
+    ]
+
+    monkeypatch.setattr(zarr_import, "upload_array", lambda conn, data, name, **kwargs: conn.add_image(name))
+    _, image_ids = zarr_import.import_collection(
+        gateway, tmp_path / "collection.zarr", manifest_path=str(tmp_path / "manifest.json"), n_workers=1,
+        show_progress=False,
+    )
+    links = oa._bulk_get_node_links(gateway, list(image_ids.values()))
+    # The image URLs of the exported images are replaced by the URLs of the imported ones.
+    assert all(
+        oa._build_image_url(image_id) in links[image_id] and not {
+            oa._build_image_url(raw_id), oa._build_image_url(label_id)
+        } & set(links[image_id])
+        for image_id in image_ids.values()
+    )
+    assert ["https://example.org/raw" in links[image_id] for image_id in image_ids.values()] == [True, False]
+    assert ["https://example.org/label" in links[image_id] for image_id in image_ids.values()] == [False, True]
+    assert not any(
+        "attributes.link" in kv for image_id in image_ids.values()
+        for _, kv in oa._list_map_annotations(gateway, image_id, oa.NS_NODE)
+    )
+
+
+def test_zarr_import_resumes_without_duplicating_nodes(tmp_path, monkeypatch):
+    gateway, (collection_id,) = make_collection_server(2)
+    export_collection(
+        gateway, collection_id, str(tmp_path / "collection.zarr"),
+        source_factory=lambda image_id: [np.zeros((1, 1, 1, 8, 8), dtype="uint8")], n_workers=1,
+    )
+    monkeypatch.setattr(zarr_import, "upload_array", lambda conn, data, name, **kwargs: conn.add_image(name))
+    manifest_path = str(tmp_path / "manifest.json")
+    _, image_ids = zarr_import.import_collection(
+        gateway, tmp_path / "collection.zarr", manifest_path=manifest_path, n_workers=1, show_progress=False,
+    )
+
+    # The process died after writing the nodes, before recording them in the manifest.
+    manifest = zarr_import._read_manifest(manifest_path)
+    for entry in manifest["nodes"].values():
+        entry["node_id"] = None
+    zarr_import._write_manifest(manifest_path, manifest)
+    zarr_import.import_collection(
+        gateway, tmp_path / "collection.zarr", manifest_path=manifest_path, n_workers=1, show_progress=False,
+    )
+
+    for image_id in image_ids.values():
+        assert len(oa._list_map_annotations(gateway, image_id, oa.NS_NODE)) == 1
+    assert all(entry["node_id"] is not None for entry in zarr_import._read_manifest(manifest_path)["nodes"].values())